@@ -10,16 +10,27 @@ import importlib.util
 import platform
 import venv
 from pathlib import Path
-from datetime import datetime
-from threading import Thread, Event
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from collections import deque
+from threading import Thread, Event, Lock, RLock, BoundedSemaphore
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import openai
+import httpx
+from openai.types import CompletionUsage
 from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TaskProgressColumn
 from rich.console import Console
 from rich.panel import Panel
 import json
+import uuid
+import queue
+import random
 import requests
 import shutil
+import signal
+import codecs
 """
 在保留原有代码结构和功能的基础上，
 通过 CommandHandler 类来统一管理命令处理逻辑，
@@ -30,6 +41,16 @@ import shutil
 PYTHON_MIN_VERSION = (3, 7)
 VENV_DIR = "venv3.9"
 REQUIREMENTS_FILE = "requirements.txt"
+CODE_DIR = "代码工具库"
+RUN_HISTORY_FILE = "run_history.jsonl"
+WHEEL_CACHE_DIR = os.getenv("WHEEL_CACHE_DIR", "wheelhouse")
+PENDING_QUEUE_FILE = "pending_dependencies.jsonl"
+LEGACY_PENDING_FILE = "pending_dependencies.json"
+ANALYSIS_CACHE_FILE = "dependency_analysis_cache.json"
+QUEUE_MAX_ATTEMPTS = 5
+QUEUE_BACKOFF_BASE = 30  # 秒，失败后按 30s、60s、120s... 退避
+# 启动器约定：由本程序启动的脚本会带上该环境变量，生成代码中的环境检查据此跳过
+LAUNCHER_ENV_MARKER = "AUTOCODE_LAUNCHER"
 
 # 根据操作系统动态设置Python命令
 if sys.platform == "win32":
@@ -40,6 +61,89 @@ else:
 # 先加载环境变量
 load_dotenv()
 
+# 托管运行配置（可在.env中覆盖）
+# terminal: 在新窗口中运行；managed: 在当前会话中托管运行并记录运行信息；background: 作为后台任务运行
+run_mode = os.getenv("RUN_MODE", "terminal")
+RUN_MODES = ("terminal", "managed", "background")
+RUN_TIMEOUT = float(os.getenv("RUN_TIMEOUT", "600"))
+RUN_CPU_LIMIT = int(os.getenv("RUN_CPU_LIMIT", "300"))
+# POSIX下限制的是虚拟地址空间（RLIMIT_AS），numpy/torch等库启动时就会预留大量地址空间，因此默认不限（0）
+RUN_MEMORY_LIMIT_MB = int(os.getenv("RUN_MEMORY_LIMIT_MB", "0"))
+RUN_NOFILE_LIMIT = int(os.getenv("RUN_NOFILE_LIMIT", "256"))
+RUN_OUTPUT_BUFFER_LINES = int(os.getenv("RUN_OUTPUT_BUFFER_LINES", "500"))
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "4"))
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", "0"))  # 0表示后台任务不限时
+
+# 预热启动配置（仅Linux/macOS，在托管运行和后台任务模式下生效）
+warm_launch_enabled = os.getenv("WARM_LAUNCHER", "0") == "1"
+WARM_MODULES = [m.strip() for m in os.getenv("WARM_MODULES", "").split(",") if m.strip()]
+WARM_MODULE_LIMIT = int(os.getenv("WARM_MODULE_LIMIT", "6"))
+venv_generation = 0  # 虚拟环境中的包每变化一次加1，用于判断预热进程是否过期
+
+# 解释器选择：fixed 固定使用Python 3.9虚拟环境；fastest 为每个脚本选用兼容的最快解释器（各自独立的虚拟环境）
+interpreter_policy = os.getenv("INTERPRETER_POLICY", "fixed")
+INTERPRETER_BENCH_FILE = "interpreter_bench.json"
+WHEEL_INFO_CACHE_FILE = "wheel_availability.json"
+WHEEL_INFO_TTL = 7 * 24 * 3600
+
+# 性能分析配置
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "10"))
+PROFILE_REPEAT = int(os.getenv("PROFILE_REPEAT", "3"))  # 优化前后各计时几次
+
+# 启动前预检配置
+PREFLIGHT_ENABLED = os.getenv("PREFLIGHT", "1") != "0"
+PREFLIGHT_TIMEOUT = float(os.getenv("PREFLIGHT_TIMEOUT", "60"))
+
+# 性能检查：保存生成代码前检查常见的慢写法（只提示）；PERF_LINT_FIX=1 时自动去掉只配合进度输出的短延时
+PERF_LINT_FIX = os.getenv("PERF_LINT_FIX", "0") == "1"
+PERF_SLEEP_MAX = float(os.getenv("PERF_SLEEP_MAX", "2"))  # 不超过该秒数的常量延时视为人为延时
+PERF_LINT_FILE = "perf_lint.json"
+
+# 导出：把脚本和锁定的依赖打包成单个 .pyz 文件
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+
+# 存储清理（gc命令）；STORAGE_BUDGET_MB 大于0时，启动时占用超出预算会自动清理
+STORAGE_BUDGET_MB = float(os.getenv("STORAGE_BUDGET_MB", "0"))
+GC_UNUSED_DAYS = int(os.getenv("GC_UNUSED_DAYS", "60"))  # 超过这么多天没运行过的脚本视为不再使用
+GC_SESSION_DAYS = int(os.getenv("GC_SESSION_DAYS", "14"))  # 超过这么多天的会话记录可以清理
+# 提示词方案：default 默认；perf 额外要求注重运行速度
+prompt_profile = os.getenv("PROMPT_PROFILE", "default")
+
+# 增量修改：修改已生成的代码时只让模型输出修改部分
+edit_mode_enabled = os.getenv("EDIT_MODE", "1") != "0"
+
+# 模型自动路由：off手动 / auto自动选择 / cascade自动选择且难题先由reasoner规划再由chat写代码
+routing_mode = os.getenv("MODEL_ROUTING", "off")
+if routing_mode not in ("off", "auto", "cascade"):
+    routing_mode = "off"
+ROUTING_THRESHOLD = int(os.getenv("ROUTING_THRESHOLD", "2"))
+
+# 对冲请求：DeepSeek超过首token阈值仍无输出时，同一请求发给通义千问，先出内容者胜出
+hedge_enabled = os.getenv("HEDGE_REQUESTS", "0") == "1"
+HEDGE_TTFT_THRESHOLD = float(os.getenv("HEDGE_TTFT_THRESHOLD", "3"))
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.9"))
+HEDGE_MODELS = {"deepseek-chat": os.getenv("HEDGE_QWEN_MODEL", "qwen-max-2025-01-25")}
+
+# 接口请求容错：连接超时与流式输出的空闲超时分开设置，失败后带抖动退避，连续失败熔断
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "10"))
+API_IDLE_TIMEOUT = float(os.getenv("API_IDLE_TIMEOUT", "60"))
+RETRY_BACKOFF_BASE = float(os.getenv("RETRY_BACKOFF_BASE", "1"))
+RETRY_BACKOFF_CAP = float(os.getenv("RETRY_BACKOFF_CAP", "20"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "60"))
+MAX_CONTINUATIONS = int(os.getenv("MAX_CONTINUATIONS", "3"))
+
+# 接口限流：每个服务商每分钟请求数、每分钟tokens数（0为不限制）和同时进行的请求数
+API_RPM = int(os.getenv("API_RPM", "60"))
+API_TPM = int(os.getenv("API_TPM", "0"))
+API_MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY", "4"))
+ESTIMATED_OUTPUT_TOKENS = int(os.getenv("ESTIMATED_OUTPUT_TOKENS", "1500"))
+
+# 批量生成配置
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+BATCH_RPM = int(os.getenv("BATCH_RPM", "30"))
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", str(min(8, os.cpu_count() or 4))))
+
 console = Console()
 
 DEEPSEEK_CLIENT = 0
@@ -55,10 +159,18 @@ try:
         console.print("[blue]DEEPSEEK_API_KEY=your_api_key_here[/blue]")
         sys.exit(1)
     
-    # 初始化 DeepSeek 客户端
+    # 初始化 DeepSeek 客户端（重试由chat_stream负责，客户端自身不重试）
+    deepseek_base_url = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1")
     deepseek_client = openai.OpenAI(
         api_key=deepseek_api_key,
-        base_url="https://api.deepseek.com/v1"
+        base_url=deepseek_base_url,
+        max_retries=0
+    )
+    # 前缀续写（断线续传、长度截断续写）需要使用beta接口
+    deepseek_beta_client = openai.OpenAI(
+        api_key=deepseek_api_key,
+        base_url=os.getenv("DEEPSEEK_BETA_BASE_URL", re.sub(r"/v1/?$", "/beta", deepseek_base_url)),
+        max_retries=0
     )
     
     # 初始化 通义千问 客户端（仅在需要时）
@@ -69,10 +181,12 @@ try:
         console.print("[blue]DASHSCOPE_API_KEY=your_api_key_here[/blue]")
         sys.exit(1)
     
+    # 配置了通义千问密钥时也创建客户端，供对冲请求使用
     qwen_client = openai.OpenAI(
         api_key=qwen_api_key if qwen_api_key else "dummy_key",
-        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-    ) if current_client_type == QWEN_CLIENT else None
+        base_url=os.getenv("DASHSCOPE_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1"),
+        max_retries=0
+    ) if current_client_type == QWEN_CLIENT or qwen_api_key else None
     
     # 根据当前客户端类型选择客户端
     client = deepseek_client if current_client_type == DEEPSEEK_CLIENT else qwen_client
@@ -148,17 +262,26 @@ class ProgressManager:
 
 class StreamPrinter:
     """流式输出处理器"""
+    silent = False
+
     def __init__(self):
+        self.listeners = []
         self.buffer = []
         self.is_first_chunk = True
         self.print_lock = Event()
         self.print_lock.set()
         self.last_chunk_ended_with_newline = False
 
+    def add_listener(self, listener):
+        """注册监听器，每个流式片段都会传给它（如写入会话日志）"""
+        self.listeners.append(listener)
+
     def stream_print(self, content):
         """优化后的流式输出逻辑"""
         if not content:
             return
+        for listener in self.listeners:
+            listener(content)
         self.buffer.append(content)
         if self.print_lock.is_set():
             self.print_lock.clear()
@@ -188,7 +311,17 @@ class StreamPrinter:
             console.print()
         self.last_chunk_ended_with_newline = False
 
-def extract_code_from_response(response):
+class SilentPrinter(StreamPrinter):
+    """不输出任何内容的流式处理器（批量模式下使用）"""
+    silent = True
+
+    def stream_print(self, content):
+        pass
+
+    def reset(self):
+        pass
+
+def extract_code_from_response(response, verbose=True):
     """代码提取函数"""
     filename_match = re.search(r'『([\u4e00-\u9fa5a-zA-Z0-9_-]+)』\.py', response)
     suggested_filename = filename_match.group(1) if filename_match else None
@@ -207,12 +340,14 @@ def extract_code_from_response(response):
         
     code_content = code_blocks[0].strip()
     
-    if not any(line.startswith('# 依赖包：') for line in code_content.split('\n')):
+    if verbose and not any(line.startswith('# 依赖包：') for line in code_content.split('\n')):
         console.print("[yellow]警告：未检测到依赖声明，可能会影响依赖安装[/yellow]")
     
     if suggested_filename and any('\u4e00' <= c <= '\u9fa5' for c in suggested_filename):
         try:
-            test_path = os.path.join("代码工具库", f"{suggested_filename}.py")
+            # 使用独立的探测文件名，避免误删同名的已保存文件（批量并发保存时尤其重要）
+            os.makedirs(CODE_DIR, exist_ok=True)
+            test_path = os.path.join(CODE_DIR, f".{suggested_filename}_{os.getpid()}_{time.time_ns()}.py")
             with open(test_path, "w", encoding="utf-8") as f:
                 f.write("")
             os.remove(test_path)
@@ -222,7 +357,7 @@ def extract_code_from_response(response):
     
     return code_content, suggested_filename
 
-def extract_imports(code_content):
+def extract_imports(code_content, verbose=True):
     """使用AST解析器从代码中提取依赖，并从注释中提取版本信息"""
     imports = set()
     try:
@@ -266,63 +401,23 @@ def extract_imports(code_content):
                     lib = package_mapping.get(lib, lib)
                     imports.add(lib)
     except SyntaxError:
-        console.print("\n[red]⚠️ 代码解析错误，无法提取依赖[/red]")
+        if verbose:
+            console.print("\n[red]⚠️ 代码解析错误，无法提取依赖[/red]")
     
-    if imports:
+    if imports and verbose:
         console.print("\n[yellow]检测到的依赖：[/yellow]")
         for dep in imports:
             console.print(f"[blue]- {dep}[/blue]")
     
     return imports
 
-def is_installed(lib_name):
-    """检查库是否已安装"""
+def is_installed(lib_name, verbose=True):
+    """检查库及其依赖闭包是否已安装（读取已安装包的元数据，不调用pip）"""
     try:
-        if lib_name in STANDARD_LIBS:
-            return True
-        package_name = lib_name.split('==')[0] if '==' in lib_name else lib_name
-        python_path = setup_virtual_env()
-        result = subprocess.run(
-            [python_path, "-m", "pip", "show", package_name],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        if result.returncode == 0:
-            special_packages = {
-                'manim': [
-                    'numpy', 'pillow', 'scipy', 'matplotlib', 'tqdm', 'colour', 'pycairo',
-                    'cloup', 'click', 'moderngl', 'moderngl_window', 'mapbox-earcut',
-                    'networkx', 'decorator'
-                ],
-                'torch': ['numpy', 'typing-extensions', 'filelock', 'sympy', 'networkx', 'jinja2'],
-                'tensorflow': [
-                    'numpy', 'six', 'wheel', 'packaging', 'protobuf', 'keras',
-                    'h5py', 'wrapt', 'opt-einsum', 'astunparse', 'gast'
-                ],
-                'opencv-python': ['numpy', 'pillow'],
-                'pygame': ['numpy'],
-                'kivy': ['docutils', 'pygments', 'kivy_deps.sdl2', 'kivy_deps.glew']
-            }
-            if package_name in special_packages:
-                missing_deps = []
-                for dep in special_packages[package_name]:
-                    dep_result = subprocess.run(
-                        [python_path, "-m", "pip", "show", dep],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True
-                    )
-                    if dep_result.returncode != 0:
-                        console.print(f"[yellow]依赖包 {dep} 未安装[/yellow]")
-                        missing_deps.append(dep)
-                if missing_deps:
-                    return False
-            console.print(f"[green]✓ {package_name} 已安装[/green]")
-            return True
-        return False
+        return not missing_dependencies([lib_name], verbose)
     except Exception as e:
-        console.print(f"[yellow]检查 {lib_name} 安装状态时出错: {str(e)}[/yellow]")
+        if verbose:
+            console.print(f"[yellow]检查 {lib_name} 安装状态时出错: {str(e)}[/yellow]")
         return False
 
 def check_python_version():
@@ -333,31 +428,51 @@ def check_python_version():
             f"Python版本过低。需要Python {'.'.join(map(str, PYTHON_MIN_VERSION))} 或更高版本"
         )
 
-def setup_virtual_env():
-    """设置Python 3.9虚拟环境"""
-    venv_path = Path(VENV_DIR).absolute()
+def setup_virtual_env(venv_dir=None, base_python=None):
+    """设置Python 3.9虚拟环境；为其他解释器准备环境时传入venv_dir和base_python"""
+    venv_path = Path(venv_dir or VENV_DIR).absolute()
     if not venv_path.exists():
-        console.print("[yellow]正在创建Python 3.9虚拟环境...[/yellow]")
-        try:
-            version_check = subprocess.run(
-                [PYTHON39_PATH.split()[0], PYTHON39_PATH.split()[1] if len(PYTHON39_PATH.split()) > 1 else "--version"],
-                capture_output=True,
-                text=True
-            )
-            if version_check.returncode != 0:
-                raise RuntimeError("未找到Python 3.9，请确保已安装并添加到系统路径")
-            subprocess.run([PYTHON39_PATH.split()[0], "-m", "venv", str(venv_path)], check=True)
-            console.print("[green]✓ 成功创建Python 3.9虚拟环境[/green]")
-            python_path = get_venv_python_path(venv_path)
-            subprocess.run([python_path, "-m", "pip", "install", "--upgrade", "pip"], check=True)
-        except subprocess.CalledProcessError:
-            console.print("[red]创建虚拟环境失败，请确保已正确安装Python 3.9[/red]")
-            raise
-        except FileNotFoundError:
-            console.print("[red]未找到Python 3.9，请确保已安装并添加到系统路径[/red]")
-            raise
+        with install_lock_for(venv_dir):
+            if not venv_path.exists():
+                if base_python:
+                    _create_interpreter_env(venv_path, base_python)
+                else:
+                    _create_virtual_env(venv_path)
     return get_venv_python_path(venv_path)
 
+def _create_interpreter_env(venv_path, base_python):
+    """用指定的解释器创建虚拟环境（需持有该环境的安装锁）"""
+    console.print(f"[yellow]正在为 {base_python} 创建虚拟环境 {venv_path.name}...[/yellow]")
+    try:
+        subprocess.run([base_python, "-m", "venv", str(venv_path)], check=True)
+        console.print(f"[green]✓ 成功创建虚拟环境 {venv_path.name}[/green]")
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        console.print(f"[red]创建虚拟环境 {venv_path.name} 失败[/red]")
+        shutil.rmtree(venv_path, ignore_errors=True)
+        raise
+
+def _create_virtual_env(venv_path):
+    """创建虚拟环境（需持有安装锁，避免多个窗口同时创建）"""
+    console.print("[yellow]正在创建Python 3.9虚拟环境...[/yellow]")
+    try:
+        version_check = subprocess.run(
+            [PYTHON39_PATH.split()[0], PYTHON39_PATH.split()[1] if len(PYTHON39_PATH.split()) > 1 else "--version"],
+            capture_output=True,
+            text=True
+        )
+        if version_check.returncode != 0:
+            raise RuntimeError("未找到Python 3.9，请确保已安装并添加到系统路径")
+        subprocess.run([PYTHON39_PATH.split()[0], "-m", "venv", str(venv_path)], check=True)
+        console.print("[green]✓ 成功创建Python 3.9虚拟环境[/green]")
+        python_path = get_venv_python_path(venv_path)
+        subprocess.run([python_path, "-m", "pip", "install", "--upgrade", "pip"], check=True)
+    except subprocess.CalledProcessError:
+        console.print("[red]创建虚拟环境失败，请确保已正确安装Python 3.9[/red]")
+        raise
+    except FileNotFoundError:
+        console.print("[red]未找到Python 3.9，请确保已安装并添加到系统路径[/red]")
+        raise
+
 def get_venv_python_path(venv_path):
     """获取虚拟环境中的Python解释器路径"""
     if sys.platform == "win32":
@@ -481,10 +596,187 @@ def check_special_dependencies(required_libs):
     
     return needs_special_handling, special_instructions
 
-def install_dependencies(required_libs):
-    """安装依赖"""
+# 虚拟环境安装锁：进程内用可重入锁，进程之间用锁文件（fcntl/msvcrt），
+# 多个窗口、后台安装线程、服务模式同时安装时依次进行，不会同时修改site-packages
+INSTALL_LOCK_FILE = f".{VENV_DIR}.install.lock"
+INSTALL_HOLDER_FILE = f".{VENV_DIR}.installing.json"
+
+def _lock_file(fd, blocking):
+    """对文件加排他锁，非阻塞模式下被占用时返回False"""
+    if sys.platform == "win32":
+        import msvcrt
+        while True:
+            try:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(0.2)
+    import fcntl
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        return True
+    except BlockingIOError:
+        return False
+
+def _unlock_file(fd):
+    if sys.platform == "win32":
+        import msvcrt
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+class VenvInstallLock:
+    """修改虚拟环境（安装包、创建环境）时持有的锁；只读检查不需要加锁。
+    waited 表示本次获取锁前是否等待过其他安装，等待过则调用方应重新检查哪些包仍需安装"""
+    def __init__(self, path=INSTALL_LOCK_FILE, holder_path=INSTALL_HOLDER_FILE):
+        self.path = path
+        self.holder_path = holder_path
+        self.rlock = RLock()
+        self.depth = 0
+        self.fd = None
+        self.waited = False
+
+    def acquire(self, libs=None):
+        waited = not self.rlock.acquire(blocking=False)
+        if waited:
+            self.rlock.acquire()
+        self.depth += 1
+        if self.depth > 1:
+            return
+        try:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if not _lock_file(self.fd, blocking=False):
+                waited = True
+                holder = self.holder()
+                detail = f"：{', '.join(holder.get('libs') or [])}" if holder and holder.get("libs") else ""
+                console.print(f"[yellow]⏳ 其他窗口正在安装依赖{detail}，等待其完成...[/yellow]")
+                _lock_file(self.fd, blocking=True)
+        except BaseException:
+            self._close()
+            self.depth -= 1
+            self.rlock.release()
+            raise
+        self.waited = waited
+        self._write_holder(libs)
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            try:
+                os.remove(self.holder_path)
+            except OSError:
+                pass
+            self._close()
+        self.rlock.release()
+
+    def _close(self):
+        if self.fd is None:
+            return
+        try:
+            _unlock_file(self.fd)
+        except OSError:
+            pass
+        os.close(self.fd)
+        self.fd = None
+
+    def _write_holder(self, libs):
+        try:
+            with open(self.holder_path, "w", encoding="utf-8") as f:
+                json.dump({"pid": os.getpid(), "libs": sorted(libs or []), "since": time.time()}, f)
+        except OSError:
+            pass
+
+    def holder(self):
+        """当前持有锁的进程及其正在安装的包（读不到时返回None）"""
+        try:
+            with open(self.holder_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    @contextmanager
+    def hold(self, libs=None):
+        self.acquire(libs)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+install_lock = VenvInstallLock()
+install_locks = {}
+
+def install_lock_for(venv_dir=None):
+    """各虚拟环境各自的安装锁，默认环境使用install_lock"""
+    if not venv_dir or venv_dir == VENV_DIR:
+        return install_lock
+    if venv_dir not in install_locks:
+        install_locks[venv_dir] = VenvInstallLock(f".{venv_dir}.install.lock", f".{venv_dir}.installing.json")
+    return install_locks[venv_dir]
+
+def install_dependencies(required_libs, interactive=False):
+    """安装依赖；interactive为True时发现版本冲突会询问处理方式，否则自动放宽冲突的版本要求"""
+    if not required_libs:
+        return True
+    if service_client is not None and service_client.shared_venv:
+        # 瘦客户端与服务使用同一个虚拟环境时，由服务统一安装；否则脚本在本机运行，依赖也装在本机
+        try:
+            return service_client.install(required_libs)
+        except requests.RequestException as e:
+            console.print(f"[yellow]⚠️ 服务安装依赖失败（{type(e).__name__}），改为本机安装[/yellow]")
+    required_libs = precheck_pins(required_libs, interactive)
+    if required_libs is None:
+        return False
     if not required_libs:
         return True
+    with install_lock.hold(required_libs):
+        if install_lock.waited:
+            # 等待期间其他窗口可能已经装好了同样的包，只安装仍然缺少的
+            required_libs = missing_dependencies(required_libs, verbose=False)
+            if not required_libs:
+                console.print("[green]✓ 所需依赖已由其他窗口安装完成[/green]")
+                return True
+        return _install_dependencies(required_libs)
+
+# 常见大型包安装失败时的提示（前置依赖由元数据解析自动计算，这里只保留提示）
+INSTALL_FAILURE_HINTS = {
+    'manim': """[yellow]提示：manim安装失败可能是因为：[/yellow]
+1. 系统PATH中未正确添加MiKTeX和FFmpeg
+2. 需要重启终端以使环境变量生效
+3. 可以尝试手动执行: pip install manim""",
+    'torch': """[yellow]提示：torch安装失败可能是因为：[/yellow]
+1. 网络连接不稳定，建议使用国内镜像
+2. 如果需要GPU支持，请先安装CUDA
+3. 可以访问 https://pytorch.org/ 选择合适的版本""",
+    'tensorflow': """[yellow]提示：tensorflow安装失败可能是因为：[/yellow]
+1. 需要先安装Microsoft Visual C++ Redistributable
+2. 如果需要GPU支持，请先安装CUDA和cuDNN
+3. 可以尝试安装CPU版本：pip install tensorflow-cpu""",
+    'opencv-python': """[yellow]提示：opencv-python安装失败可能是因为：[/yellow]
+1. 需要安装Microsoft Visual C++ Redistributable
+2. 可以尝试安装headless版本：pip install opencv-python-headless""",
+    'pygame': """[yellow]提示：pygame安装失败可能是因为：[/yellow]
+1. 需要安装SDL库
+2. 需要安装Microsoft Visual C++ Redistributable
+3. 可以尝试：pip install pygame --pre""",
+    'kivy': """[yellow]提示：kivy安装失败可能是因为：[/yellow]
+1. 需要安装Microsoft Visual C++ Build Tools
+2. 需要先安装kivy的依赖：pip install kivy_deps.sdl2 kivy_deps.glew
+3. 建议使用官方预编译wheel：pip install kivy[base] kivy_examples""",
+}
+
+def _install_dependencies(required_libs):
     python_path = setup_virtual_env()
     
     failed_libs = []
@@ -498,420 +790,3387 @@ def install_dependencies(required_libs):
         
         for lib in required_libs:
             installed = False
-            lib_name = lib.split('==')[0] if '==' in lib else lib
-            
-            special_packages = {
-                'manim': {
-                    'deps': [
-                        'numpy', 'pillow', 'scipy', 'matplotlib', 'tqdm', 'colour', 'pycairo',
-                        'cloup', 'click', 'moderngl', 'moderngl_window', 'mapbox-earcut',
-                        'networkx', 'decorator'
-                    ],
-                    'message': """[yellow]提示：manim安装失败可能是因为：[/yellow]
-1. 系统PATH中未正确添加MiKTeX和FFmpeg
-2. 需要重启终端以使环境变量生效
-3. 可以尝试手动执行: pip install manim"""
-                },
-                'torch': {
-                    'deps': ['numpy', 'typing-extensions', 'filelock', 'sympy', 'networkx', 'jinja2'],
-                    'message': """[yellow]提示：torch安装失败可能是因为：[/yellow]
-1. 网络连接不稳定，建议使用国内镜像
-2. 如果需要GPU支持，请先安装CUDA
-3. 可以访问 https://pytorch.org/ 选择合适的版本"""
-                },
-                'tensorflow': {
-                    'deps': [
-                        'numpy', 'six', 'wheel', 'packaging', 'protobuf', 'keras',
-                        'h5py', 'wrapt', 'opt-einsum', 'astunparse', 'gast'
-                    ],
-                    'message': """[yellow]提示：tensorflow安装失败可能是因为：[/yellow]
-1. 需要先安装Microsoft Visual C++ Redistributable
-2. 如果需要GPU支持，请先安装CUDA和cuDNN
-3. 可以尝试安装CPU版本：pip install tensorflow-cpu"""
-                },
-                'opencv-python': {
-                    'deps': ['numpy', 'pillow'],
-                    'message': """[yellow]提示：opencv-python安装失败可能是因为：[/yellow]
-1. 需要安装Microsoft Visual C++ Redistributable
-2. 可以尝试安装headless版本：pip install opencv-python-headless"""
-                },
-                'pygame': {
-                    'deps': ['numpy'],
-                    'message': """[yellow]提示：pygame安装失败可能是因为：[/yellow]
-1. 需要安装SDL库
-2. 需要安装Microsoft Visual C++ Redistributable
-3. 可以尝试：pip install pygame --pre"""
-                },
-                'kivy': {
-                    'deps': ['docutils', 'pygments', 'kivy_deps.sdl2', 'kivy_deps.glew'],
-                    'message': """[yellow]提示：kivy安装失败可能是因为：[/yellow]
-1. 需要安装Microsoft Visual C++ Build Tools
-2. 需要先安装kivy的依赖：pip install kivy_deps.sdl2 kivy_deps.glew
-3. 建议使用官方预编译wheel：pip install kivy[base] kivy_examples"""
-                }
-            }
+            lib_name = split_requirement(lib)[0] or lib
             
-            if lib_name in special_packages:
+            for mirror in mirrors:
                 try:
-                    package_info = special_packages[lib_name]
-                    console.print(f"[yellow]正在安装{lib_name}的前置依赖...[/yellow]")
-                    for dep in package_info['deps']:
-                        try:
-                            process = subprocess.Popen(
-                                [python_path, "-m", "pip", "install", "--no-cache-dir", dep, "-i", mirrors[0]],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                text=True,
-                                bufsize=1,
-                                universal_newlines=True
-                            )
-                            while True:
-                                line = process.stdout.readline()
-                                if not line and process.poll() is not None:
-                                    break
-                                if line:
-                                    line = line.strip()
-                                    if any(keyword in line for keyword in [
-                                        "Successfully installed",
-                                        "Requirement already satisfied",
-                                        "ERROR:",
-                                        "WARNING:"
-                                    ]):
-                                        console.print(f"[yellow]{line}[/yellow]")
-                                    elif "%" in line and "Downloading" in line:
-                                        console.print(f"[blue]{line}[/blue]", end="\r")
-                            error_output = process.stderr.read()
-                            if error_output:
-                                console.print(f"[red]{error_output.strip()}[/red]")
-                            if process.returncode == 0:
-                                console.print(f"[green]✓ {dep}[/green]")
-                            else:
-                                console.print(f"[red]安装 {dep} 失败[/red]")
-                        except Exception as e:
-                            console.print(f"[red]安装 {dep} 时出错: {str(e)}[/red]")
-                    console.print(f"[yellow]正在安装{lib_name}主程序...[/yellow]")
-                    for mirror in mirrors:
+                    timeout = 300
+                    start_time = time.time()
+                    
+                    cmd = [
+                        python_path, 
+                        "-m", 
+                        "pip", 
+                        "install", 
+                        lib, 
+                        "--prefer-binary",
+                        "--disable-pip-version-check"
+                    ]
+                    if mirror:
+                        cmd.extend(["-i", mirror])
+                    
+                    process = subprocess.Popen(
+                        cmd,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        text=True,
+                        bufsize=1,
+                        universal_newlines=True
+                    )
+                    
+                    def read_output(pipe, is_error=False):
                         try:
-                            cmd = [
-                                python_path, 
-                                "-m", 
-                                "pip", 
-                                "install", 
-                                "--no-cache-dir", 
-                                lib
-                            ]
-                            if mirror:
-                                cmd.extend(["-i", mirror])
-                            
-                            process = subprocess.Popen(
-                                cmd,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                text=True,
-                                bufsize=1,
-                                universal_newlines=True
-                            )
-                            success = False
-                            while True:
-                                line = process.stdout.readline()
-                                if not line and process.poll() is not None:
-                                    break
+                            for line in pipe:
+                                if time.time() - start_time > timeout:
+                                    process.terminate()
+                                    console.print(f"[red]安装超时，已终止[/red]")
+                                    return
+                                line = line.strip()
                                 if line:
-                                    line = line.strip()
-                                    if "Successfully installed" in line:
-                                        success = True
                                     if any(keyword in line for keyword in [
                                         "Successfully installed",
-                                        "Requirement already satisfied",
                                         "ERROR:",
-                                        "WARNING:"
+                                        "WARNING:",
+                                        "Requirement already satisfied"
                                     ]):
-                                        console.print(f"[yellow]{line}[/yellow]")
+                                        console.print(f"[{'red' if is_error else 'yellow'}]{line}[/{'red' if is_error else 'yellow'}]")
                                     elif "%" in line and "Downloading" in line:
                                         console.print(f"[blue]{line}[/blue]", end="\r")
-                            error_output = process.stderr.read()
-                            if error_output:
-                                console.print(f"[red]{error_output.strip()}[/red]")
-                            if process.returncode == 0 and success:
-                                console.print(f"[green]✅ {lib_name}[/green]")
-                                installed = True
-                                break
-                            elif process.returncode == 0:
-                                continue
                         except Exception as e:
-                            console.print(f"[red]安装出错: {str(e)}[/red]")
-                            continue
-                except Exception as e:
-                    console.print(f"[red]安装 {lib_name} 时出错: {str(e)}[/red]")
-            else:
-                for mirror in mirrors:
+                            console.print(f"[red]输出读取错误: {str(e)}[/red]")
+
+                    stdout_thread = Thread(target=read_output, args=(process.stdout,))
+                    stderr_thread = Thread(target=read_output, args=(process.stderr, True))
+                    stdout_thread.daemon = True
+                    stderr_thread.daemon = True
+                    stdout_thread.start()
+                    stderr_thread.start()
+                    
                     try:
-                        timeout = 300
-                        start_time = time.time()
-                        
-                        cmd = [
-                            python_path, 
-                            "-m", 
-                            "pip", 
-                            "install", 
-                            lib, 
-                            "--prefer-binary",
-                            "--disable-pip-version-check"
-                        ]
-                        if mirror:
-                            cmd.extend(["-i", mirror])
-                        
-                        process = subprocess.Popen(
-                            cmd,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            text=True,
-                            bufsize=1,
-                            universal_newlines=True
-                        )
-                        
-                        def read_output(pipe, is_error=False):
-                            try:
-                                for line in pipe:
-                                    if time.time() - start_time > timeout:
-                                        process.terminate()
-                                        console.print(f"[red]安装超时，已终止[/red]")
-                                        return
-                                    line = line.strip()
-                                    if line:
-                                        if any(keyword in line for keyword in [
-                                            "Successfully installed",
-                                            "ERROR:",
-                                            "WARNING:",
-                                            "Requirement already satisfied"
-                                        ]):
-                                            console.print(f"[{'red' if is_error else 'yellow'}]{line}[/{'red' if is_error else 'yellow'}]")
-                                        elif "%" in line and "Downloading" in line:
-                                            console.print(f"[blue]{line}[/blue]", end="\r")
-                            except Exception as e:
-                                console.print(f"[red]输出读取错误: {str(e)}[/red]")
-
-                        stdout_thread = Thread(target=read_output, args=(process.stdout,))
-                        stderr_thread = Thread(target=read_output, args=(process.stderr, True))
-                        stdout_thread.daemon = True
-                        stderr_thread.daemon = True
-                        stdout_thread.start()
-                        stderr_thread.start()
-                        
-                        try:
-                            return_code = process.wait(timeout=timeout)
-                            stdout_thread.join(timeout=1)
-                            stderr_thread.join(timeout=1)
-                            process.stdout.close()
-                            process.stderr.close()
-                            if return_code == 0:
-                                console.print(f"[green]✅ {lib_name}[/green]")
-                                installed = True
-                                break
-                        except subprocess.TimeoutExpired:
-                            process.terminate()
-                            console.print(f"[red]安装超时，已终止[/red]")
-                            continue
-                    except Exception as e:
-                        console.print(f"[red]安装过程出错: {str(e)}[/red]")
+                        return_code = process.wait(timeout=timeout)
+                        stdout_thread.join(timeout=1)
+                        stderr_thread.join(timeout=1)
+                        process.stdout.close()
+                        process.stderr.close()
+                        if return_code == 0:
+                            console.print(f"[green]✅ {lib_name}[/green]")
+                            installed = True
+                            break
+                    except subprocess.TimeoutExpired:
+                        process.terminate()
+                        console.print(f"[red]安装超时，已终止[/red]")
                         continue
-                if not installed:
-                    failed_libs.append(lib)
-                    if lib_name in special_packages:
-                        console.print(special_packages[lib_name]['message'])
-                
-                progress.update(install_task, advance=1)
-    
+                except Exception as e:
+                    console.print(f"[red]安装过程出错: {str(e)}[/red]")
+                    continue
+            if not installed:
+                failed_libs.append(lib)
+                hint = INSTALL_FAILURE_HINTS.get(normalize_dist_name(lib_name))
+                if hint:
+                    console.print(hint)
+            
+            progress.update(install_task, advance=1)
+
+    mark_venv_changed()
     if failed_libs:
         console.print(f"\n[red]以下依赖安装失败: {', '.join(failed_libs)},若开启了VPN，请关闭VPN后重试[/red]")
         return False
                 
     return True
 
+def mark_venv_changed():
+    """记录虚拟环境中的包发生了变化（预热进程等缓存据此失效）"""
+    global venv_generation
+    venv_generation += 1
+
 def check_system_dependencies(code_content):
     """检查是否需要系统级依赖"""
     system_dep_pattern = r'#\s*是否需要提前安装除以上的其它依赖\s*[：:]\s*是'
     return bool(re.search(system_dep_pattern, code_content))
 
-def save_pending_dependencies(filename, required_libs):
-    """保存待安装的依赖信息"""
-    pending_file = "pending_dependencies.json"
-    data = {
-        "filename": filename,
-        "required_libs": list(required_libs),
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+# ----------------------------
+# 待安装依赖队列：持久化（追加写入的JSONL事件日志）+ 后台安装
+# ----------------------------
+class InstallQueue:
+    """持久化的待安装依赖队列，每条记录有状态、尝试次数和下次重试时间"""
+    STATUS_PENDING = "pending"
+    STATUS_INSTALLING = "installing"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_LABELS = {
+        "pending": "待安装",
+        "installing": "安装中",
+        "done": "已完成",
+        "failed": "已放弃",
     }
+
+    def __init__(self, path=PENDING_QUEUE_FILE):
+        self.path = path
+        self.lock = Lock()
+        self.jobs = {}
+        self.event_count = 0
+        self._load()
+
+    def _load(self):
+        """重放事件日志，恢复各任务的最新状态"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # 写入中途崩溃只会损坏最后一行，跳过即可
+                    continue
+                self.event_count += 1
+                if event.get("event") == "add":
+                    self.jobs[event["id"]] = {
+                        "id": event["id"],
+                        "filename": event["filename"],
+                        "libs": event["libs"],
+                        "timestamp": event.get("timestamp"),
+                        "hold_pid": event.get("hold_pid"),
+                        "status": self.STATUS_PENDING,
+                        "attempts": 0,
+                        "next_attempt": 0,
+                        "error": None,
+                    }
+                elif event.get("event") == "update" and event.get("id") in self.jobs:
+                    self.jobs[event["id"]].update(event.get("fields", {}))
+        # 上次运行中断时正在安装的任务，重新置为待安装
+        for job in self.jobs.values():
+            if job["status"] == self.STATUS_INSTALLING:
+                job["status"] = self.STATUS_PENDING
+
+    def _append(self, event):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.event_count += 1
+
+    def add(self, filename, libs, hold_until_restart=False):
+        """加入一个待安装任务；hold_until_restart为True时只在下次启动后处理（需先安装系统级依赖）"""
+        event = {
+            "event": "add",
+            "id": uuid.uuid4().hex[:8],
+            "filename": filename,
+            "libs": sorted(set(libs)),
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "hold_pid": os.getpid() if hold_until_restart else None,
+        }
+        with self.lock:
+            self._append(event)
+            self.jobs[event["id"]] = {
+                "id": event["id"],
+                "filename": filename,
+                "libs": event["libs"],
+                "timestamp": event["timestamp"],
+                "hold_pid": event["hold_pid"],
+                "status": self.STATUS_PENDING,
+                "attempts": 0,
+                "next_attempt": 0,
+                "error": None,
+            }
+        return event["id"]
+
+    def update(self, job_id, **fields):
+        with self.lock:
+            self._append({"event": "update", "id": job_id, "fields": fields})
+            self.jobs[job_id].update(fields)
+
+    def active_jobs(self):
+        return [job for job in self.jobs.values() if job["status"] in (self.STATUS_PENDING, self.STATUS_INSTALLING)]
+
+    def ready_jobs(self, now=None):
+        """到了重试时间、可以立即处理的任务"""
+        now = now or time.time()
+        return [
+            job for job in self.jobs.values()
+            if job["status"] == self.STATUS_PENDING
+            and job["next_attempt"] <= now
+            and job.get("hold_pid") != os.getpid()
+        ]
+
+    def compact(self):
+        """重写事件日志，只保留未完成的任务（每个任务压缩为两条事件）"""
+        with self.lock:
+            active = {job_id: job for job_id, job in self.jobs.items() if job["status"] != self.STATUS_DONE}
+            if not os.path.exists(self.path) or self.event_count <= 2 * len(active):
+                return
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for job in active.values():
+                    f.write(json.dumps({
+                        "event": "add", "id": job["id"], "filename": job["filename"], "libs": job["libs"],
+                        "timestamp": job["timestamp"], "hold_pid": None,
+                    }, ensure_ascii=False) + "\n")
+                    fields = {key: job[key] for key in ("status", "attempts", "next_attempt", "error")}
+                    f.write(json.dumps({"event": "update", "id": job["id"], "fields": fields}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self.jobs = active
+            self.event_count = 2 * len(active)
+            for job in self.jobs.values():
+                job["hold_pid"] = None
+
+    def migrate_legacy(self):
+        """导入旧版 pending_dependencies.json（只保存一条记录）"""
+        if not os.path.exists(LEGACY_PENDING_FILE):
+            return
+        try:
+            with open(LEGACY_PENDING_FILE, "r", encoding="utf-8") as f:
+                data = json.loads(f.read().strip() or "{}")
+            if data.get("filename") and data.get("required_libs"):
+                self.add(data["filename"], data["required_libs"])
+        except (OSError, json.JSONDecodeError):
+            console.print("[yellow]⚠️ 旧版依赖信息文件格式不正确，已忽略[/yellow]")
+        os.remove(LEGACY_PENDING_FILE)
+
+def pip_install_quiet(libs, python_path=None):
+    """不显示进度地安装一批依赖（后台使用），返回是否成功；python_path默认为Python 3.9虚拟环境"""
+    python_path = python_path or setup_virtual_env()
+    for mirror in ("https://mirrors.aliyun.com/pypi/simple/", "https://pypi.org/simple/"):
+        result = subprocess.run(
+            [python_path, "-m", "pip", "install", "--prefer-binary", "--disable-pip-version-check", "-i", mirror] + list(libs),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding="utf-8", errors="replace"
+        )
+        if result.returncode == 0:
+            return True, ""
+        error = (result.stderr.strip().splitlines() or ["未知错误"])[-1]
+    return False, error
+
+class InstallQueueWorker:
+    """后台线程：合并所有到期任务的依赖，一次安装，失败按指数退避重试"""
+    def __init__(self, queue):
+        self.queue = queue
+        self.thread = None
+        self.wakeup = Event()
+        # running与线程的退出判断共用一把锁：线程决定退出时不会漏掉start()前刚加入的任务
+        self.lock = Lock()
+        self.running = False
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                self.wakeup.set()
+                return
+            self.running = True
+            self.thread = Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _waiting_jobs(self):
+        return [job for job in self.queue.active_jobs() if job.get("hold_pid") != os.getpid()]
+
+    def _run(self):
+        try:
+            while True:
+                jobs = self.queue.ready_jobs()
+                if not jobs:
+                    waiting = self._waiting_jobs()
+                    if not waiting:
+                        with self.lock:
+                            # 加锁后再确认一次，期间通过start()加入的任务由本线程继续处理
+                            if not self._waiting_jobs():
+                                self.running = False
+                                return
+                        continue
+                    delay = max(1.0, min(job["next_attempt"] for job in waiting) - time.time())
+                    self.wakeup.wait(timeout=delay)
+                    self.wakeup.clear()
+                    continue
+                try:
+                    self._process(jobs)
+                except Exception as e:
+                    # 队列文件写入失败等：内存中的任务退回待安装，稍后再试，线程继续运行
+                    with self.queue.lock:
+                        for job in jobs:
+                            if job["status"] == InstallQueue.STATUS_INSTALLING:
+                                job["status"] = InstallQueue.STATUS_PENDING
+                    console.print(f"\n[yellow]⚠️ [后台] 处理待安装队列出错: {str(e)}[/yellow]")
+                    self.wakeup.wait(timeout=QUEUE_BACKOFF_BASE)
+                    self.wakeup.clear()
+        except BaseException:
+            # 线程异常退出时允许下次start()重新启动
+            with self.lock:
+                self.running = False
+            raise
+
+    def _process(self, jobs):
+        for job in jobs:
+            self.queue.update(job["id"], status=InstallQueue.STATUS_INSTALLING)
+        try:
+            error = self._install(jobs)
+            results = [(job, [lib for lib in job["libs"] if not is_installed(lib, verbose=False)]) for job in jobs]
+        except Exception as e:
+            # 锁文件读写、包元数据解析等出错时整批退回待安装，按失败处理，不让后台线程退出
+            error = f"{type(e).__name__}: {e}"
+            results = [(job, job["libs"]) for job in jobs]
+        for job, remaining in results:
+            name = os.path.basename(job["filename"])
+            if not remaining:
+                self.queue.update(job["id"], status=InstallQueue.STATUS_DONE, error=None)
+                console.print(f"\n[green]✓ [后台] {name} 的依赖已安装完成，可通过 ls 运行[/green]")
+                continue
+            attempts = job["attempts"] + 1
+            if attempts >= QUEUE_MAX_ATTEMPTS:
+                self.queue.update(job["id"], status=InstallQueue.STATUS_FAILED, attempts=attempts,
+                                  libs=remaining, error=error or "安装失败")
+                console.print(f"\n[red]❌ [后台] {name} 的依赖多次安装失败，已放弃: {', '.join(remaining)}[/red]")
+            else:
+                delay = min(QUEUE_BACKOFF_BASE * (2 ** (attempts - 1)), 3600)
+                self.queue.update(job["id"], status=InstallQueue.STATUS_PENDING, attempts=attempts,
+                                  next_attempt=time.time() + delay, libs=remaining, error=error or "安装失败")
+                console.print(f"\n[yellow]⚠️ [后台] {name} 的依赖安装失败，{delay:.0f}秒后重试: {', '.join(remaining)}[/yellow]")
+
+    def _install(self, jobs):
+        """合并多个任务中重复的依赖，只安装尚未安装的部分；返回pip的错误信息"""
+        merged = sorted({lib for job in jobs for lib in job["libs"]})
+        error = ""
+        with install_lock.hold(merged):
+            # 加锁后再检查，其他窗口刚装好的包不再重复安装
+            missing = missing_dependencies(merged, verbose=False)
+            if missing:
+                ok, error = pip_install_quiet(missing)
+                if not ok and len(missing) > 1:
+                    # 整批失败时逐个安装，找出具体失败的依赖
+                    for lib in missing:
+                        pip_install_quiet([lib])
+        if missing:
+            mark_venv_changed()
+        return error
+
+install_queue = None
+install_queue_worker = None
+
+def get_install_queue():
+    """懒加载待安装队列与后台安装线程"""
+    global install_queue, install_queue_worker
+    if install_queue is None:
+        install_queue = InstallQueue()
+        install_queue_worker = InstallQueueWorker(install_queue)
+    return install_queue
+
+def save_pending_dependencies(filename, required_libs, hold_until_restart=False):
+    """把待安装的依赖加入队列并交给后台安装"""
     try:
-        with open(pending_file, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        queue = get_install_queue()
+        queue.add(filename, required_libs, hold_until_restart=hold_until_restart)
+        if hold_until_restart:
+            console.print("[yellow]依赖已加入待安装队列，将在重新运行本程序后自动安装（输入 queue 查看）[/yellow]")
+        else:
+            install_queue_worker.start()
+            console.print("[yellow]依赖已加入待安装队列，将在后台自动重试（输入 queue 查看）[/yellow]")
     except Exception as e:
         console.print(f"[yellow]⚠️ 保存待安装依赖信息失败: {str(e)}[/yellow]")
 
 def check_pending_dependencies():
-    """检查是否有待安装的依赖"""
-    pending_file = "pending_dependencies.json"
-    if not os.path.exists(pending_file):
-        return
+    """启动时检查待安装队列，有任务则在后台开始安装"""
     try:
-        with open(pending_file, "r", encoding="utf-8") as f:
-            content = f.read().strip()
-        if not content:
-            os.remove(pending_file)
+        queue = get_install_queue()
+        queue.migrate_legacy()
+        queue.compact()
+        active = queue.active_jobs()
+        if not active:
             return
-        data = json.loads(content)
-        filename = data.get("filename")
-        required_libs = data.get("required_libs", [])
-        timestamp = data.get("timestamp")
-        if not filename or not required_libs:
-            os.remove(pending_file)
-            return
-        console.print(f"\n[yellow]检测到上次有未完成的依赖安装[/yellow]")
-        console.print(f"[blue]文件: {filename}[/blue]")
-        console.print(f"[blue]时间: {timestamp}[/blue]")
-        console.print("[blue]待安装依赖:[/blue]")
-        for lib in required_libs:
-            console.print(f"- {lib}")
-        while True:
-            console.print("\n[yellow]是否现在安装这些依赖？(y/n)[/yellow]")
-            choice = input().strip().lower()
-            if choice in ('y', 'yes'):
-                original_libs = required_libs.copy()
-                if install_dependencies(required_libs):
-                    console.print("[green]✅ 所有依赖安装成功[/green]")
-                    os.remove(pending_file)
-                    console.print("\n[yellow]是否立即运行该代码？(y/n)[/yellow]")
-                    run_choice = input().strip().lower()
-                    if run_choice in ('y', 'yes'):
-                        with open(filename, "r", encoding="utf-8") as f:
-                            code_content = f.read()
-                        save_and_execute_code((code_content, os.path.basename(filename)), True)
-                else:
-                    remaining_libs = [lib for lib in original_libs if not is_installed(lib)]
-                    if len(remaining_libs) < len(original_libs):
-                        data["required_libs"] = remaining_libs
-                        with open(pending_file, "w", encoding="utf-8") as f:
-                            json.dump(data, f, ensure_ascii=False, indent=2)
-                        console.print(f"[yellow]已更新待安装依赖列表，剩余 {len(remaining_libs)} 个依赖需要安装[/yellow]")
-                    console.print("[red]❌ 部分依赖安装失败[/red]")
-                break
-            elif choice in ('n', 'no'):
-                console.print("[yellow]已取消安装[/yellow]")
-                break
-            else:
-                console.print("[red]无效的输入，请输入 y 或 n[/red]")
-    except json.JSONDecodeError:
-        console.print("[yellow]⚠️ 依赖信息文件格式不正确，正在重置...[/yellow]")
-        os.remove(pending_file)
+        lib_count = len({lib for job in active for lib in job["libs"]})
+        console.print(f"\n[yellow]检测到 {len(active)} 个未完成的依赖安装任务（共 {lib_count} 个依赖），正在后台安装，输入 queue 查看进度[/yellow]")
+        install_queue_worker.start()
     except Exception as e:
         console.print(f"[red]❌ 检查待安装依赖时出错: {str(e)}[/red]")
-        if os.path.exists(pending_file):
-            os.remove(pending_file)
 
-def save_and_execute_code(code_content, execute=True):
-    """保存并执行代码"""
-    try:
-        code_dir = "代码工具库"
-        if not os.path.exists(code_dir):
-            os.makedirs(code_dir)
+# ----------------------------
+# 程序启动：新窗口运行 / 托管运行
+# ----------------------------
+def launcher_env(python_path=None):
+    """启动脚本时使用的环境变量：带上启动器标记，脚本无需再检查或切换解释器"""
+    env = os.environ.copy()
+    env[LAUNCHER_ENV_MARKER] = "1"
+    if python_path:
+        env["AUTOCODE_PYTHON"] = python_path
+    return env
 
-        if isinstance(code_content, tuple):
-            code_content, suggested_filename = code_content
+def launch_in_terminal(python_path, filename):
+    """在新的终端窗口中启动程序（不等待结束）"""
+    env = launcher_env(python_path)
+    # fastest策略下可能不是默认的3.9环境，显示实际使用的解释器
+    console.print(f"\n[yellow]🚀 正在新窗口中启动程序({os.path.relpath(python_path)})...[/yellow]")
+    try:
+        if sys.platform == "win32":
+            if not os.path.exists(python_path):
+                console.print(f"\n[red]⚠️ 虚拟环境Python解释器不存在: {python_path}[/red]")
+                return
+            rel_python = os.path.relpath(python_path)
+            rel_filename = os.path.relpath(filename)
+            cmd = f'start cmd /c "{rel_python} {rel_filename} & pause"'
+            subprocess.Popen(cmd, shell=True, env=env)
         else:
-            suggested_filename = None
+            if sys.platform == "darwin":
+                # Terminal通过LaunchServices启动，不继承env，启动器标记需写进命令本身
+                import shlex
+                command = "cd {} && {}=1 AUTOCODE_PYTHON={} {} {}".format(
+                    shlex.quote(os.getcwd()), LAUNCHER_ENV_MARKER, shlex.quote(os.path.abspath(python_path)),
+                    shlex.quote(os.path.abspath(python_path)), shlex.quote(os.path.abspath(filename)))
+                script = command.replace("\\", "\\\\").replace('"', '\\"')
+                subprocess.Popen(['osascript', '-e', f'tell application "Terminal" to do script "{script}"',
+                                  '-e', 'tell application "Terminal" to activate'], env=env)
+            else:
+                terminals = ['gnome-terminal', 'xterm', 'konsole']
+                for term in terminals:
+                    try:
+                        subprocess.Popen([term, '--', python_path, filename], env=env)
+                        break
+                    except FileNotFoundError:
+                        continue
+                else:
+                    subprocess.Popen([python_path, filename], env=env)
+    except Exception as e:
+        console.print(f"\n[red]⚠️ 启动程序失败: {str(e)}[/red]")
 
-        if suggested_filename:
-            if not suggested_filename.endswith('.py'):
-                suggested_filename += '.py'
-            filename = os.path.join(code_dir, suggested_filename)
-        else:
-            filename = os.path.join(code_dir, f"generated_{datetime.now().strftime('%Y%m%d%H%M%S')}.py")
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write(code_content)
-        abs_path = os.path.abspath(filename)
-        console.print(f"\n[blue]💾 代码保存路径: [cyan]{abs_path}[/cyan][/blue]")
+# 非Linux的POSIX系统上，用这个小包装先设置资源限制再exec脚本（避免在多线程进程中使用preexec_fn）
+# python -c <源码> CPU秒数 地址空间字节 文件数 python路径 脚本
+RUN_LIMITS_WRAPPER_SOURCE = r'''
+import os, resource, sys
+for name, value in zip(("RLIMIT_CPU", "RLIMIT_AS", "RLIMIT_NOFILE"), sys.argv[1:4]):
+    value = int(value)
+    if value <= 0 or not hasattr(resource, name):
+        continue
+    limit = getattr(resource, name)
+    try:
+        soft, hard = resource.getrlimit(limit)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(limit, (value, hard))
+    except (ValueError, OSError):
+        pass
+os.execv(sys.argv[4], sys.argv[4:])
+'''
 
-        needs_system_deps = check_system_dependencies(code_content)
-        if needs_system_deps:
-            console.print("\n[yellow]⚠️ 检测到此代码需要额外的系统级依赖[/yellow]")
-            console.print("[yellow]请按以下步骤操作：[/yellow]")
-            console.print("1. 先安装代码注释中提到的系统级依赖")
-            console.print("2. 关闭当前终端")
-            console.print("3. 重新运行本程序")
-            required_libs = [
-                lib for lib in extract_imports(code_content)
-                if not is_installed(lib)
-            ]
-            if required_libs:
-                save_pending_dependencies(filename, required_libs)
-            return True
+def run_limit_values():
+    """托管运行的资源限制 [(名称, 值)]，值<=0表示不限"""
+    return [
+        ("RLIMIT_CPU", RUN_CPU_LIMIT),
+        ("RLIMIT_AS", RUN_MEMORY_LIMIT_MB * 1024 * 1024),
+        ("RLIMIT_NOFILE", RUN_NOFILE_LIMIT),
+    ]
 
-        required_libs = [
-            lib for lib in extract_imports(code_content)
-            if not is_installed(lib)
-        ]
-        if required_libs and not install_dependencies(required_libs):
-            console.print("\n[red]⚠️ 部分依赖安装失败,代码可能无法正常运行[/red]")
-            save_pending_dependencies(filename, required_libs)
-            return True
+def _apply_run_limits(pid):
+    """Linux下在子进程启动后立即用prlimit设置资源限制"""
+    import resource
+    for name, value in run_limit_values():
+        if value <= 0:
+            continue
+        limit = getattr(resource, name)
+        try:
+            soft, hard = resource.prlimit(pid, limit)
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            resource.prlimit(pid, limit, (value, hard))
+        except (ValueError, OSError):
+            # 进程已退出或不支持该限制，忽略即可
+            pass
 
-        if execute:
-            python_path = setup_virtual_env()
-            console.print("\n[yellow]🚀 正在新窗口中启动程序(Python 3.9)...[/yellow]")
+class ManagedRun:
+    """托管运行的子进程：资源限制、输出环形缓冲、非阻塞回收与运行统计"""
+    def __init__(self, python_path, filename, timeout=RUN_TIMEOUT, echo=True, interactive=True, launcher_marker=True, cwd=None):
+        self.python_path = python_path
+        self.cwd = cwd
+        self.launcher_marker = launcher_marker
+        self.filename = filename
+        self.timeout = timeout
+        self.echo = echo
+        self.interactive = interactive
+        self.output = deque(maxlen=RUN_OUTPUT_BUFFER_LINES)
+        self.output_lock = Lock()
+        self.poll_lock = Lock()
+        self.proc = None
+        self.job_handle = None
+        self.readers = []
+        self.start_time = None
+        self.first_output_time = None
+        self.end_time = None
+        self.returncode = None
+        self.peak_rss_kb = None
+        self.timed_out = False
+        self.killed = False
+
+    @property
+    def pid(self):
+        return self.proc.pid if self.proc else None
+
+    def _child_env(self):
+        env = launcher_env(self.python_path) if self.launcher_marker else os.environ.copy()
+        env["PYTHONUNBUFFERED"] = "1"
+        env["PYTHONIOENCODING"] = "utf-8"
+        return env
+
+    def start(self):
+        """启动子进程并开始收集输出"""
+        popen_kwargs = {
+            "stdout": subprocess.PIPE,
+            "stderr": subprocess.PIPE,
+            "stdin": None if self.interactive else subprocess.DEVNULL,
+            "env": self._child_env(),
+            "cwd": self.cwd,
+        }
+        command = [self.python_path, self.filename]
+        if os.name == "posix":
+            popen_kwargs["start_new_session"] = not self.interactive
+            if sys.platform != "linux" and any(value > 0 for _, value in run_limit_values()):
+                command = [self.python_path, "-c", RUN_LIMITS_WRAPPER_SOURCE] + [
+                    str(value) for _, value in run_limit_values()] + command
+        self.start_time = time.time()
+        self.proc = subprocess.Popen(command, **popen_kwargs)
+        if sys.platform == "linux":
+            _apply_run_limits(self.proc.pid)
+        if sys.platform == "win32":
+            self.job_handle = self._create_windows_job()
+        self._start_readers(self.proc.stdout, self.proc.stderr)
+        return self
+
+    def _start_readers(self, stdout, stderr):
+        for pipe, is_error in ((stdout, False), (stderr, True)):
+            reader = Thread(target=self._read_output, args=(pipe, is_error), daemon=True)
+            reader.start()
+            self.readers.append(reader)
+
+    def _create_windows_job(self):
+        """Windows下通过作业对象限制内存与CPU时间（依赖pywin32）"""
+        try:
+            import win32api
+            import win32con
+            import win32job
+        except ImportError:
+            console.print("[yellow]⚠️ 未安装pywin32，托管运行将不限制资源[/yellow]")
+            return None
+        try:
+            job = win32job.CreateJobObject(None, "")
+            info = win32job.QueryInformationJobObject(job, win32job.JobObjectExtendedLimitInformation)
+            flags = win32job.JOB_OBJECT_LIMIT_KILL_ON_JOB_CLOSE
+            if RUN_MEMORY_LIMIT_MB > 0:
+                flags |= win32job.JOB_OBJECT_LIMIT_PROCESS_MEMORY
+                info['ProcessMemoryLimit'] = RUN_MEMORY_LIMIT_MB * 1024 * 1024
+            if RUN_CPU_LIMIT > 0:
+                flags |= win32job.JOB_OBJECT_LIMIT_PROCESS_TIME
+                info['BasicLimitInformation']['PerProcessUserTimeLimit'] = RUN_CPU_LIMIT * 10000000
+            info['BasicLimitInformation']['LimitFlags'] = flags
+            win32job.SetInformationJobObject(job, win32job.JobObjectExtendedLimitInformation, info)
+            handle = win32api.OpenProcess(win32con.PROCESS_ALL_ACCESS, False, self.proc.pid)
+            win32job.AssignProcessToJobObject(job, handle)
+            return job
+        except Exception as e:
+            console.print(f"[yellow]⚠️ 设置资源限制失败: {str(e)}[/yellow]")
+            return None
+
+    def _read_output(self, pipe, is_error):
+        """读取子进程输出，写入环形缓冲并按需回显。
+        按块读取而不是按行读取：input("请输入：")这类不换行的提示也能立即显示"""
+        style = "red" if is_error else None
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        pending = ""  # 尚未换行的当前行
+        echoed = 0  # 当前行中已经回显的字符数
+        try:
+            fd = pipe.fileno()
+            while True:
+                data = os.read(fd, 4096)
+                text = decoder.decode(data, final=not data)
+                if data and self.first_output_time is None:
+                    self.first_output_time = time.time()
+                pending += text
+                while "\n" in pending:
+                    line, pending = pending.split("\n", 1)
+                    self._append_line(is_error, line.rstrip("\r"), echoed, style)
+                    echoed = 0
+                if not data:
+                    break
+                if pending and self.echo and len(pending) > echoed:
+                    console.print(pending[echoed:], style=style, markup=False, highlight=False, end="")
+                    echoed = len(pending)
+            if pending:
+                self._append_line(is_error, pending.rstrip("\r"), echoed, style)
+        except (OSError, ValueError):
+            pass
+        finally:
+            pipe.close()
+
+    def _append_line(self, is_error, line, echoed, style):
+        """一行输出完整后写入环形缓冲，并回显该行中尚未显示的部分"""
+        with self.output_lock:
+            self.output.append((is_error, line))
+        if self.echo:
+            console.print(line[echoed:], style=style, markup=False, highlight=False)
+
+    def poll(self):
+        """非阻塞地检查进程状态，超时则终止；返回退出码或None"""
+        with self.poll_lock:
+            return self._poll()
+
+    def _poll(self):
+        if self.returncode is not None:
+            return self.returncode
+        if self.timeout and time.time() - self.start_time > self.timeout and not self.timed_out:
+            self.timed_out = True
+            self.kill()
+        if os.name == "posix":
             try:
-                if sys.platform == "win32":
-                    venv_python = os.path.join("venv3.9", "Scripts", "python.exe")
-                    if not os.path.exists(venv_python):
-                        console.print(f"\n[red]⚠️ 虚拟环境Python解释器不存在: {venv_python}[/red]")
-                        return True
-                    rel_python = os.path.relpath(venv_python)
-                    rel_filename = os.path.relpath(filename)
-                    cmd = f'start cmd /c "{rel_python} {rel_filename} & pause"'
-                    subprocess.Popen(cmd, shell=True)
-                else:
-                    if sys.platform == "darwin":
-                        subprocess.Popen(['open', '-a', 'Terminal', '--', python_path, filename])
-                    else:
-                        terminals = ['gnome-terminal', 'xterm', 'konsole']
-                        for term in terminals:
-                            try:
-                                subprocess.Popen([term, '--', python_path, filename])
-                                break
-                            except FileNotFoundError:
-                                continue
-                        else:
-                            subprocess.Popen([python_path, filename])
-            except Exception as e:
-                console.print(f"\n[red]⚠️ 启动程序失败: {str(e)}[/red]")
-            return True
+                pid, status, rusage = os.wait4(self.proc.pid, os.WNOHANG)
+            except ChildProcessError:
+                pid, status, rusage = self.proc.pid, 0, None
+            if pid == 0:
+                return None
+            returncode = os.waitstatus_to_exitcode(status) if rusage else self.proc.returncode
+            self.proc.returncode = returncode
+            if rusage:
+                # Linux下ru_maxrss单位为KB，macOS下为字节
+                self.peak_rss_kb = rusage.ru_maxrss // 1024 if sys.platform == "darwin" else rusage.ru_maxrss
         else:
-            return True
-    except Exception as e:
-        console.print(f"\n[red]⚠️ 异常: {str(e)}[/red]")
-        return False
+            returncode = self.proc.poll()
+            if returncode is None:
+                return None
+            self.peak_rss_kb = self._windows_peak_memory_kb()
+        self.end_time = time.time()
+        for reader in self.readers:
+            reader.join(timeout=1)
+        self.returncode = returncode if returncode is not None else -1
+        return self.returncode
 
-def chat_stream(messages, printer, model="deepseek-chat"):
-    """流式对话处理"""
+    def _windows_peak_memory_kb(self):
+        if not self.job_handle:
+            return None
+        try:
+            import win32job
+            info = win32job.QueryInformationJobObject(self.job_handle, win32job.JobObjectExtendedLimitInformation)
+            return info['PeakProcessMemoryUsed'] // 1024
+        except Exception:
+            return None
+
+    def wait(self, timeout=None):
+        """等待进程结束；timeout为None时一直等待"""
+        deadline = time.time() + timeout if timeout is not None else None
+        while self.poll() is None:
+            if deadline is not None and time.time() > deadline:
+                return None
+            time.sleep(0.05)
+        return self.returncode
+
+    def kill(self):
+        """终止进程（POSIX下连同其进程组）"""
+        if not self.proc or self.returncode is not None:
+            return
+        self.killed = True
+        try:
+            if os.name == "posix" and not self.interactive:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            else:
+                self.proc.kill()
+        except (ProcessLookupError, PermissionError, OSError):
+            pass
+
+    def tail(self, lines=20, errors_only=False):
+        """返回缓冲区中最后若干行输出"""
+        with self.output_lock:
+            items = [line for is_error, line in self.output if is_error or not errors_only]
+        return items[-lines:]
+
+    def traceback_text(self):
+        """提取最后一段Python异常回溯"""
+        stderr_lines = self.tail(len(self.output), errors_only=True)
+        for i in range(len(stderr_lines) - 1, -1, -1):
+            if stderr_lines[i].startswith("Traceback (most recent call last)"):
+                return "\n".join(stderr_lines[i:])
+        return ""
+
+    def duration(self):
+        end = self.end_time or time.time()
+        return end - self.start_time if self.start_time else 0.0
+
+    def result(self):
+        """运行结果摘要（写入运行历史）"""
+        first_output = self.first_output_time - self.start_time if self.first_output_time else None
+        try:
+            file_path = os.path.relpath(self.filename)
+        except ValueError:
+            # Windows下临时目录与当前目录不在同一个盘
+            file_path = os.path.abspath(self.filename)
+        return {
+            "file": file_path,
+            "mode": "managed",
+            "launcher": "cold",
+            "exit_code": self.returncode,
+            "duration": round(self.duration(), 3),
+            "first_output": round(first_output, 3) if first_output is not None else None,
+            "peak_rss_kb": self.peak_rss_kb,
+            "timed_out": self.timed_out,
+            "killed": self.killed,
+            "traceback": self.traceback_text(),
+            "stderr_tail": self.tail(20, errors_only=True),
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+def record_run_history(entry):
+    """追加一条运行记录"""
+    try:
+        with open(RUN_HISTORY_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    except Exception as e:
+        console.print(f"[yellow]⚠️ 写入运行历史失败: {str(e)}[/yellow]")
+
+def load_run_history(limit=None):
+    """读取运行历史（跳过损坏的行）"""
+    if not os.path.exists(RUN_HISTORY_FILE):
+        return []
+    entries = []
+    with open(RUN_HISTORY_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return entries[-limit:] if limit else entries
+
+# ----------------------------
+# 预热启动器（forkserver）：预先导入常用模块，fork运行脚本
+# ----------------------------
+WARM_LAUNCHER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "warm_launcher.py")
+
+def choose_warm_modules(limit=WARM_MODULE_LIMIT):
+    """根据运行历史选出最常用的第三方模块（.env中WARM_MODULES可直接指定）"""
+    if WARM_MODULES:
+        return WARM_MODULES
+    from collections import Counter
+    counts = Counter()
+    file_modules = {}
+    for entry in load_run_history():
+        path = entry.get("file")
+        if path not in file_modules:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    file_modules[path] = extract_import_names(f.read())
+            except (OSError, TypeError):
+                file_modules[path] = set()
+        counts.update(file_modules[path])
+    return [name for name, _ in counts.most_common(limit)]
+
+class WarmLauncher:
+    """管理虚拟环境中常驻的预热启动进程"""
+    def __init__(self):
+        self.proc = None
+        self.socket_path = None
+        self.modules = []
+        self.generation = None
+        self.lock = Lock()
+
+    @staticmethod
+    def available():
+        import socket
+        return os.name == "posix" and hasattr(socket, "send_fds") and os.path.exists(WARM_LAUNCHER_SCRIPT)
+
+    def running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def ensure_started(self):
+        """启动（或在依赖变化后重启）预热进程，返回是否可用"""
+        import tempfile
+        with self.lock:
+            if self.running() and self.generation == venv_generation:
+                return True
+            self._stop()
+            modules = choose_warm_modules()
+            # 能连上这个套接字就能以当前用户身份运行任意代码，放在只有当前用户可访问的私有目录（0700）中
+            self.socket_path = os.path.join(tempfile.mkdtemp(prefix="autocode_warm_"), "launcher.sock")
+            self.proc = subprocess.Popen(
+                [setup_virtual_env(), WARM_LAUNCHER_SCRIPT, self.socket_path] + modules,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                stdin=subprocess.DEVNULL,
+                text=True,
+                encoding="utf-8",
+            )
+            ready = {}
+            reader = Thread(target=lambda: ready.update(json.loads(self.proc.stdout.readline() or "{}")), daemon=True)
+            reader.start()
+            reader.join(timeout=120)
+            if not ready.get("ready"):
+                self._stop()
+                return False
+            self.modules = ready.get("modules", [])
+            self.generation = venv_generation
+            return True
+
+    def launch(self, argv, cwd, env, fds, limits):
+        """请求预热进程fork运行脚本，返回 (连接, 读取器, 子进程pid)"""
+        import socket
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.socket_path)
+            request = {"argv": argv, "cwd": cwd, "env": env, "limits": limits}
+            socket.send_fds(conn, [json.dumps(request).encode("utf-8")], fds)
+            reader = conn.makefile("r", encoding="utf-8")
+            reply = json.loads(reader.readline() or "{}")
+        except (OSError, ValueError):
+            conn.close()
+            raise
+        if "pid" not in reply:
+            conn.close()
+            raise RuntimeError("预热进程未返回子进程信息")
+        return conn, reader, reply["pid"]
+
+    def _stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=3)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self.proc = None
+        if self.socket_path:
+            shutil.rmtree(os.path.dirname(self.socket_path), ignore_errors=True)
+            self.socket_path = None
+
+    def stop(self):
+        with self.lock:
+            self._stop()
+
+warm_launcher = WarmLauncher()
+
+class WarmManagedRun(ManagedRun):
+    """由预热进程fork出来的托管运行，接口与ManagedRun一致"""
+    def __init__(self, launcher, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.launcher = launcher
+        self.conn = None
+        self.child_pid = None
+        self.exit_info = None
+        self.exit_event = Event()
+
+    @property
+    def pid(self):
+        return self.child_pid
+
+    def start(self):
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        stdin_fd = os.dup(0) if self.interactive else os.open(os.devnull, os.O_RDONLY)
+        limits = dict(run_limit_values())
+        self.start_time = time.time()
+        try:
+            self.conn, reader, self.child_pid = self.launcher.launch(
+                [os.path.abspath(self.filename)], self.cwd or os.getcwd(), self._child_env(), [stdin_fd, out_w, err_w], limits
+            )
+        except Exception:
+            os.close(out_r)
+            os.close(err_r)
+            raise
+        finally:
+            for fd in (stdin_fd, out_w, err_w):
+                os.close(fd)
+        self._start_readers(os.fdopen(out_r, "rb"), os.fdopen(err_r, "rb"))
+        Thread(target=self._wait_exit, args=(reader,), daemon=True).start()
+        return self
+
+    def _wait_exit(self, reader):
+        try:
+            self.exit_info = json.loads(reader.readline() or "{}")
+        except (OSError, ValueError):
+            self.exit_info = {}
+        finally:
+            self.conn.close()
+            self.exit_event.set()
+
+    def _poll(self):
+        if self.returncode is not None:
+            return self.returncode
+        if self.timeout and time.time() - self.start_time > self.timeout and not self.timed_out:
+            self.timed_out = True
+            self.kill()
+        if not self.exit_event.is_set():
+            return None
+        self.end_time = time.time()
+        maxrss = self.exit_info.get("maxrss")
+        if maxrss is not None:
+            self.peak_rss_kb = maxrss // 1024 if sys.platform == "darwin" else maxrss
+        for reader in self.readers:
+            reader.join(timeout=1)
+        self.returncode = self.exit_info.get("exit_code", -1)
+        return self.returncode
+
+    def kill(self):
+        if not self.child_pid or self.returncode is not None:
+            return
+        self.killed = True
+        try:
+            # 子进程在预热进程中调用了setsid，整个进程组一起终止
+            os.killpg(self.child_pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError, OSError):
+            pass
+
+    def result(self):
+        result = super().result()
+        result["launcher"] = "warm"
+        return result
+
+def create_managed_run(python_path, filename, **kwargs):
+    """创建托管运行：启用预热启动时优先fork运行，失败则回退到冷启动"""
+    # 预热进程运行在Python 3.9虚拟环境中，选用其他解释器时只能冷启动
+    if warm_launch_enabled and warm_launcher.available() and python_path == setup_virtual_env():
+        try:
+            if warm_launcher.ensure_started():
+                return WarmManagedRun(warm_launcher, python_path, filename, **kwargs).start()
+        except Exception as e:
+            console.print(f"[yellow]⚠️ 预热启动失败，改为普通启动: {str(e)}[/yellow]")
+    return ManagedRun(python_path, filename, **kwargs).start()
+
+def benchmark_launch(filename, repeat=3):
+    """对比不同启动方式从启动到首次输出的耗时：无启动标记 / 冷启动 / 预热启动"""
+    python_path = setup_virtual_env()
+    # 无启动标记时用基础解释器启动，复现脚本内环境检查触发的二次启动
+    base_python = getattr(sys, "_base_executable", None) or sys.executable
+    variants = [("unmarked", "无启动标记"), ("cold", "冷启动")]
+    if warm_launcher.available() and warm_launcher.ensure_started():
+        variants.append(("warm", "预热启动"))
+    else:
+        console.print("[yellow]⚠️ 预热启动器不可用（仅支持Linux/macOS），只测试冷启动[/yellow]")
+    console.print(f"\n[yellow]正在测试启动耗时（各运行 {repeat} 次）...[/yellow]")
+    if len(variants) == 3:
+        console.print(f"[blue]预导入模块: {', '.join(warm_launcher.modules) or '无'}[/blue]")
+    timings = {kind: [] for kind, _ in variants}
+    for _ in range(repeat):
+        for kind, _ in variants:
+            if kind == "warm":
+                run = WarmManagedRun(warm_launcher, python_path, filename, echo=False, interactive=False)
+            elif kind == "unmarked":
+                run = ManagedRun(base_python, filename, echo=False, interactive=False, launcher_marker=False)
+            else:
+                run = ManagedRun(python_path, filename, echo=False, interactive=False)
+            run.start()
+            run.wait()
+            result = run.result()
+            first = result["first_output"] if result["first_output"] is not None else result["duration"]
+            timings[kind].append((first, result["duration"], result["exit_code"]))
+    console.print(f"\n[cyan]{'':10}{'首次输出(中位数)':>16}{'总耗时(中位数)':>16}{'退出码':>8}[/cyan]")
+    summary = {}
+    for kind, label in variants:
+        firsts = sorted(t[0] for t in timings[kind])
+        totals = sorted(t[1] for t in timings[kind])
+        summary[kind] = {"first_output": firsts[len(firsts) // 2], "duration": totals[len(totals) // 2]}
+        console.print(f"{label:10}{summary[kind]['first_output']:>15.3f}s{summary[kind]['duration']:>15.3f}s{timings[kind][-1][2]:>8}")
+    saved = summary["unmarked"]["first_output"] - summary["cold"]["first_output"]
+    console.print(f"[green]启动标记节省 {saved * 1000:.0f} ms（跳过脚本内的解释器检查与二次启动）[/green]")
+    if "warm" in summary and summary["warm"]["first_output"] > 0:
+        console.print(f"[green]预热启动首次输出提速 {summary['cold']['first_output'] / summary['warm']['first_output']:.1f} 倍[/green]")
+    return summary
+
+def print_run_result(result):
+    """显示托管运行的结果摘要"""
+    if result["timed_out"]:
+        status = f"[red]超时终止（{RUN_TIMEOUT:.0f}秒）[/red]"
+    elif result["exit_code"] == 0:
+        status = "[green]✓ 正常结束[/green]"
+    else:
+        status = f"[red]❌ 退出码 {result['exit_code']}[/red]"
+    peak = f"{result['peak_rss_kb'] / 1024:.1f} MB" if result["peak_rss_kb"] else "未知"
+    console.print(f"\n[blue]运行结果:[/blue] {status}  [blue]耗时:[/blue] {result['duration']:.2f}s  [blue]峰值内存:[/blue] {peak}")
+    if result["traceback"]:
+        console.print("[yellow]异常回溯已记录到运行历史，可直接询问AI错误原因[/yellow]")
+
+def run_managed(python_path, filename):
+    """在当前会话中托管运行程序，等待结束并记录运行信息"""
+    console.print(f"\n[yellow]🚀 正在托管运行程序(超时 {RUN_TIMEOUT:.0f}秒)...[/yellow]")
+    try:
+        run = create_managed_run(python_path, filename)
+        try:
+            run.wait()
+        except KeyboardInterrupt:
+            console.print("\n[yellow]🛑 已中断，正在终止程序...[/yellow]")
+            run.kill()
+            run.wait()
+    except Exception as e:
+        console.print(f"\n[red]⚠️ 启动程序失败: {str(e)}[/red]")
+        return None
+    result = run.result()
+    record_run_history(result)
+    print_run_result(result)
+    return result
+
+class JobManager:
+    """后台任务表：限制并发数量，非阻塞回收已结束的进程"""
+    STATUS_QUEUED = "排队中"
+    STATUS_RUNNING = "运行中"
+    STATUS_DONE = "已结束"
+    STATUS_FAILED = "出错"
+    STATUS_KILLED = "已终止"
+    STATUS_TIMEOUT = "超时"
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_JOBS):
+        self.max_concurrent = max(1, max_concurrent)
+        self.jobs = {}
+        self.queue = deque()
+        self.next_id = 1
+        self.lock = Lock()
+        self.reaper = None
+        self.starting = 0
+
+    def _ensure_reaper(self):
+        if self.reaper is None or not self.reaper.is_alive():
+            self.reaper = Thread(target=self._reap_loop, daemon=True)
+            self.reaper.start()
+
+    def _reap_loop(self):
+        while True:
+            self.reap()
+            with self.lock:
+                if not self.queue and not self.starting and not self.running():
+                    self.reaper = None
+                    return
+            time.sleep(0.2)
+
+    def running(self):
+        return [job for job in self.jobs.values() if job["status"] == self.STATUS_RUNNING]
+
+    def submit(self, python_path, filename):
+        """提交后台任务，超过并发上限时排队"""
+        with self.lock:
+            job_id = self.next_id
+            self.next_id += 1
+            self.jobs[job_id] = {
+                "id": job_id,
+                "file": filename,
+                "python_path": python_path,
+                "status": self.STATUS_QUEUED,
+                "run": None,
+            }
+            self.queue.append(job_id)
+        self._start_queued()
+        self._ensure_reaper()
+        job = self.jobs[job_id]
+        if job["status"] == self.STATUS_QUEUED:
+            console.print(f"\n[yellow]任务 {job_id} 已排队（并发上限 {self.max_concurrent}）: {os.path.basename(filename)}[/yellow]")
+        else:
+            console.print(f"\n[green]✓ 任务 {job_id} 已在后台启动: {os.path.basename(filename)}[/green]")
+        return job_id
+
+    def _start_queued(self):
+        while True:
+            with self.lock:
+                if not self.queue or len(self.running()) + self.starting >= self.max_concurrent:
+                    return
+                job = self.jobs[self.queue.popleft()]
+                if job["status"] != self.STATUS_QUEUED:
+                    continue
+                # 启动期间状态仍为排队中，此时kill只需改状态，启动完成后再结束进程
+                self.starting += 1
+            # 启动可能要等预热进程就绪，不能持有锁，否则jobs/kill等命令会一直卡住
+            try:
+                run = create_managed_run(job["python_path"], job["file"], timeout=JOB_TIMEOUT,
+                                         echo=False, interactive=False)
+            except Exception as e:
+                run = None
+                console.print(f"\n[red]⚠️ 任务 {job['id']} 启动失败: {str(e)}[/red]")
+            with self.lock:
+                self.starting -= 1
+                if run is None:
+                    job["status"] = self.STATUS_FAILED
+                    continue
+                job["run"] = run
+                cancelled = job["status"] == self.STATUS_KILLED
+                job["status"] = self.STATUS_RUNNING
+            if cancelled:
+                # 启动期间被kill的任务，启动完成后立即结束，由reap记为已终止
+                run.kill()
+
+    def reap(self):
+        """回收已结束的任务并启动排队任务（不阻塞）"""
+        finished = []
+        with self.lock:
+            running = self.running()
+        # poll会等待输出读取线程结束（最多约1秒），不能持有锁，否则jobs/kill/wait都会被卡住
+        exited = [job for job in running if job["run"].poll() is not None]
+        with self.lock:
+            for job in exited:
+                run = job["run"]
+                if job["status"] != self.STATUS_RUNNING:
+                    # 另一个线程已回收过
+                    continue
+                if run.timed_out:
+                    job["status"] = self.STATUS_TIMEOUT
+                elif run.killed:
+                    job["status"] = self.STATUS_KILLED
+                elif run.returncode != 0:
+                    job["status"] = self.STATUS_FAILED
+                else:
+                    job["status"] = self.STATUS_DONE
+                finished.append(job)
+        for job in finished:
+            result = job["run"].result()
+            result["mode"] = "job"
+            record_run_history(result)
+            console.print(f"\n[blue]任务 {job['id']} {job['status']}（退出码 {result['exit_code']}，{result['duration']:.1f}s）: {os.path.basename(job['file'])}[/blue]")
+        if finished:
+            self._start_queued()
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def kill(self, job_id):
+        job = self.jobs.get(job_id)
+        if not job:
+            return False
+        with self.lock:
+            if job["status"] == self.STATUS_QUEUED:
+                job["status"] = self.STATUS_KILLED
+                return True
+        if job["status"] == self.STATUS_RUNNING:
+            job["run"].kill()
+            job["run"].wait(timeout=5)
+            self.reap()
+        return True
+
+    def wait(self, job_id):
+        """阻塞等待任务结束，Ctrl+C仅停止等待而不终止任务"""
+        job = self.jobs.get(job_id)
+        if not job:
+            return None
+        try:
+            while job["status"] in (self.STATUS_QUEUED, self.STATUS_RUNNING):
+                self.reap()
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            console.print("\n[yellow]已停止等待，任务仍在后台运行[/yellow]")
+        return job["status"]
+
+    def kill_all(self):
+        for job_id, job in list(self.jobs.items()):
+            if job["status"] in (self.STATUS_QUEUED, self.STATUS_RUNNING):
+                self.kill(job_id)
+
+job_manager = JobManager()
+
+def launch_script(filename):
+    """按当前运行模式启动程序"""
+    python_path = setup_virtual_env()
+    if interpreter_policy == "fastest":
+        python_path = prepare_fastest_interpreter(filename) or python_path
+    if run_mode == "managed":
+        return run_managed(python_path, filename)
+    if run_mode == "background":
+        job_manager.submit(python_path, filename)
+        return None
+    launch_in_terminal(python_path, filename)
+    # 新窗口运行不等待结束，只记录启动时间（存储清理据此判断脚本是否还在使用）
+    record_run_history({"file": os.path.relpath(filename), "mode": "terminal",
+                        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+    return None
+
+# ----------------------------
+# 性能分析：cProfile + tracemalloc 找出热点，可让AI据此优化并实测对比
+# ----------------------------
+# 在虚拟环境中运行：python -c <源码> 脚本 结果文件 条数
+PROFILE_RUNNER_SOURCE = r'''
+import cProfile, json, os, pstats, runpy, sys, time, traceback, tracemalloc
+script, out_path, top = sys.argv[1], sys.argv[2], int(sys.argv[3])
+sys.argv = [script]
+sys.path[0] = os.path.dirname(os.path.abspath(script))
+exit_code = 0
+keep_alive = None
+profiler = cProfile.Profile()
+tracemalloc.start()
+start = time.perf_counter()
+profiler.enable()
+try:
+    # 保留脚本的全局变量，结束时的内存快照才能看到数据占用在哪里
+    keep_alive = runpy.run_path(script, run_name="__main__")
+except SystemExit as e:
+    exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+except BaseException:
+    keep_alive = sys.exc_info()
+    traceback.print_exc()
+    exit_code = 1
+finally:
+    profiler.disable()
+elapsed = time.perf_counter() - start
+peak = tracemalloc.get_traced_memory()[1]
+snapshot = tracemalloc.take_snapshot().filter_traces((
+    tracemalloc.Filter(False, "<frozen *>"), tracemalloc.Filter(False, "<unknown>"), tracemalloc.Filter(False, runpy.__file__),
+))
+tracemalloc.stop()
+script_path = os.path.normcase(os.path.abspath(script))
+functions = []
+for (filename, line, name), (_, calls, tottime, cumtime, _) in pstats.Stats(profiler).stats.items():
+    if "_lsprof.Profiler" in name:
+        continue
+    in_script = not filename.startswith(("<", "~")) and os.path.normcase(os.path.abspath(filename)) == script_path
+    functions.append({"file": filename, "line": line, "name": name, "calls": calls,
+                      "tottime": tottime, "cumtime": cumtime, "in_script": in_script})
+hotspots = sorted(functions, key=lambda f: f["tottime"], reverse=True)[:top]
+script_functions = sorted((f for f in functions if f["in_script"]), key=lambda f: f["cumtime"], reverse=True)[:top]
+allocations = [{"file": stat.traceback[0].filename, "line": stat.traceback[0].lineno, "size": stat.size, "count": stat.count}
+               for stat in snapshot.statistics("lineno")[:top]]
+with open(out_path, "w", encoding="utf-8") as f:
+    json.dump({"exit_code": exit_code, "elapsed": elapsed, "peak_memory": peak, "hotspots": hotspots,
+               "script_functions": script_functions, "allocations": allocations}, f)
+sys.exit(exit_code)
+'''
+
+PROFILE_OPTIMIZE_INSTRUCTION = """下面是这个脚本实际运行时的性能分析结果。请在功能和输出完全不变的前提下，针对最耗时、最占内存的部分进行优化
+（例如：避免在循环中重复计算、重复打开文件或逐行拼接字符串；用批量/向量化操作代替逐行处理；选用更合适的数据结构）。
+不要删除功能，不要增加新的依赖包，不要加入time.sleep。"""
+
+def profile_script(filename, top=PROFILE_TOP):
+    """在虚拟环境中用cProfile和tracemalloc运行脚本，返回分析结果，运行失败返回None"""
+    import tempfile
+    python_path = setup_virtual_env()
+    env = launcher_env(python_path)
+    env["PYTHONIOENCODING"] = "utf-8"
+    fd, out_path = tempfile.mkstemp(suffix=".json", prefix="autocode_prof_")
+    os.close(fd)
+    console.print(f"\n[yellow]⏳ 正在分析运行 {os.path.basename(filename)}（cProfile + tracemalloc，比平时慢）...[/yellow]")
+    try:
+        subprocess.run([python_path, "-c", PROFILE_RUNNER_SOURCE, filename, out_path, str(top)],
+                       env=env, timeout=RUN_TIMEOUT)
+        with open(out_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except subprocess.TimeoutExpired:
+        console.print(f"[red]❌ 分析运行超时（{RUN_TIMEOUT:.0f}秒）[/red]")
+    except (OSError, json.JSONDecodeError):
+        console.print("[red]❌ 分析运行失败，未得到分析结果[/red]")
+    finally:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+    return None
+
+def _format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+def _profile_location(item):
+    if item["file"].startswith(("~", "<")):
+        return item["name"]
+    return f"{os.path.basename(item['file'])}:{item['line']} {item['name']}"
+
+def report_profile(profile):
+    """显示精简的分析报告：总耗时、峰值内存、耗时最多的函数和内存占用最多的代码行"""
+    exit_note = "" if profile["exit_code"] == 0 else f"，[red]退出码 {profile['exit_code']}[/red]"
+    console.print(f"\n[cyan]总耗时 {profile['elapsed']:.2f}s（含分析开销），峰值内存 {_format_bytes(profile['peak_memory'])}{exit_note}[/cyan]")
+    console.print(f"[cyan]{'自身耗时':>9}{'累计耗时':>10}{'调用次数':>10}  函数[/cyan]")
+    for item in profile["hotspots"]:
+        marker = "[green]*[/green]" if item["in_script"] else " "
+        console.print(f"{item['tottime']:>8.3f}s{item['cumtime']:>9.3f}s{item['calls']:>10}  {marker}{_profile_location(item)}")
+    if profile["allocations"]:
+        console.print("[cyan]结束时内存占用最多的代码行：[/cyan]")
+        for item in profile["allocations"][:5]:
+            console.print(f"{_format_bytes(item['size']):>9}  {os.path.basename(item['file'])}:{item['line']}（{item['count']}个对象）")
+    console.print("[dim]* 为脚本自身的代码[/dim]")
+
+def format_profile_for_prompt(profile, code_content):
+    """把热点整理成给模型看的文字，并附上脚本中对应的代码行"""
+    lines = code_content.splitlines()
+    def source(line_number):
+        return lines[line_number - 1].strip() if 0 < line_number <= len(lines) else ""
+    parts = [f"总耗时 {profile['elapsed']:.2f}s，峰值内存 {_format_bytes(profile['peak_memory'])}", "耗时最多的函数（自身耗时/累计耗时/调用次数）："]
+    for item in profile["hotspots"]:
+        parts.append(f"- {_profile_location(item)}: {item['tottime']:.3f}s / {item['cumtime']:.3f}s / {item['calls']}次")
+    parts.append("脚本中累计耗时最多的函数：")
+    for item in profile["script_functions"]:
+        parts.append(f"- 第{item['line']}行 {item['name']}: {item['cumtime']:.3f}s，{item['calls']}次  `{source(item['line'])}`")
+    script_path = os.path.basename(profile.get("file", ""))
+    allocations = [item for item in profile["allocations"] if os.path.basename(item["file"]) == script_path]
+    if allocations:
+        parts.append("脚本中内存占用最多的代码行：")
+        for item in allocations[:5]:
+            parts.append(f"- 第{item['line']}行 {_format_bytes(item['size'])}  `{source(item['line'])}`")
+    return "\n".join(parts)
+
+def time_script(python_path, filename, repeat=PROFILE_REPEAT, cwd=None):
+    """不带分析器地运行几次脚本，返回 (耗时中位数, 退出码, 输出)；cwd为运行时的工作目录"""
+    durations = []
+    exit_code = 0
+    output = []
+    for _ in range(repeat):
+        run = ManagedRun(python_path, filename, echo=False, interactive=False, cwd=cwd).start()
+        run.wait()
+        result = run.result()
+        exit_code = exit_code or result["exit_code"]
+        durations.append(result["duration"])
+        output = run.tail(RUN_OUTPUT_BUFFER_LINES)
+    durations.sort()
+    return durations[len(durations) // 2], exit_code, output
+
+def choose_timing_sandbox(interactive=True):
+    """对比计时前提醒会重复运行脚本，返回 True（在临时目录中运行）、False（直接运行）或 None（取消）"""
+    console.print(
+        f"\n[yellow]⚠️ 对比计时会把原脚本和优化版本各运行 {PROFILE_REPEAT} 次。如果脚本会移动、重命名、删除文件或修改数据，"
+        f"重复运行可能破坏数据，输出对比也没有意义[/yellow]"
+    )
+    if not interactive:
+        return True
+    choice = input("1 在临时目录中运行（相对路径指向临时目录，绝对路径仍是真实文件）  2 直接运行  3 取消  [1]: ").strip() or "1"
+    return {"1": True, "2": False}.get(choice)
+
+def optimize_from_profile(filename, profile, model="deepseek-chat", interactive=True):
+    """把热点和代码发给模型请求更快的版本，前后各计时几次，保留更快的一版；返回是否替换了原脚本"""
+    import tempfile
+    with open(filename, "r", encoding="utf-8") as f:
+        original_code = f.read()
+    messages = init_messages()
+    printer = StreamPrinter()
+    prompt = PROFILE_OPTIMIZE_INSTRUCTION + "\n\n" + format_profile_for_prompt(dict(profile, file=filename), original_code)
+    console.print("\n[yellow]⏳ 正在请求优化版本...[/yellow]")
+    optimized_code, _ = request_code_edit(messages, printer, model, prompt, original_code, include_code=True)
+    if not optimized_code or optimized_code.strip() == original_code.strip():
+        console.print("\n[yellow]⚠️ 没有得到新的代码，保留原脚本[/yellow]")
+        return False
+    sandbox = choose_timing_sandbox(interactive)
+    if sandbox is None:
+        console.print("[yellow]已取消对比，保留原脚本[/yellow]")
+        return False
+
+    # 候选版本写入临时目录，不放进代码工具库；在临时目录中运行时原脚本也复制一份，各自一个工作目录
+    work_dir = tempfile.mkdtemp(prefix="autocode_prof_opt_")
+    name = os.path.basename(filename)
+    candidate_dir = os.path.join(work_dir, "optimized")
+    os.makedirs(candidate_dir)
+    candidate_path = os.path.join(candidate_dir, name)
+    with open(candidate_path, "w", encoding="utf-8") as f:
+        f.write(optimized_code)
+    original_path, original_cwd, candidate_cwd = os.path.abspath(filename), None, None
+    if sandbox:
+        original_dir = os.path.join(work_dir, "original")
+        os.makedirs(original_dir)
+        original_path = os.path.join(original_dir, name)
+        shutil.copyfile(filename, original_path)
+        original_cwd, candidate_cwd = original_dir, candidate_dir
+    try:
+        syntax_error = compile_check(optimized_code)
+        if syntax_error:
+            console.print(f"[yellow]⚠️ 优化版本有语法错误（{syntax_error}），保留原脚本[/yellow]")
+            return False
+        if not ensure_script_dependencies(optimized_code):
+            console.print("[yellow]⚠️ 优化版本的依赖未就绪，保留原脚本[/yellow]")
+            return False
+        python_path = setup_virtual_env()
+        console.print(f"\n[yellow]⏳ 正在对比计时（各运行 {PROFILE_REPEAT} 次）...[/yellow]")
+        before, before_code, before_output = time_script(python_path, original_path, cwd=original_cwd)
+        after, after_code, after_output = time_script(python_path, candidate_path, cwd=candidate_cwd)
+        console.print(f"[cyan]原版本 {before:.3f}s（退出码 {before_code}），优化版本 {after:.3f}s（退出码 {after_code}）[/cyan]")
+        if after_code != 0 or after >= before:
+            console.print("[yellow]优化版本没有更快或运行出错，保留原脚本[/yellow]")
+            return False
+        if after_output != before_output:
+            console.print("[yellow]⚠️ 优化前后的输出不一致（如果输出里有时间、随机数属于正常）[/yellow]")
+            if not interactive or input("仍然使用优化版本吗？(y/n): ").strip().lower() != "y":
+                console.print("[yellow]已保留原脚本[/yellow]")
+                return False
+        shutil.copyfile(filename, filename + ".bak")
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write(optimized_code)
+        console.print(f"[green]✓ 已替换为优化版本（快 {before / after:.1f} 倍），原脚本备份为 {os.path.basename(filename)}.bak[/green]")
+        return True
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+# ----------------------------
+# 解释器选择：发现本机的Python、检查脚本兼容性、为脚本选用最快的解释器
+# ----------------------------
+# 新增的标准库模块（需要的最低版本）和已移除的模块（从该版本起不可用）
+STDLIB_ADDED = {"zoneinfo": (3, 9), "graphlib": (3, 9), "tomllib": (3, 11)}
+STDLIB_REMOVED = {
+    "distutils": (3, 12), "imp": (3, 12), "asynchat": (3, 12), "asyncore": (3, 12), "smtpd": (3, 12),
+    "aifc": (3, 13), "audioop": (3, 13), "cgi": (3, 13), "cgitb": (3, 13), "chunk": (3, 13), "crypt": (3, 13),
+    "imghdr": (3, 13), "mailcap": (3, 13), "msilib": (3, 13), "nis": (3, 13), "nntplib": (3, 13),
+    "ossaudiodev": (3, 13), "pipes": (3, 13), "sndhdr": (3, 13), "spwd": (3, 13), "sunau": (3, 13),
+    "telnetlib": (3, 13), "uu": (3, 13), "xdrlib": (3, 13),
+}
+BUILTIN_GENERICS = {"list", "dict", "tuple", "set", "frozenset", "type"}
+_interpreters = None
+_wheel_info_lock = Lock()
+
+def _minor_tuple(minor):
+    return tuple(int(part) for part in minor.split("."))
+
+def discover_interpreters(refresh=False):
+    """查找本机安装的CPython解释器：[{version, minor, path}]，每个小版本一个，按版本从新到旧排列"""
+    global _interpreters
+    if _interpreters is not None and not refresh:
+        return _interpreters
+    candidates = []
+    if sys.platform == "win32":
+        try:
+            listing = subprocess.run(["py", "-0p"], capture_output=True, text=True, timeout=10).stdout
+        except (OSError, subprocess.SubprocessError):
+            listing = ""
+        candidates += re.findall(r"([A-Za-z]:\\\S.*?python\.exe)", listing)
+    else:
+        for minor in range(PYTHON_MIN_VERSION[1], 15):
+            path = shutil.which(f"python3.{minor}")
+            if path:
+                candidates.append(path)
+        if shutil.which("python3"):
+            candidates.append(shutil.which("python3"))
+        # pyenv 安装的各个版本（shim 只对当前激活的版本有效）
+        pyenv_root = Path(os.getenv("PYENV_ROOT", "~/.pyenv")).expanduser()
+        candidates += [str(path) for path in sorted(pyenv_root.glob("versions/*/bin/python3"))]
+    candidates.append(getattr(sys, "_base_executable", None) or sys.executable)
+    probe = "import sys, json; print(json.dumps([sys.implementation.name, list(sys.version_info[:3])]))"
+    found = {}
+    for path in candidates:
+        try:
+            result = subprocess.run([path, "-c", probe], capture_output=True, text=True, timeout=10)
+            implementation, version = json.loads(result.stdout)
+        except (OSError, subprocess.SubprocessError, ValueError):
+            continue
+        if implementation != "cpython" or tuple(version[:2]) < PYTHON_MIN_VERSION:
+            continue
+        minor = f"{version[0]}.{version[1]}"
+        found.setdefault(minor, {"version": ".".join(map(str, version)), "minor": minor, "path": path})
+    _interpreters = sorted(found.values(), key=lambda interp: _minor_tuple(interp["minor"]), reverse=True)
+    return _interpreters
+
+def interpreter_venv_dir(interp):
+    """解释器对应的虚拟环境目录：3.9沿用默认环境，其他版本各自一个 venv3.x"""
+    return VENV_DIR if interp["minor"] == "3.9" else f"venv{interp['minor']}"
+
+def _annotation_requirement(annotation):
+    """类型注解在运行时求值所需的最低版本（X | Y 需要3.10，list[int] 等需要3.9）"""
+    required = None
+    for node in ast.walk(annotation):
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitOr):
+            return (3, 10), "类型注解 X | Y"
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id in BUILTIN_GENERICS:
+            required = ((3, 9), f"类型注解 {node.value.id}[...]")
+    return required or (None, None)
+
+def script_python_range(code_content):
+    """按语法特性和标准库模块推断脚本支持的Python版本：(最低版本, 最高版本（不含）或None, 原因列表)"""
+    tree = ast.parse(code_content)
+    minimum, maximum, reasons = PYTHON_MIN_VERSION, None, []
+
+    def need(version, reason):
+        nonlocal minimum
+        if version > minimum:
+            minimum = version
+        reasons.append(f"{reason}（需要 {version[0]}.{version[1]}+）")
+
+    future_annotations = any(
+        isinstance(node, ast.ImportFrom) and node.module == "__future__" and any(alias.name == "annotations" for alias in node.names)
+        for node in tree.body
+    )
+    for node in ast.walk(tree):
+        kind = type(node).__name__
+        if kind == "NamedExpr":
+            need((3, 8), "海象运算符 :=")
+        elif kind == "Match":
+            need((3, 10), "match 语句")
+        elif kind == "TryStar":
+            need((3, 11), "except*")
+        elif kind == "TypeAlias" or getattr(node, "type_params", None):
+            need((3, 12), "类型参数语法")
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)) and node.args.posonlyargs:
+            need((3, 8), "仅位置参数 /")
+        if not future_annotations:
+            annotations = []
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                annotations = [arg.annotation for arg in node.args.args + node.args.kwonlyargs if arg.annotation]
+                if node.returns:
+                    annotations.append(node.returns)
+            elif isinstance(node, ast.AnnAssign):
+                annotations = [node.annotation]
+            for annotation in annotations:
+                version, reason = _annotation_requirement(annotation)
+                if version:
+                    need(version, reason)
+        modules = []
+        if isinstance(node, ast.Import):
+            modules = [alias.name.split(".")[0] for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules = [node.module.split(".")[0]]
+        for module in modules:
+            if module in STDLIB_ADDED:
+                need(STDLIB_ADDED[module], f"标准库 {module}")
+            if module in STDLIB_REMOVED:
+                removed = STDLIB_REMOVED[module]
+                if maximum is None or removed < maximum:
+                    maximum = removed
+                reasons.append(f"标准库 {module}（{removed[0]}.{removed[1]} 起已移除）")
+    return minimum, maximum, list(dict.fromkeys(reasons))
+
+def _wheel_tag_supports(filename, minor):
+    """wheel文件名的标签是否支持指定Python版本和本机平台"""
+    parts = filename[:-4].split("-")
+    if len(parts) < 5:
+        return False
+    python_tags, abi_tags, platform_tags = parts[-3].split("."), parts[-2].split("."), parts[-1].split(".")
+    major, minor_number = _minor_tuple(minor)
+    cp_tag = f"cp{major}{minor_number}"
+    python_ok = any(
+        tag in ("py3", f"py{major}{minor_number}", cp_tag)
+        or ("abi3" in abi_tags and tag.startswith("cp3") and tag[3:].isdigit() and int(tag[3:]) <= minor_number)
+        for tag in python_tags
+    )
+    if not python_ok:
+        return False
+    prefix = "win" if sys.platform == "win32" else "macosx" if sys.platform == "darwin" else "linux"
+    machine = platform.machine().lower()
+    machines = {"amd64": ("amd64", "x86_64"), "x86_64": ("amd64", "x86_64"),
+                "arm64": ("arm64", "aarch64"), "aarch64": ("arm64", "aarch64")}.get(machine, (machine,))
+    if prefix == "macosx":
+        machines += ("universal2",)
+    return any(tag == "any" or (prefix in tag and any(name in tag for name in machines)) for tag in platform_tags)
+
+def _load_wheel_info():
+    try:
+        with open(WHEEL_INFO_CACHE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def release_files(lib):
+    """查询依赖在PyPI上的发布文件名（固定版本时查该版本，否则查最新版本），结果缓存7天；查询失败返回None"""
+    name, specifier, _ = split_requirement(lib)
+    if not name:
+        return None
+    version = specifier[2:].strip() if specifier.startswith("==") and "*" not in specifier else ""
+    key = f"{normalize_dist_name(name)}=={version}" if version else normalize_dist_name(name)
+    with _wheel_info_lock:
+        info = _load_wheel_info()
+        entry = info.get(key)
+        if entry and time.time() - entry["fetched"] < WHEEL_INFO_TTL:
+            return entry["files"]
+    url = f"https://pypi.org/pypi/{name}/{version}/json" if version else f"https://pypi.org/pypi/{name}/json"
+    try:
+        response = requests.get(url, timeout=5)
+        if response.status_code == 404:
+            files = []
+        else:
+            response.raise_for_status()
+            files = [item["filename"] for item in response.json().get("urls", [])]
+    except (requests.RequestException, ValueError):
+        return None
+    with _wheel_info_lock:
+        info = _load_wheel_info()
+        info[key] = {"files": files, "fetched": time.time()}
+        try:
+            with open(WHEEL_INFO_CACHE_FILE, "w", encoding="utf-8") as f:
+                json.dump(info, f, ensure_ascii=False)
+        except OSError:
+            pass
+    return files
+
+def dependency_available(lib, interp):
+    """依赖能否装到指定解释器：已安装或有匹配的wheel时为True，只有二进制wheel且都不匹配时为False，
+    无法确定（离线、PyPI上找不到）时为None"""
+    venv_dir = interpreter_venv_dir(interp)
+    if not missing_dependencies([lib], verbose=False, venv_dir=venv_dir):
+        return True
+    if os.path.isdir(WHEEL_CACHE_DIR):
+        name = normalize_dist_name(split_requirement(lib)[0] or lib)
+        for entry in os.listdir(WHEEL_CACHE_DIR):
+            if entry.endswith(".whl") and normalize_dist_name(entry.split("-")[0]) == name and _wheel_tag_supports(entry, interp["minor"]):
+                return True
+    files = release_files(lib)
+    if not files:
+        return None
+    wheels = [filename for filename in files if filename.endswith(".whl")]
+    if not wheels:
+        # 只有源码包的多为纯Python包，任何版本都能安装
+        return True
+    return any(_wheel_tag_supports(filename, interp["minor"]) for filename in wheels)
+
+def interpreter_compatibility(code_content, interp, libs=None):
+    """检查脚本能否在指定解释器上运行，返回 (是否兼容, 原因)"""
+    try:
+        minimum, maximum, _ = script_python_range(code_content)
+    except SyntaxError:
+        return False, "语法无法解析"
+    version = _minor_tuple(interp["minor"])
+    if version < minimum:
+        return False, f"需要 Python {minimum[0]}.{minimum[1]}+"
+    if maximum and version >= maximum:
+        return False, f"使用了 {maximum[0]}.{maximum[1]} 起已移除的标准库"
+    if libs is None:
+        libs = extract_imports(code_content, verbose=False)
+    for lib in sorted(libs):
+        if dependency_available(lib, interp) is False:
+            return False, f"{lib} 没有适用于 Python {interp['minor']} 的wheel"
+    return True, "兼容"
+
+def load_interpreter_bench():
+    try:
+        with open(INTERPRETER_BENCH_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def choose_interpreter(code_content, libs=None):
+    """在兼容的解释器中选最快的：有该脚本的实测耗时按实测，否则选版本最新的（新版本CPython通常更快）。
+    返回 (解释器信息, 原因)，没有兼容的解释器时返回 (None, 原因)"""
+    measured = load_interpreter_bench().get(_code_hash(code_content), {})
+    compatible = []
+    for interp in discover_interpreters():
+        ok, reason = interpreter_compatibility(code_content, interp, libs)
+        if ok:
+            compatible.append(interp)
+    if not compatible:
+        return None, "没有兼容的解释器"
+    best = min(compatible, key=lambda interp: (measured.get(interp["minor"], float("inf")),
+                                               tuple(-part for part in _minor_tuple(interp["minor"]))))
+    if best["minor"] in measured:
+        return best, f"实测最快（{measured[best['minor']]:.2f}s）"
+    return best, "兼容的最新版本"
+
+def ensure_interpreter_env(interp, libs, verbose=True):
+    """准备解释器对应的虚拟环境并安装缺少的依赖，返回环境中的python路径，失败返回None"""
+    venv_dir = interpreter_venv_dir(interp)
+    try:
+        python_path = setup_virtual_env(venv_dir, interp["path"]) if venv_dir != VENV_DIR else setup_virtual_env()
+    except Exception as e:
+        if verbose:
+            console.print(f"[yellow]⚠️ 创建 {venv_dir} 失败: {str(e)}[/yellow]")
+        return None
+    missing = missing_dependencies(libs, verbose=False, venv_dir=venv_dir)
+    if missing:
+        with install_lock_for(venv_dir).hold(missing):
+            if install_lock_for(venv_dir).waited:
+                missing = missing_dependencies(missing, verbose=False, venv_dir=venv_dir)
+            if missing:
+                if verbose:
+                    console.print(f"[yellow]⏳ 正在向 {venv_dir} 安装: {', '.join(missing)}[/yellow]")
+                ok, error = pip_install_quiet(missing, python_path)
+                if venv_dir == VENV_DIR:
+                    mark_venv_changed()
+                if not ok:
+                    if verbose:
+                        console.print(f"[yellow]⚠️ 向 {venv_dir} 安装依赖失败: {error}[/yellow]")
+                    return None
+    return python_path
+
+def prepare_fastest_interpreter(filename):
+    """fastest策略：为脚本选出最快的兼容解释器并准备好环境，返回python路径；沿用默认环境时返回None"""
+    try:
+        with open(filename, "r", encoding="utf-8") as f:
+            code_content = f.read()
+        libs = extract_imports(code_content, verbose=False)
+        interp, reason = choose_interpreter(code_content, libs)
+    except Exception as e:
+        console.print(f"[yellow]⚠️ 选择解释器失败，使用默认环境: {str(e)}[/yellow]")
+        return None
+    if interp is None or interpreter_venv_dir(interp) == VENV_DIR:
+        return None
+    python_path = ensure_interpreter_env(interp, libs)
+    if python_path is None:
+        console.print("[yellow]⚠️ 改用默认的Python 3.9环境运行[/yellow]")
+        return None
+    console.print(f"[cyan]🐍 使用 Python {interp['version']} 运行（{reason}）[/cyan]")
+    return python_path
+
+def benchmark_interpreters(filename, repeat=3):
+    """在每个兼容的解释器上各运行脚本几次，比较耗时，结果供fastest策略使用"""
+    with open(filename, "r", encoding="utf-8") as f:
+        code_content = f.read()
+    libs = extract_imports(code_content, verbose=False)
+    interps = discover_interpreters(refresh=True)
+    if not interps:
+        console.print("[red]❌ 没有找到可用的Python解释器[/red]")
+        return
+    console.print(f"\n[yellow]正在测试 {len(interps)} 个解释器（各运行 {repeat} 次）...[/yellow]")
+    rows = []
+    for interp in interps:
+        ok, reason = interpreter_compatibility(code_content, interp, libs)
+        if not ok:
+            rows.append((interp, None, reason))
+            continue
+        python_path = ensure_interpreter_env(interp, libs)
+        if python_path is None:
+            rows.append((interp, None, "环境准备失败"))
+            continue
+        durations = []
+        exit_code = 0
+        for _ in range(repeat):
+            run = ManagedRun(python_path, filename, echo=False, interactive=False)
+            run.start()
+            run.wait()
+            result = run.result()
+            exit_code = exit_code or result["exit_code"]
+            durations.append(result["duration"])
+        durations.sort()
+        median = durations[len(durations) // 2]
+        rows.append((interp, median if exit_code == 0 else None, "完成" if exit_code == 0 else f"退出码 {exit_code}"))
+
+    results = {interp["minor"]: median for interp, median, _ in rows if median is not None}
+    if results:
+        bench = load_interpreter_bench()
+        bench[_code_hash(code_content)] = results
+        with open(INTERPRETER_BENCH_FILE, "w", encoding="utf-8") as f:
+            json.dump(bench, f, ensure_ascii=False, indent=2)
+    fastest = min(results, key=results.get) if results else None
+    console.print(f"\n[cyan]{'解释器':<14}{'耗时(中位数)':>10}  说明[/cyan]")
+    for interp, median, note in rows:
+        timing = f"{median:.3f}s" if median is not None else "-"
+        marker = " ⭐" if interp["minor"] == fastest else ""
+        console.print(f"{'Python ' + interp['version']:<16}{timing:>12}  {note}{marker}")
+    if fastest:
+        console.print(f"\n[green]✓ 最快: Python {fastest}，已记录；fastest 策略下运行此脚本会使用它[/green]")
+
+# ----------------------------
+# 依赖锁文件：记录脚本实际使用的包版本，重复运行时跳过依赖分析
+# ----------------------------
+LOCK_SUFFIX = ".lock.json"
+
+def normalize_dist_name(name):
+    """规范化包名（PEP 503）：不区分大小写，-_.视为相同"""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+def venv_site_packages(venv_dir=None):
+    """虚拟环境的site-packages目录列表"""
+    venv_path = Path(venv_dir or VENV_DIR).absolute()
+    if sys.platform == "win32":
+        candidates = [venv_path / "Lib" / "site-packages"]
+    else:
+        candidates = sorted(venv_path.glob("lib/python*/site-packages"))
+    return [path for path in candidates if path.is_dir()]
+
+def _dist_info_dirs(venv_dir=None):
+    for site_dir in venv_site_packages(venv_dir):
+        for entry in site_dir.iterdir():
+            if entry.suffix in (".dist-info", ".egg-info"):
+                yield entry
+
+def read_venv_distributions(venv_dir=None):
+    """读取虚拟环境中已安装的包：{规范名: {name, version, requires, top_level, path}}"""
+    from email.parser import HeaderParser
+    distributions = {}
+    for info_dir in _dist_info_dirs(venv_dir):
+        metadata_file = info_dir / ("METADATA" if info_dir.suffix == ".dist-info" else "PKG-INFO")
+        if not metadata_file.is_file():
+            continue
+        try:
+            with open(metadata_file, "r", encoding="utf-8", errors="replace") as f:
+                metadata = HeaderParser().parse(f)
+        except OSError:
+            continue
+        name = metadata.get("Name")
+        if not name:
+            continue
+        top_level_file = info_dir / "top_level.txt"
+        top_level = []
+        if top_level_file.is_file():
+            top_level = [line.strip() for line in top_level_file.read_text(encoding="utf-8", errors="replace").splitlines() if line.strip()]
+        distributions[normalize_dist_name(name)] = {
+            "name": name,
+            "version": metadata.get("Version", ""),
+            "requires": metadata.get_all("Requires-Dist") or [],
+            "top_level": top_level,
+            "path": str(info_dir),
+        }
+    return distributions
+
+def venv_fingerprint(locked_names, distributions=None):
+    """锁定包的环境指纹：Python版本 + 锁文件中各个包当前安装的版本；其他包的增删不会使锁失效"""
+    import hashlib
+    if distributions is None:
+        distributions = read_venv_distributions()
+    venv_path = Path(VENV_DIR).absolute()
+    cfg = venv_path / "pyvenv.cfg"
+    parts = [cfg.read_text(encoding="utf-8", errors="replace") if cfg.exists() else ""]
+    for name in sorted(normalize_dist_name(name) for name in locked_names):
+        dist = distributions.get(name)
+        parts.append(f"{name}=={dist['version'] if dist else ''}")
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()[:16]
+
+def split_requirement(requirement):
+    """拆分需求字符串，返回 (包名, 版本说明, 环境标记)"""
+    requirement, _, marker = requirement.partition(";")
+    match = re.match(r"\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*(.*)", requirement)
+    if not match:
+        return None, "", marker.strip()
+    specifier = match.group(3).strip().strip("()").strip()
+    return match.group(1), specifier, marker.strip()
+
+def resolve_installed_closure(required_libs, distributions):
+    """根据已安装包的依赖声明，计算脚本依赖的完整闭包 {包名: 版本}，并返回找不到的依赖"""
+    import_map = {}
+    for key, dist in distributions.items():
+        for module in dist["top_level"]:
+            import_map.setdefault(module.lower(), key)
+    resolved = {}
+    unresolved = []
+    stack = []
+    for lib in required_libs:
+        name = split_requirement(lib)[0] or lib
+        key = normalize_dist_name(name)
+        if key not in distributions:
+            key = import_map.get(name.lower(), key)
+        if key in distributions:
+            stack.append(key)
+        else:
+            unresolved.append(lib)
+    while stack:
+        key = stack.pop()
+        if key in resolved:
+            continue
+        dist = distributions[key]
+        resolved[key] = dist
+        for requirement in dist["requires"]:
+            dep_name, _, marker = split_requirement(requirement)
+            # 可选功能(extra)的依赖不属于闭包
+            if not dep_name or "extra" in marker:
+                continue
+            dep_key = normalize_dist_name(dep_name)
+            if dep_key in distributions and dep_key not in resolved:
+                stack.append(dep_key)
+    return {dist["name"]: dist["version"] for dist in resolved.values()}, unresolved
+
+# ----------------------------
+# 依赖闭包解析：按Requires-Dist元数据和环境标记计算真正缺少的包
+# ----------------------------
+_packaging = None
+_wheel_metadata_cache = {}
+
+def load_packaging():
+    """导入packaging（未单独安装时使用pip自带的副本），都不可用时返回None"""
+    global _packaging
+    if _packaging is None:
+        _packaging = False
+        for prefix in ("packaging", "pip._vendor.packaging"):
+            try:
+                requirements_module = importlib.import_module(prefix + ".requirements")
+                version_module = importlib.import_module(prefix + ".version")
+                markers_module = importlib.import_module(prefix + ".markers")
+            except ImportError:
+                continue
+            from types import SimpleNamespace
+            _packaging = SimpleNamespace(
+                Requirement=requirements_module.Requirement,
+                InvalidRequirement=requirements_module.InvalidRequirement,
+                Version=version_module.Version,
+                InvalidVersion=version_module.InvalidVersion,
+                default_environment=markers_module.default_environment,
+            )
+            break
+    return _packaging or None
+
+def venv_marker_environment(venv_dir=None):
+    """环境标记的取值：平台信息取自本机，Python版本取自虚拟环境的pyvenv.cfg"""
+    packaging = load_packaging()
+    env = packaging.default_environment() if packaging else {}
+    cfg = Path(venv_dir or VENV_DIR).absolute() / "pyvenv.cfg"
+    version = None
+    if cfg.exists():
+        for line in cfg.read_text(encoding="utf-8", errors="replace").splitlines():
+            key, _, value = line.partition("=")
+            if key.strip() in ("version", "version_info") and value.strip():
+                version = ".".join(value.strip().split(".")[:3])
+    if version:
+        env["python_full_version"] = version
+        env["python_version"] = ".".join(version.split(".")[:2])
+        env["implementation_version"] = version
+    return env
+
+def parse_requirement(text):
+    """解析需求字符串，返回 (包名, extras集合, 需求对象)；packaging不可用时需求对象为None"""
+    packaging = load_packaging()
+    if packaging:
+        try:
+            req = packaging.Requirement(text)
+            return req.name, set(req.extras), req
+        except packaging.InvalidRequirement:
+            pass
+    name = split_requirement(text)[0]
+    extras = re.search(r"\[([^\]]*)\]", text.partition(";")[0])
+    return name, {extra.strip() for extra in extras.group(1).split(",")} if extras else set(), None
+
+def requirement_applies(text, req, env, extras):
+    """按虚拟环境判断一条依赖声明是否生效（环境标记，以及是否属于已请求的extra）"""
+    if req is not None:
+        if req.marker is None:
+            return True
+        return any(req.marker.evaluate(dict(env, extra=extra)) for extra in (extras or {""}))
+    marker = text.partition(";")[2]
+    if "extra" in marker:
+        return any(re.search(r"extra\s*==\s*['\"]%s['\"]" % re.escape(extra), marker) for extra in extras)
+    return True
+
+def version_satisfies(text, req, version):
+    """已安装/缓存的版本是否满足需求的版本说明"""
+    if req is not None:
+        try:
+            return req.specifier.contains(version, prereleases=True)
+        except Exception:
+            return True
+    specifier = split_requirement(text)[1]
+    return not specifier.startswith("==") or specifier[2:].strip() == version
+
+def requirement_spec(text, req):
+    """去掉环境标记后的需求字符串，交给pip安装"""
+    if req is None:
+        return text.partition(";")[0].strip()
+    extras = f"[{','.join(sorted(req.extras))}]" if req.extras else ""
+    return f"{req.name}{extras}{req.specifier}"
+
+def _version_key(version):
+    packaging = load_packaging()
+    if packaging:
+        try:
+            return (1, packaging.Version(version))
+        except packaging.InvalidVersion:
+            pass
+    return (0, version)
+
+def read_wheel_cache_distributions():
+    """读取本地wheel缓存中各wheel的元数据：{规范名: [{name, version, requires, path}]}"""
+    from email.parser import HeaderParser
+    import zipfile
+    distributions = {}
+    if not os.path.isdir(WHEEL_CACHE_DIR):
+        return distributions
+    for entry in os.scandir(WHEEL_CACHE_DIR):
+        if not entry.name.endswith(".whl"):
+            continue
+        cache_key = (entry.path, entry.stat().st_mtime)
+        info = _wheel_metadata_cache.get(cache_key)
+        if info is None:
+            try:
+                with zipfile.ZipFile(entry.path) as wheel:
+                    metadata_name = next(name for name in wheel.namelist()
+                                         if name.count("/") == 1 and name.endswith(".dist-info/METADATA"))
+                    metadata = HeaderParser().parsestr(wheel.read(metadata_name).decode("utf-8", "replace"))
+            except (OSError, zipfile.BadZipFile, StopIteration):
+                continue
+            info = {
+                "name": metadata.get("Name", ""),
+                "version": metadata.get("Version", ""),
+                "requires": metadata.get_all("Requires-Dist") or [],
+                "path": entry.path,
+            }
+            _wheel_metadata_cache[cache_key] = info
+        if info["name"]:
+            distributions.setdefault(normalize_dist_name(info["name"]), []).append(info)
+    return distributions
+
+def missing_dependencies(required_libs, verbose=True, distributions=None, venv_dir=None):
+    """计算依赖闭包中真正缺少的部分：已安装的包按其Requires-Dist继续检查（环境标记按虚拟环境求值），
+    未安装的包如果在本地wheel缓存中，也按缓存中的元数据展开；返回需要交给pip安装的需求列表。
+    连续检查多组依赖时可传入已读取的distributions，避免重复读取元数据"""
+    if distributions is None:
+        distributions = read_venv_distributions(venv_dir)
+    cached = None
+    env = venv_marker_environment(venv_dir)
+    import_map = {}
+    for key, dist in distributions.items():
+        for module in dist["top_level"]:
+            import_map.setdefault(module.lower(), key)
+    missing = []
+    missing_keys = set()
+    visited = set()
+    stack = [(lib, None) for lib in reversed(list(required_libs))]
+    while stack:
+        text, parent = stack.pop()
+        if parent is None and text in STANDARD_LIBS:
+            continue
+        name, extras, req = parse_requirement(text)
+        if not name:
+            if text not in missing:
+                missing.append(text)
+            continue
+        key = normalize_dist_name(name)
+        if parent is None and key not in distributions:
+            # 脚本里的导入名与包名不同时（如 yaml -> PyYAML），按已安装包的top_level反查
+            key = import_map.get(name.lower(), key)
+        dist = distributions.get(key)
+        if dist is not None and version_satisfies(text, req, dist["version"]):
+            if (key, tuple(sorted(extras))) in visited:
+                continue
+            visited.add((key, tuple(sorted(extras))))
+            if verbose and parent is None:
+                console.print(f"[green]✓ {dist['name']} 已安装[/green]")
+            requires = dist["requires"]
+        else:
+            if key in missing_keys:
+                continue
+            missing_keys.add(key)
+            missing.append(text if parent is None else requirement_spec(text, req))
+            if verbose and parent is not None:
+                state = f"版本 {dist['version']} 不满足 {text.partition(';')[0].strip()}" if dist else "未安装"
+                console.print(f"[yellow]依赖包 {name} {state}（{parent} 需要）[/yellow]")
+            if cached is None:
+                cached = read_wheel_cache_distributions()
+            candidates = [info for info in cached.get(key, []) if version_satisfies(text, req, info["version"])]
+            if not candidates:
+                # 缓存中没有时无法得知其依赖，交给pip解析
+                continue
+            requires = max(candidates, key=lambda info: _version_key(info["version"]))["requires"]
+        for requirement in requires:
+            dep_name, _, dep_req = parse_requirement(requirement)
+            if dep_name and requirement_applies(requirement, dep_req, env, extras):
+                stack.append((requirement, dist["name"] if dist else name))
+    return missing
+
+# ----------------------------
+# 安装前的离线版本冲突检查：脚本指定的版本与已安装的包、已知依赖约束是否冲突
+# ----------------------------
+def pinned_version(text, req):
+    """需求固定的版本（==x.y），没有固定版本时返回None"""
+    if req is not None:
+        specs = list(req.specifier)
+        if len(specs) == 1 and specs[0].operator in ("==", "===") and "*" not in specs[0].version:
+            return specs[0].version
+        return None
+    specifier = split_requirement(text)[1]
+    if specifier.startswith("==") and "," not in specifier and "*" not in specifier:
+        return specifier[2:].strip()
+    return None
+
+def find_pin_conflicts(required_libs):
+    """离线检查：脚本要求的版本是否违反已安装包（及缓存wheel）声明的依赖约束，或会降级被其他包依赖的共享库。
+    返回冲突列表 [{requirement, name, version, installed, violated, dependents, relaxed}]"""
+    distributions = read_venv_distributions()
+    cached = read_wheel_cache_distributions()
+    env = venv_marker_environment()
+    # 先确定每个需求安装后的目标版本：固定版本，或缓存中满足要求的最高版本
+    targets = {}
+    for text in required_libs:
+        name, _, req = parse_requirement(text)
+        if not name:
+            continue
+        key = normalize_dist_name(name)
+        installed = distributions.get(key)
+        version = pinned_version(text, req)
+        if version is None:
+            if installed and version_satisfies(text, req, installed["version"]):
+                continue
+            candidates = [info["version"] for info in cached.get(key, []) if version_satisfies(text, req, info["version"])]
+            version = max(candidates, key=_version_key) if candidates else None
+        if version is not None:
+            targets[key] = (text, name, req, version)
+
+    # 收集所有已知约束：要被替换版本的包，改用其目标版本在缓存中的元数据
+    constraints = {}
+    def add_constraints(source, requires):
+        for requirement in requires:
+            dep_name, _, dep_req = parse_requirement(requirement)
+            if dep_name and requirement_applies(requirement, dep_req, env, set()):
+                constraints.setdefault(normalize_dist_name(dep_name), []).append((source, requirement, dep_req))
+    for key, dist in distributions.items():
+        if key in targets and targets[key][3] != dist["version"]:
+            continue
+        add_constraints(f"{dist['name']} {dist['version']}", dist["requires"])
+    for key, (text, name, req, version) in targets.items():
+        for info in cached.get(key, []):
+            if info["version"] == version:
+                add_constraints(f"{info['name']} {version}（wheel缓存）", info["requires"])
+                break
+    for text in required_libs:
+        name, _, req = parse_requirement(text)
+        if name and req is not None and req.specifier:
+            constraints.setdefault(normalize_dist_name(name), []).append(("脚本", text, req))
+
+    conflicts = []
+    for key, (text, name, req, version) in targets.items():
+        others = [(source, requirement, dep_req) for source, requirement, dep_req in constraints.get(key, [])
+                  if requirement != text]
+        violated = [(source, requirement.partition(";")[0].strip()) for source, requirement, dep_req in others
+                    if not version_satisfies(requirement, dep_req, version)]
+        installed = distributions.get(key)
+        dependents = [source for source, _, _ in others if source != "脚本"]
+        downgrade = (installed is not None and dependents
+                     and _version_key(version) < _version_key(installed["version"]))
+        if not violated and not downgrade:
+            continue
+        # 放宽版本：优先沿用已安装版本，其次缓存中满足全部约束的版本，最后只保留其他包的约束交给pip选择
+        relaxed = None
+        candidates = ([installed["version"]] if installed else []) + sorted(
+            (info["version"] for info in cached.get(key, [])), key=_version_key, reverse=True)
+        for candidate in candidates:
+            if all(version_satisfies(requirement, dep_req, candidate) for _, requirement, dep_req in others):
+                relaxed = name if installed and candidate == installed["version"] else f"{name}=={candidate}"
+                break
+        if relaxed is None:
+            specifiers = [str(dep_req.specifier) for _, _, dep_req in others if dep_req is not None and dep_req.specifier]
+            relaxed = name + ",".join(specifiers)
+        conflicts.append({
+            "requirement": text,
+            "name": name,
+            "version": version,
+            "installed": installed["version"] if installed else None,
+            "violated": violated,
+            "dependents": dependents,
+            "relaxed": relaxed,
+        })
+
+    # 要安装的包（缓存中有元数据）本身要求改动已安装的共享库时，也视为冲突
+    def breaks_installed(requires):
+        broken = []
+        for requirement in requires:
+            dep_name, _, dep_req = parse_requirement(requirement)
+            if not dep_name or not requirement_applies(requirement, dep_req, env, set()):
+                continue
+            dep_key = normalize_dist_name(dep_name)
+            dist = distributions.get(dep_key)
+            if dist and dep_key not in targets and not version_satisfies(requirement, dep_req, dist["version"]):
+                broken.append((dist, requirement.partition(";")[0].strip()))
+        return broken
+    reported = {conflict["requirement"] for conflict in conflicts}
+    for key, (text, name, req, version) in targets.items():
+        if text in reported:
+            continue
+        infos = sorted(cached.get(key, []), key=lambda info: _version_key(info["version"]), reverse=True)
+        target_info = next((info for info in infos if info["version"] == version), None)
+        broken = breaks_installed(target_info["requires"]) if target_info else []
+        if not broken:
+            continue
+        relaxed = next((f"{name}=={info['version']}" for info in infos if not breaks_installed(info["requires"])), name)
+        conflicts.append({
+            "requirement": text,
+            "name": name,
+            "version": version,
+            "installed": distributions[key]["version"] if key in distributions else None,
+            "violated": [(f"已安装的 {dist['name']} {dist['version']}", requirement) for dist, requirement in broken],
+            "dependents": [],
+            "relaxed": relaxed,
+        })
+    return conflicts
+
+def report_pin_conflicts(conflicts):
+    console.print("\n[yellow]⚠️ 安装前检查发现版本冲突（尚未下载任何文件）：[/yellow]")
+    for conflict in conflicts:
+        installed = f"，已安装 {conflict['installed']}" if conflict["installed"] else ""
+        console.print(f"[blue]- {conflict['requirement']}[/blue]（将安装 {conflict['version']}{installed}）")
+        for source, requirement in conflict["violated"]:
+            console.print(f"    [red]与 {source} 冲突（{requirement}）[/red]")
+        if not conflict["violated"]:
+            console.print(f"    [yellow]会降级 {len(conflict['dependents'])} 个包共用的库：{', '.join(conflict['dependents'][:5])}[/yellow]")
+        console.print(f"    [green]💡 建议放宽为: {conflict['relaxed']}[/green]")
+    console.print(f"[yellow]💡 如果必须使用指定版本，建议为该脚本单独创建虚拟环境（如 python -m venv 脚本名_env），避免影响 {VENV_DIR} 中的其他工具[/yellow]")
+
+def precheck_pins(required_libs, interactive=False):
+    """安装前的离线冲突检查；返回调整后的依赖列表，用户取消安装时返回None"""
+    try:
+        conflicts = find_pin_conflicts(required_libs)
+    except Exception as e:
+        console.print(f"[yellow]⚠️ 版本冲突检查出错，跳过: {str(e)}[/yellow]")
+        return list(required_libs)
+    if not conflicts:
+        return list(required_libs)
+    report_pin_conflicts(conflicts)
+    choice = "1"
+    if interactive:
+        choice = input("\n1 放宽版本要求（推荐）  2 仍按指定版本安装  3 取消安装\n请选择（回车默认1）: ").strip() or "1"
+    else:
+        console.print("[yellow]已自动放宽冲突的版本要求，避免改动共享环境[/yellow]")
+    if choice == "2":
+        return list(required_libs)
+    if choice == "3":
+        console.print("[yellow]已取消安装[/yellow]")
+        return None
+    relaxed = {conflict["requirement"]: conflict["relaxed"] for conflict in conflicts}
+    adjusted = [relaxed.get(lib, lib) for lib in required_libs]
+    return missing_dependencies(list(dict.fromkeys(adjusted)), verbose=False)
+
+def lock_path_for(filename):
+    return os.path.splitext(filename)[0] + LOCK_SUFFIX
+
+def _code_hash(code_content):
+    import hashlib
+    return hashlib.sha256(code_content.encode("utf-8")).hexdigest()
+
+def write_script_lock(filename, code_content, required_libs=None):
+    """依赖就绪后，在脚本旁写入锁文件"""
+    try:
+        if required_libs is None:
+            required_libs = extract_imports(code_content, verbose=False)
+        distributions = read_venv_distributions()
+        locked, unresolved = resolve_installed_closure(required_libs, distributions)
+        data = {
+            "script": os.path.basename(filename),
+            "script_sha256": _code_hash(code_content),
+            "env_hash": venv_fingerprint(locked, distributions),
+            "requested": sorted(required_libs),
+            "distributions": dict(sorted(locked.items(), key=lambda item: item[0].lower())),
+            "unresolved": unresolved,
+            "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        with open(lock_path_for(filename), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        return data
+    except Exception as e:
+        console.print(f"[yellow]⚠️ 写入锁文件失败: {str(e)}[/yellow]")
+        return None
+
+def load_script_lock(filename, code_content):
+    """读取与脚本内容匹配的锁文件；脚本修改过或锁文件损坏时返回None"""
+    path = lock_path_for(filename)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if data.get("script_sha256") != _code_hash(code_content):
+        return None
+    return data
+
+def pip_install_exact(specs, quiet=False, python_path=None):
+    """一次性安装指定版本的包（--no-deps，不再解析依赖）；优先使用本地wheel缓存离线安装"""
+    default_env = python_path is None
+    python_path = python_path or setup_virtual_env()
+    base_cmd = [python_path, "-m", "pip", "install", "--no-deps", "--disable-pip-version-check"] + list(specs)
+    attempts = []
+    if os.path.isdir(WHEEL_CACHE_DIR):
+        attempts.append(["--no-index", "--find-links", WHEEL_CACHE_DIR])
+    attempts.append(["--prefer-binary", "-i", "https://mirrors.aliyun.com/pypi/simple/"])
+    attempts.append(["--prefer-binary", "-i", "https://pypi.org/simple/"])
+    for extra in attempts:
+        cmd = base_cmd + extra
+        if os.path.isdir(WHEEL_CACHE_DIR) and "--no-index" not in extra:
+            cmd += ["--find-links", WHEEL_CACHE_DIR]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                encoding="utf-8", errors="replace")
+        if result.returncode == 0:
+            if default_env:
+                mark_venv_changed()
+            return True
+        if not quiet:
+            last_error = (result.stderr.strip().splitlines() or [""])[-1]
+            source = "本地wheel缓存" if "--no-index" in extra else extra[-1]
+            console.print(f"[yellow]从 {source} 安装失败: {last_error}[/yellow]")
+    return False
+
+def other_lock_pins(filename):
+    """收集同目录及代码库中其他脚本锁文件锁定的版本 {规范化包名: {版本: [脚本名]}}"""
+    own = os.path.abspath(lock_path_for(filename))
+    pins = {}
+    for folder in dict.fromkeys([os.path.dirname(os.path.abspath(filename)), os.path.abspath(CODE_DIR)]):
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if not name.endswith(LOCK_SUFFIX) or path == own:
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    distributions = json.load(f).get("distributions", {})
+            except (OSError, json.JSONDecodeError, AttributeError):
+                continue
+            for dist_name, version in distributions.items():
+                pins.setdefault(normalize_dist_name(dist_name), {}).setdefault(version, []).append(name[:-len(LOCK_SUFFIX)])
+    return pins
+
+def sync_script_lock(filename, code_content):
+    """按锁文件准备依赖：锁定包的版本都未变时直接跳过分析；有变化时在不破坏其他包和其他锁文件的前提下
+    精确安装锁定的版本。返回True表示依赖已就绪，False表示需要走常规依赖分析"""
+    lock = load_script_lock(filename, code_content)
+    if not lock:
+        return False
+    if lock.get("unresolved"):
+        # 锁文件生成时就有找不到的依赖，只按锁文件安装会漏装，交给常规分析
+        return False
+    if lock.get("env_hash") == venv_fingerprint(lock["distributions"]):
+        console.print("[green]✓ 锁文件与当前环境一致，跳过依赖分析[/green]")
+        return True
+    def missing_specs():
+        installed = {key: dist["version"] for key, dist in read_venv_distributions().items()}
+        return [f"{name}=={version}" for name, version in lock["distributions"].items()
+                if installed.get(normalize_dist_name(name)) != version]
+
+    specs = missing_specs()
+    if specs:
+        with install_lock.hold(specs):
+            if install_lock.waited:
+                specs = missing_specs()
+            if specs and not lock_specs_safe(filename, specs):
+                return False
+            if specs:
+                console.print(f"\n[yellow]环境已变化，正在按锁文件安装 {len(specs)} 个包...[/yellow]")
+            ok = pip_install_exact(specs) if specs else True
+        if not ok:
+            console.print("[red]❌ 按锁文件安装失败，改为重新分析依赖[/red]")
+            return False
+    console.print("[green]✓ 已按锁文件恢复依赖[/green]")
+    lock["env_hash"] = venv_fingerprint(lock["distributions"])
+    try:
+        with open(lock_path_for(filename), "w", encoding="utf-8") as f:
+            json.dump(lock, f, ensure_ascii=False, indent=2)
+    except OSError:
+        pass
+    return True
+
+def lock_specs_safe(filename, specs):
+    """精确安装（--no-deps）前的检查：不违反已安装包的依赖声明，也不改动其他锁文件正在使用的版本"""
+    installed = read_venv_distributions()
+    pins = other_lock_pins(filename)
+    for spec in specs:
+        name, _, version = spec.partition("==")
+        key = normalize_dist_name(name)
+        current = installed.get(key)
+        users = pins.get(key, {}).get(current["version"], []) if current else []
+        if users:
+            console.print(f"[yellow]⚠️ 锁定的 {spec} 会改动 {', '.join(users[:3])} 正在使用的 {name} {current['version']}，改为重新分析依赖[/yellow]")
+            return False
+    try:
+        conflicts = find_pin_conflicts(specs)
+    except Exception as e:
+        console.print(f"[yellow]⚠️ 版本冲突检查出错，改为重新分析依赖: {str(e)}[/yellow]")
+        return False
+    if conflicts:
+        report_pin_conflicts(conflicts)
+        console.print("[yellow]锁定的版本与共享环境冲突，改为重新分析依赖[/yellow]")
+        return False
+    return True
+
+# ----------------------------
+# 启动前预检：语法编译 + 导入冒烟测试
+# ----------------------------
+# 在虚拟环境中运行的导入检查进程：提前启动后等待读入一个JSON请求，返回各模块的导入结果
+PREFLIGHT_WORKER_SOURCE = r'''
+import importlib, json, os, sys, traceback
+proto = os.fdopen(os.dup(1), "w", encoding="utf-8")
+os.dup2(2, 1)
+sys.stdout = sys.stderr
+for line in sys.stdin:
+    request = json.loads(line)
+    importlib.invalidate_caches()
+    results = {}
+    for name in request["modules"]:
+        try:
+            importlib.import_module(name)
+            results[name] = None
+        except BaseException as e:
+            kind = "missing" if isinstance(e, ImportError) else "error"
+            results[name] = [kind, f"{type(e).__name__}: {e}"]
+    proto.write(json.dumps(results) + "\n")
+    proto.flush()
+'''
+
+def extract_import_names(code_content):
+    """提取代码中导入的顶层第三方模块名（导入名，而不是pip包名）"""
+    names = set()
+    try:
+        tree = ast.parse(code_content)
+    except SyntaxError:
+        return names
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                names.add(alias.name.split('.')[0])
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            names.add(node.module.split('.')[0])
+    return {name for name in names if name not in STANDARD_LIBS and name != "__future__"}
+
+OPTIONAL_IMPORT_ERRORS = {"ImportError", "ModuleNotFoundError", "Exception", "BaseException"}
+PLATFORM_TEST_NAMES = {"platform", "name", "system", "win32_ver", "mac_ver"}
+
+def _catches_import_error(handler):
+    """except子句是否会捕获ImportError（含裸except）"""
+    if handler.type is None:
+        return True
+    types = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+    return any((getattr(t, "id", None) or getattr(t, "attr", None)) in OPTIONAL_IMPORT_ERRORS for t in types)
+
+def _is_platform_test(test):
+    """if条件是否在判断操作系统（sys.platform、os.name、platform.system()等）"""
+    return any(isinstance(node, ast.Attribute) and node.attr in PLATFORM_TEST_NAMES
+               and isinstance(node.value, ast.Name) and node.value.id in ("sys", "os", "platform")
+               for node in ast.walk(test))
+
+def classify_import_names(code_content, script_dir=None):
+    """把第三方导入分为必需和可选：try/except ImportError 中的导入、按操作系统判断的导入属于可选；
+    与脚本同目录的本地模块不计入。返回 (必需模块名集合, 可选模块名集合)"""
+    required, optional = set(), set()
+    try:
+        tree = ast.parse(code_content)
+    except SyntaxError:
+        return required, optional
+
+    def visit(node, guarded):
+        if isinstance(node, ast.Try):
+            body_guarded = guarded or any(_catches_import_error(handler) for handler in node.handlers)
+            for child in node.body:
+                visit(child, body_guarded)
+            for child in node.handlers + node.orelse + node.finalbody:
+                visit(child, guarded)
+            return
+        if isinstance(node, ast.If) and _is_platform_test(node.test):
+            guarded = True
+        names = []
+        if isinstance(node, ast.Import):
+            names = [alias.name.split(".")[0] for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            names = [node.module.split(".")[0]]
+        for name in names:
+            (optional if guarded else required).add(name)
+        for child in ast.iter_child_nodes(node):
+            visit(child, guarded)
+
+    visit(tree, False)
+
+    def third_party(name):
+        if name in STANDARD_LIBS or name == "__future__":
+            return False
+        if script_dir and (os.path.exists(os.path.join(script_dir, name + ".py"))
+                           or os.path.isdir(os.path.join(script_dir, name))):
+            return False
+        return True
+
+    required = {name for name in required if third_party(name)}
+    optional = {name for name in optional if third_party(name)} - required
+    return required, optional
+
+class PreflightWorker:
+    """导入检查进程：提前启动以省去解释器启动时间；每个进程只做一次检查，
+    检查后即退出，避免已导入的模块（升级或清理后的旧版本、torch等大模块）留在内存中"""
+    def __init__(self):
+        self.proc = None
+        self.responses = None
+        self.generation = None
+        self.lock = Lock()
+
+    def _ensure_started(self):
+        if self.proc and self.proc.poll() is None and self.generation == venv_generation:
+            return
+        self.stop()
+        self.generation = venv_generation
+        python_path = setup_virtual_env()
+        env = os.environ.copy()
+        env["PYTHONIOENCODING"] = "utf-8"
+        self.proc = subprocess.Popen(
+            [python_path, "-u", "-c", PREFLIGHT_WORKER_SOURCE],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=env,
+            text=True,
+            encoding="utf-8",
+        )
+        self.responses = queue.Queue()
+        Thread(target=self._read_responses, args=(self.proc, self.responses), daemon=True).start()
+
+    @staticmethod
+    def _read_responses(proc, responses):
+        for line in proc.stdout:
+            responses.put(line)
+        responses.put(None)
+
+    def warm_up(self):
+        """提前启动检查进程（可在保存代码的同时进行）"""
+        with self.lock:
+            self._ensure_started()
+
+    def check_imports(self, modules, timeout=PREFLIGHT_TIMEOUT):
+        """在虚拟环境中导入各模块；返回 {模块名: None 或 [类型, 错误信息]}"""
+        if not modules:
+            return {}
+        with self.lock:
+            self._ensure_started()
+            try:
+                self.proc.stdin.write(json.dumps({"modules": sorted(modules)}) + "\n")
+                self.proc.stdin.flush()
+                line = self.responses.get(timeout=timeout)
+            except queue.Empty:
+                self.stop()
+                return {name: ["error", f"导入超时（{timeout:.0f}秒）"] for name in modules}
+            except (OSError, ValueError):
+                line = None
+            self.stop()
+            if line is None:
+                return {name: ["error", "检查进程意外退出"] for name in modules}
+            return json.loads(line)
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+        self.proc = None
+
+preflight_worker = PreflightWorker()
+
+def compile_check(code_content, filename="<generated>"):
+    """字节编译代码，返回语法错误描述或None"""
+    try:
+        compile(code_content, filename, "exec", dont_inherit=True)
+        return None
+    except SyntaxError as e:
+        source_line = (e.text or "").rstrip()
+        return f"第 {e.lineno} 行: {e.msg}" + (f"\n    {source_line}" if source_line else "")
+    except ValueError as e:
+        return str(e)
+
+class Preflight:
+    """启动前预检：语法编译在后台线程中与保存、依赖分析并行进行"""
+    def __init__(self, code_content, script_dir=CODE_DIR):
+        self.code_content = code_content
+        self.script_dir = script_dir
+        self.syntax_error = None
+        self.thread = Thread(target=self._run_compile, daemon=True)
+
+    def start(self):
+        if PREFLIGHT_ENABLED:
+            self.thread.start()
+        return self
+
+    def _run_compile(self):
+        self.syntax_error = compile_check(self.code_content)
+        if not self.syntax_error:
+            try:
+                preflight_worker.warm_up()
+            except Exception:
+                pass
+
+    def check_syntax(self):
+        """等待编译结果，语法错误时输出报告并返回False"""
+        if not PREFLIGHT_ENABLED:
+            return True
+        self.thread.join()
+        if self.syntax_error:
+            console.print(Panel(
+                f"[red]语法错误，已取消依赖安装和运行[/red]\n{self.syntax_error}",
+                title="[bold red]预检失败[/bold red]", expand=False
+            ))
+            return False
+        return True
+
+    def check_imports(self):
+        """在虚拟环境中导入所有第三方模块；必需的模块缺失时输出报告并返回False，可选的模块缺失只提示"""
+        if not PREFLIGHT_ENABLED:
+            return True
+        self.thread.join()
+        required, optional = classify_import_names(self.code_content, self.script_dir)
+        modules = required | optional
+        if not modules:
+            return True
+        results = preflight_worker.check_imports(modules)
+        missing = {name: info[1] for name, info in results.items() if info and info[0] == "missing" and name in required}
+        errors = {name: info[1] for name, info in results.items() if info and name not in missing}
+        for name, message in errors.items():
+            # 可选导入缺失、导入时出现的其它错误（如无图形界面）不一定影响运行，只做提示
+            if name in optional and results[name][0] == "missing":
+                console.print(f"[yellow]⚠️ 预检：可选模块 {name} 不可用（脚本对它做了兼容处理或只在特定系统上使用）[/yellow]")
+            else:
+                console.print(f"[yellow]⚠️ 预检：导入 {name} 时出现异常: {message}[/yellow]")
+        if missing:
+            lines = "\n".join(f"- {name}: {message}" for name, message in missing.items())
+            console.print(Panel(
+                f"[red]以下模块无法导入，已取消运行（请检查模块名是否拼写正确或依赖是否安装成功）[/red]\n{lines}",
+                title="[bold red]预检失败[/bold red]", expand=False
+            ))
+            return False
+        console.print(f"[green]✓ 预检通过（{len(modules) - len(errors)}/{len(modules)} 个第三方模块导入正常）[/green]")
+        return True
+
+# ----------------------------
+# 性能检查：保存生成代码前用AST检查常见的慢写法，人为延时可自动去掉
+# ----------------------------
+PERF_LINT_LABELS = {
+    "sleep": "人为延时",
+    "str_concat": "循环中拼接字符串",
+    "open_in_loop": "循环中反复打开同一文件",
+    "iterrows": "pandas逐行遍历",
+    "df_append": "pandas循环中追加行",
+}
+# 导入了这些模块时，延时多半用于轮询、限速或动画，不自动去掉
+SLEEP_LEGIT_MODULES = {
+    "requests", "urllib", "http", "socket", "selenium", "pyautogui", "pynput", "keyboard", "mouse", "serial",
+    "pygame", "turtle", "asyncio", "threading", "schedule", "smtplib", "aiohttp", "httpx", "playwright",
+    "tkinter", "subprocess", "multiprocessing", "psutil", "ctypes", "webbrowser", "pywinauto", "uiautomation",
+    "pythoncom", "comtypes", "wx", "PyQt5", "PyQt6", "PySide2", "PySide6", "kivy", "cv2", "pyperclip", "signal",
+}
+# 调用了这些函数时，延时多半是在等待外部程序
+SLEEP_LEGIT_CALLS = {("os", "startfile"), ("os", "system"), ("os", "popen"), ("os", "kill")}
+# 延时前后只有这些调用时，才认为延时只是为了"显示进度"
+PROGRESS_CALLS = {"print", "update", "write", "flush", "set_description", "set_postfix", "refresh"}
+
+def _assigned_names(nodes):
+    """一组语句中被赋值的变量名（循环中会变化的变量）"""
+    names = set()
+    for node in nodes:
+        for child in ast.walk(node):
+            if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Store):
+                names.add(child.id)
+    return names
+
+class PerfLinter(ast.NodeVisitor):
+    """遍历AST，记录人为延时、循环中拼接字符串、循环中反复打开同一文件、pandas逐行处理"""
+    def __init__(self, tree):
+        self.findings = []
+        self.loops = []  # [(循环节点, 循环中会变化的变量名)]
+        self.modules = set()
+        self.sleep_names = set()
+        self.str_vars = set()
+        self.siblings = {}
+        self.external_calls = False
+        for node in ast.walk(tree):
+            for field in ("body", "orelse", "finalbody"):
+                statements = getattr(node, field, None)
+                if isinstance(statements, list):
+                    for statement in statements:
+                        self.siblings[id(statement)] = statements
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name) \
+                    and (node.func.value.id, node.func.attr) in SLEEP_LEGIT_CALLS:
+                self.external_calls = True
+            if isinstance(node, ast.Import):
+                self.modules.update(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                self.modules.add(node.module.split(".")[0])
+                if node.module == "time":
+                    self.sleep_names.update(alias.asname or alias.name for alias in node.names if alias.name == "sleep")
+            elif isinstance(node, ast.Assign) and isinstance(node.value, (ast.JoinedStr, ast.Constant)) \
+                    and isinstance(getattr(node.value, "value", ""), str):
+                self.str_vars.update(target.id for target in node.targets if isinstance(target, ast.Name))
+
+    def add(self, kind, node, message, fixable=False):
+        self.findings.append({"kind": kind, "line": node.lineno, "message": message, "fixable": fixable, "node": node})
+
+    def _visit_scope(self, node):
+        # 函数体不属于外层循环
+        saved, self.loops = self.loops, []
+        self.generic_visit(node)
+        self.loops = saved
+
+    visit_FunctionDef = visit_AsyncFunctionDef = visit_Lambda = _visit_scope
+
+    def visit_For(self, node):
+        self.visit(node.iter)
+        self.loops.append((node, _assigned_names([node.target] + node.body)))
+        for child in node.body:
+            self.visit(child)
+        self.loops.pop()
+        for child in node.orelse:
+            self.visit(child)
+
+    visit_AsyncFor = visit_For
+
+    def visit_While(self, node):
+        self.loops.append((node, _assigned_names(node.body)))
+        self.visit(node.test)
+        for child in node.body:
+            self.visit(child)
+        self.loops.pop()
+        for child in node.orelse:
+            self.visit(child)
+
+    def _is_sleep(self, call):
+        func = call.func
+        if isinstance(func, ast.Attribute):
+            return func.attr == "sleep" and isinstance(func.value, ast.Name) and func.value.id == "time"
+        return isinstance(func, ast.Name) and func.id in self.sleep_names
+
+    def _only_progress(self, node):
+        """同一层语句中只有进度输出（print、进度条更新）和延时本身"""
+        for statement in self.siblings.get(id(node), [node]):
+            if not (isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Call)):
+                return False
+            call = statement.value
+            name = call.func.attr if isinstance(call.func, ast.Attribute) else getattr(call.func, "id", None)
+            if name not in PROGRESS_CALLS and not self._is_sleep(call):
+                return False
+        return True
+
+    def _waits_for_something(self):
+        """脚本在操作窗口、外部程序或网络，延时可能是在等待它们"""
+        return (self.external_calls or bool(self.modules & SLEEP_LEGIT_MODULES)
+                or any(module.startswith(("win32", "pywin")) for module in self.modules))
+
+    def visit_Expr(self, node):
+        if isinstance(node.value, ast.Call) and self._is_sleep(node.value):
+            args = node.value.args
+            seconds = args[0].value if args and isinstance(args[0], ast.Constant) else None
+            polling = any(isinstance(loop, ast.While) for loop, _ in self.loops)
+            fixable = (isinstance(seconds, (int, float)) and seconds <= PERF_SLEEP_MAX and not polling
+                       and self._only_progress(node) and not self._waits_for_something())
+            if fixable:
+                self.add("sleep", node, f"time.sleep({seconds}) 只配合进度输出，属于人为等待，拖慢了实际处理", fixable=True)
+            elif self.loops:
+                self.add("sleep", node, "循环中的延时会累加，请确认是否确实需要（轮询/限速）")
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        if self.loops and isinstance(node.op, ast.Add) and isinstance(node.target, ast.Name):
+            value = node.value
+            stringy = (
+                node.target.id in self.str_vars
+                or isinstance(value, ast.JoinedStr)
+                or (isinstance(value, ast.Constant) and isinstance(value.value, str))
+                or (isinstance(value, ast.Call) and isinstance(value.func, ast.Name) and value.func.id == "str")
+            )
+            if stringy:
+                self.add("str_concat", node, f"{node.target.id} += ... 在循环中反复复制字符串，建议放入列表后 \"\".join()")
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        func = node.func
+        if self.loops and isinstance(func, ast.Name) and func.id == "open" and node.args:
+            varying = set().union(*(names for _, names in self.loops))
+            used = {child.id for arg in node.args[:1] for child in ast.walk(arg) if isinstance(child, ast.Name)}
+            if not used & varying:
+                self.add("open_in_loop", node, "循环中每次都打开同一个文件，建议在循环外打开一次")
+        if isinstance(func, ast.Attribute) and func.attr == "iterrows":
+            self.add("iterrows", node, "iterrows() 逐行处理很慢，建议用向量化操作或 itertuples()")
+        self.generic_visit(node)
+
+    def visit_Assign(self, node):
+        if self.loops and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name) and isinstance(node.value, ast.Call):
+            name = node.targets[0].id
+            func = node.value.func
+            appends = isinstance(func, ast.Attribute) and func.attr == "append" and isinstance(func.value, ast.Name) and func.value.id == name
+            concats = (isinstance(func, ast.Attribute) and func.attr == "concat" and node.value.args
+                       and isinstance(node.value.args[0], (ast.List, ast.Tuple))
+                       and any(isinstance(item, ast.Name) and item.id == name for item in node.value.args[0].elts))
+            if appends or concats:
+                self.add("df_append", node, f"循环中 {name} = {name}.append/concat(...) 每次都复制整个表，建议先收集到列表再一次性创建DataFrame")
+        self.generic_visit(node)
+
+def _remove_sleeps(code_content, findings):
+    """把可去掉的延时语句替换为pass（保留原语句作为注释），返回新代码；无法安全替换的保持不变"""
+    lines = code_content.splitlines(keepends=True)
+    fixed = []
+    for finding in sorted(findings, key=lambda item: item["line"], reverse=True):
+        node = finding["node"]
+        end_line, end_col = getattr(node, "end_lineno", None), getattr(node, "end_col_offset", None)
+        if not finding["fixable"] or end_line != node.lineno:
+            continue
+        line = lines[node.lineno - 1]
+        # 按字符计算的偏移量（AST给出的是UTF-8字节偏移）
+        raw = line.encode("utf-8")
+        before = raw[:node.col_offset].decode("utf-8")
+        statement = raw[node.col_offset:end_col].decode("utf-8")
+        rest = raw[end_col:].decode("utf-8")
+        if rest.strip() and not rest.strip().startswith("#"):
+            continue
+        newline = "\n" if line.endswith("\n") else ""
+        lines[node.lineno - 1] = f"{before}pass  # 性能检查：已去掉人为延时 {statement}{newline}"
+        fixed.append(finding)
+    new_code = "".join(lines)
+    try:
+        ast.parse(new_code)
+    except SyntaxError:
+        return code_content, []
+    return new_code, fixed
+
+def perf_lint(code_content, fix=None):
+    """检查生成代码中的常见慢写法，fix为True时去掉人为延时。返回 (代码, 检查结果列表)"""
+    if fix is None:
+        fix = PERF_LINT_FIX
+    try:
+        tree = ast.parse(code_content)
+    except SyntaxError:
+        return code_content, []
+    linter = PerfLinter(tree)
+    linter.visit(tree)
+    findings = sorted(linter.findings, key=lambda item: item["line"])
+    fixed = []
+    if fix:
+        code_content, fixed = _remove_sleeps(code_content, findings)
+    fixed_ids = {id(item) for item in fixed}
+    for finding in findings:
+        finding["fixed"] = id(finding) in fixed_ids
+        del finding["node"]
+    return code_content, findings
+
+def report_perf_lint(findings):
+    if not findings:
+        return
+    console.print("\n[yellow]⚡ 性能检查：[/yellow]")
+    for finding in findings:
+        if finding["fixed"]:
+            console.print(f"[green]  第{finding['line']}行 已去掉人为延时[/green]")
+        else:
+            console.print(f"[yellow]  第{finding['line']}行 {PERF_LINT_LABELS[finding['kind']]}：{finding['message']}[/yellow]")
+
+def perf_lint_counts(findings):
+    counts = {}
+    for finding in findings:
+        counts[finding["kind"]] = counts.get(finding["kind"], 0) + 1
+    return counts
+
+_perf_lint_lock = Lock()
+
+def record_perf_lint(filename, findings):
+    """按脚本记录各类问题的数量（perf_lint.json）"""
+    with _perf_lint_lock:
+        try:
+            with open(PERF_LINT_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            data = {}
+        data[os.path.basename(filename)] = {
+            "counts": perf_lint_counts(findings),
+            "fixed": sum(1 for finding in findings if finding["fixed"]),
+            "checked": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        try:
+            with open(PERF_LINT_FILE, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+        except OSError:
+            pass
+
+def save_code_file(code_content, suggested_filename=None, unique=False):
+    """将代码写入代码工具库，返回文件路径；unique为True时不覆盖已有文件"""
+    code_dir = CODE_DIR
+    os.makedirs(code_dir, exist_ok=True)
+    if suggested_filename:
+        if not suggested_filename.endswith('.py'):
+            suggested_filename += '.py'
+        filename = os.path.join(code_dir, suggested_filename)
+    else:
+        filename = os.path.join(code_dir, f"generated_{datetime.now().strftime('%Y%m%d%H%M%S')}.py")
+    if unique:
+        base, ext = os.path.splitext(filename)
+        counter = 1
+        while True:
+            try:
+                # 以独占方式创建，避免并发保存时互相覆盖
+                with open(filename, "x", encoding="utf-8") as f:
+                    f.write(code_content)
+                return filename
+            except FileExistsError:
+                filename = f"{base}_{counter}{ext}"
+                counter += 1
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(code_content)
+    return filename
+
+def save_and_execute_code(code_content, execute=True):
+    """保存并执行代码"""
+    try:
+        if isinstance(code_content, tuple):
+            code_content, suggested_filename = code_content
+        else:
+            suggested_filename = None
+
+        code_content, perf_findings = perf_lint(code_content)
+        report_perf_lint(perf_findings)
+        # 预检与保存同时进行
+        preflight = Preflight(code_content).start()
+        filename = save_code_file(code_content, suggested_filename)
+        record_perf_lint(filename, perf_findings)
+        abs_path = os.path.abspath(filename)
+        console.print(f"\n[blue]💾 代码保存路径: [cyan]{abs_path}[/cyan][/blue]")
+        if not preflight.check_syntax():
+            return True
+
+        needs_system_deps = check_system_dependencies(code_content)
+        if needs_system_deps:
+            console.print("\n[yellow]⚠️ 检测到此代码需要额外的系统级依赖[/yellow]")
+            console.print("[yellow]请按以下步骤操作：[/yellow]")
+            console.print("1. 先安装代码注释中提到的系统级依赖")
+            console.print("2. 关闭当前终端")
+            console.print("3. 重新运行本程序")
+            required_libs = missing_dependencies(extract_imports(code_content))
+            if required_libs:
+                save_pending_dependencies(filename, required_libs, hold_until_restart=True)
+            return True
+
+        all_libs = extract_imports(code_content)
+        required_libs = missing_dependencies(all_libs)
+        if required_libs and not install_dependencies(required_libs, interactive=True):
+            console.print("\n[red]⚠️ 部分依赖安装失败,代码可能无法正常运行[/red]")
+            save_pending_dependencies(filename, required_libs)
+            return True
+        write_script_lock(filename, code_content, all_libs)
+
+        if execute:
+            if not preflight.check_imports():
+                return True
+            launch_script(filename)
+            return True
+        else:
+            return True
+    except Exception as e:
+        console.print(f"\n[red]⚠️ 异常: {str(e)}[/red]")
+        return False
+
+# ----------------------------
+# 对冲请求：主服务商迟迟没有首个token时，同时向备用服务商发出请求，先出内容者胜出
+# ----------------------------
+TTFT_STATS_FILE = "ttft_stats.json"
+TTFT_BUCKETS = [0.5, 1, 2, 3, 5, 8, 13, 21, 34]  # 首token耗时直方图的分桶上限（秒），最后一桶为超过34秒
+HEDGE_MIN_SAMPLES = 20
+HEDGE_THRESHOLD_RANGE = (1.0, 15.0)
+
+def chunk_has_content(chunk):
+    """流式分片中是否有正文或思考内容"""
+    if not chunk.choices:
+        return False
+    delta = chunk.choices[0].delta
+    return bool(delta.content or getattr(delta, "reasoning_content", None))
+
+class TTFTStats:
+    """按服务商记录首token耗时直方图，保存在ttft_stats.json"""
+    def __init__(self, path=TTFT_STATS_FILE):
+        self.path = path
+        self.lock = Lock()
+        self.data = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.data = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self.data = {}
+
+    def record(self, provider, seconds, censored=False):
+        """记录一次首token耗时；censored表示请求在出内容前被取消，实际耗时至少为seconds"""
+        with self.lock:
+            entry = self.data.setdefault(provider, {"counts": [0] * (len(TTFT_BUCKETS) + 1), "count": 0, "sum": 0.0})
+            index = next((i for i, edge in enumerate(TTFT_BUCKETS) if seconds <= edge), len(TTFT_BUCKETS))
+            entry["counts"][index] += 1
+            entry["count"] += 1
+            entry["sum"] += seconds
+            if censored:
+                entry["censored"] = entry.get("censored", 0) + 1
+            try:
+                with open(self.path, "w", encoding="utf-8") as f:
+                    json.dump(self.data, f)
+            except OSError:
+                pass
+
+    def percentile(self, provider, q):
+        """按直方图估算分位数（取所在分桶的上限），样本不足返回None"""
+        entry = self.data.get(provider)
+        if not entry or entry["count"] < HEDGE_MIN_SAMPLES:
+            return None
+        target = q * entry["count"]
+        cumulative = 0
+        for index, count in enumerate(entry["counts"]):
+            cumulative += count
+            if cumulative >= target:
+                return TTFT_BUCKETS[index] if index < len(TTFT_BUCKETS) else TTFT_BUCKETS[-1] * 2
+        return TTFT_BUCKETS[-1] * 2
+
+    def summary(self, provider):
+        """返回 (样本数, 平均值, 中位数, P90)"""
+        entry = self.data.get(provider)
+        if not entry or not entry["count"]:
+            return None
+        return entry["count"], entry["sum"] / entry["count"], self._raw_percentile(entry, 0.5), self._raw_percentile(entry, 0.9)
+
+    def _raw_percentile(self, entry, q):
+        cumulative = 0
+        for index, count in enumerate(entry["counts"]):
+            cumulative += count
+            if cumulative >= q * entry["count"]:
+                return TTFT_BUCKETS[index] if index < len(TTFT_BUCKETS) else TTFT_BUCKETS[-1] * 2
+        return TTFT_BUCKETS[-1] * 2
+
+ttft_stats = TTFTStats()
+
+def hedge_threshold(provider="deepseek"):
+    """对冲阈值：样本足够时取主服务商首token耗时的分位数，否则用配置值"""
+    observed = ttft_stats.percentile(provider, HEDGE_PERCENTILE)
+    if observed is None:
+        return HEDGE_TTFT_THRESHOLD
+    low, high = HEDGE_THRESHOLD_RANGE
+    return min(max(observed, low), high)
+
+def hedge_available(model):
+    """当前是否可以对冲该请求"""
+    return (
+        hedge_enabled and current_client_type == DEEPSEEK_CLIENT and qwen_client is not None
+        and model in HEDGE_MODELS
+    )
+
+class HedgedStream:
+    """依次启动各服务商的流式请求：前一个超过阈值仍无内容（或出错）时启动下一个，
+    第一个输出内容的请求胜出，其余请求取消。可像普通流一样迭代分片"""
+    def __init__(self, attempts, threshold, **request_kwargs):
+        self.attempts = attempts  # [(服务商, 客户端, 模型), ...]
+        self.threshold = threshold
+        self.request_kwargs = request_kwargs
+        self.events = queue.Queue()
+        self.cancel_events = [Event() for _ in attempts]
+        self.start_times = {}
+        self.got_content = set()
+        self.streams = {}
+        self.provider = None
+        self.queue_wait = 0.0
+
+    def _run(self, index):
+        provider, api_client, model = self.attempts[index]
+        governor = api_governors[provider]
+        ticket = governor.acquire(estimate_request_tokens(self.request_kwargs["messages"]))
+        self.queue_wait += ticket["waited"]
+        start_time = time.time()
+        self.start_times[index] = start_time
+        got_content = False
+        usage = None
+        try:
+            stream = api_client.chat.completions.create(model=model, stream=True, **self.request_kwargs)
+            self.streams[index] = stream
+            for chunk in stream:
+                if self.cancel_events[index].is_set():
+                    break
+                if chunk.usage:
+                    usage = chunk.usage
+                if not got_content and chunk_has_content(chunk):
+                    got_content = True
+                    self.got_content.add(index)
+                    ttft_stats.record(provider, time.time() - start_time)
+                self.events.put((index, "chunk", chunk))
+            governor.record_success()
+            self.events.put((index, "done", None))
+        except Exception as e:
+            if is_throttled(e):
+                governor.penalize(retry_after_seconds(e))
+            if not self.cancel_events[index].is_set():
+                self.events.put((index, "error", e))
+        finally:
+            governor.release(ticket, usage)
+
+    def _start(self, index):
+        Thread(target=self._run, args=(index,), daemon=True).start()
+
+    def _cancel(self, index):
+        if self.cancel_events[index].is_set():
+            return
+        self.cancel_events[index].set()
+        # 落败的请求还没出内容就被取消：按已等待的时间记为删失样本，避免阈值只根据较快的请求一路走低
+        if index in self.start_times and index not in self.got_content:
+            ttft_stats.record(self.attempts[index][0], time.time() - self.start_times[index], censored=True)
+        stream = self.streams.get(index)
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def __iter__(self):
+        buffers = [[] for _ in self.attempts]
+        errors = {}
+        self._start(0)
+        started = 1
+        deadline = time.time() + self.threshold
+        winner = None
+        try:
+            while winner is None:
+                timeout = max(deadline - time.time(), 0) if started < len(self.attempts) else None
+                try:
+                    index, kind, payload = self.events.get(timeout=timeout)
+                except queue.Empty:
+                    self._start(started)
+                    started += 1
+                    deadline = time.time() + self.threshold
+                    continue
+                if kind == "chunk":
+                    buffers[index].append(payload)
+                    if chunk_has_content(payload):
+                        winner = index
+                elif kind == "done":
+                    winner = index
+                else:
+                    errors[index] = payload
+                    if started < len(self.attempts):
+                        self._start(started)
+                        started += 1
+                        deadline = time.time() + self.threshold
+                    elif len(errors) == started:
+                        raise errors[0] if 0 in errors else payload
+            for index in range(started):
+                if index != winner:
+                    self._cancel(index)
+            self.provider = self.attempts[winner][0]
+            yield from buffers[winner]
+            while True:
+                index, kind, payload = self.events.get()
+                if index != winner:
+                    continue
+                if kind == "chunk":
+                    yield payload
+                elif kind == "done":
+                    return
+                else:
+                    raise payload
+        finally:
+            for index in range(started):
+                self._cancel(index)
+
+# ----------------------------
+# 流式请求的容错：超时、退避、熔断、续写
+# ----------------------------
+# 流式读取中断时httpx的异常不会被openai包装，一并作为可重试错误
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError, httpx.TransportError)
+
+API_TIMEOUT = httpx.Timeout(connect=API_CONNECT_TIMEOUT, read=API_IDLE_TIMEOUT, write=API_CONNECT_TIMEOUT, pool=API_CONNECT_TIMEOUT)
+
+class CircuitBreaker:
+    """熔断器：连续失败达到阈值后暂停请求一段时间，冷却结束后放行一次试探请求"""
+    def __init__(self, name, failure_threshold=None, cooldown=None):
+        self.name = name
+        self.failure_threshold = failure_threshold or CIRCUIT_FAILURE_THRESHOLD
+        self.cooldown = cooldown or CIRCUIT_COOLDOWN
+        self.failures = 0
+        self.opened_at = None
+        self.lock = Lock()
+
+    def allow(self):
+        """是否允许发出请求"""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.cooldown:
+                # 半开状态：放行一次试探请求，失败则重新计时
+                self.opened_at = time.time()
+                self.failures = self.failure_threshold - 1
+                return True
+            return False
+
+    def remaining(self):
+        """距离冷却结束的秒数"""
+        if self.opened_at is None:
+            return 0
+        return max(self.cooldown - (time.time() - self.opened_at), 0)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+circuit_breakers = {"deepseek": CircuitBreaker("deepseek"), "qwen": CircuitBreaker("qwen")}
+
+# ----------------------------
+# 接口限流：按服务商的令牌桶（每分钟请求数/tokens数）+ 并发上限，遇到429/503自适应降速
+# ----------------------------
+class TokenBucket:
+    """令牌桶：按每分钟速率补充，容量为10秒的额度；单次需求超过容量时允许透支"""
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, per_minute / 6.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now, factor):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate * factor)
+        self.updated = now
+
+    def time_until(self, amount, factor):
+        """还需等待多少秒才有足够额度"""
+        needed = min(amount, self.capacity) - self.tokens
+        return needed / (self.rate * factor) if needed > 0 else 0.0
+
+class ApiGovernor:
+    """包住每一次接口调用：排队等待令牌与并发名额，记录排队耗时；
+    被限流（429/503）时按Retry-After暂停并把速率减半，之后成功一次恢复5%"""
+    def __init__(self, name, rpm, tpm, max_concurrency):
+        self.name = name
+        self.lock = Lock()
+        self.semaphore = BoundedSemaphore(max(1, max_concurrency))
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate_factor = 1.0
+        self.blocked_until = 0.0
+        self.in_flight = 0
+        self.stats = {"requests": 0, "queue_wait": 0.0, "max_wait": 0.0, "throttled": 0, "tokens": 0}
+        self.set_limits(rpm, tpm)
+
+    def set_limits(self, rpm=None, tpm=None):
+        """调整速率限制（0表示不限制）"""
+        with self.lock:
+            if rpm is not None:
+                self.rpm = rpm
+                self.request_bucket = TokenBucket(rpm) if rpm > 0 else None
+            if tpm is not None:
+                self.tpm = tpm
+                self.token_bucket = TokenBucket(tpm) if tpm > 0 else None
+
+    def acquire(self, estimated_tokens):
+        """阻塞直到允许发出请求，返回本次请求的凭据（含排队耗时）"""
+        start = time.monotonic()
+        self.semaphore.acquire()
+        try:
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    wait = max(self.blocked_until - now, 0.0)
+                    if not wait:
+                        demands = [(b, amount) for b, amount in ((self.request_bucket, 1), (self.token_bucket, estimated_tokens)) if b]
+                        for bucket, _ in demands:
+                            bucket.refill(now, self.rate_factor)
+                        wait = max([bucket.time_until(amount, self.rate_factor) for bucket, amount in demands] + [0.0])
+                        if not wait:
+                            for bucket, amount in demands:
+                                bucket.tokens -= amount
+                            self.in_flight += 1
+                            break
+                time.sleep(min(wait, 1.0))
+        except BaseException:
+            self.semaphore.release()
+            raise
+        waited = time.monotonic() - start
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["queue_wait"] += waited
+            self.stats["max_wait"] = max(self.stats["max_wait"], waited)
+        return {"tokens": estimated_tokens, "waited": waited}
+
+    def release(self, ticket, usage=None):
+        """请求结束：按实际用量修正tokens额度，归还并发名额"""
+        with self.lock:
+            self.in_flight -= 1
+            if usage:
+                self.stats["tokens"] += usage.total_tokens
+                if self.token_bucket:
+                    self.token_bucket.tokens += ticket["tokens"] - usage.total_tokens
+        self.semaphore.release()
+
+    def record_success(self):
+        with self.lock:
+            self.rate_factor = min(1.0, self.rate_factor + 0.05)
+
+    def penalize(self, retry_after=None):
+        """被限流：暂停到Retry-After之后，并把速率减半"""
+        with self.lock:
+            self.stats["throttled"] += 1
+            self.rate_factor = max(0.1, self.rate_factor / 2)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+api_governors = {
+    "deepseek": ApiGovernor("deepseek", API_RPM, API_TPM, API_MAX_CONCURRENCY),
+    "qwen": ApiGovernor("qwen", API_RPM, API_TPM, API_MAX_CONCURRENCY),
+}
+
+def estimate_request_tokens(messages):
+    """粗略估算一次请求消耗的tokens（输入按每2个字符1个token，加上预计的输出）"""
+    chars = sum(len(str(m.get("content", ""))) for m in messages)
+    return chars // 2 + ESTIMATED_OUTPUT_TOKENS
+
+def retry_after_seconds(error):
+    """从429/503响应头中读取Retry-After（秒）"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+def is_throttled(error):
+    """是否是限流/过载（429或带Retry-After的503）"""
+    if isinstance(error, openai.RateLimitError):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code == 503
+
+def backoff_delay(attempt):
+    """带随机抖动的指数退避（full jitter），避免多个请求同时重试"""
+    return random.uniform(0, min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * 2 ** attempt))
+
+def prefix_message(provider, partial):
+    """构造续写用的assistant前缀消息：DeepSeek用prefix，通义千问用partial"""
+    key = "prefix" if provider == "deepseek" else "partial"
+    return {"role": "assistant", "content": partial, key: True}
+
+def resume_client(provider):
+    """续写请求使用的客户端（DeepSeek的前缀续写需要beta接口）"""
+    if provider == "deepseek":
+        return deepseek_beta_client if client is deepseek_client else client
+    return qwen_client or client
+
+def merge_usage(usages):
+    """合并续写产生的多段usage"""
+    if not usages:
+        return None
+    if len(usages) == 1:
+        return usages[0]
+    prompt_tokens = sum(u.prompt_tokens for u in usages)
+    completion_tokens = sum(u.completion_tokens for u in usages)
+    return CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens,
+                           prompt_cache_hit_tokens=sum(usage_cache_hit_tokens(u) for u in usages))
+
+
+def chat_stream(messages, printer, model="deepseek-chat"):
+    """流式对话处理：连接中断时从已输出的内容续写，因长度截断时自动续写"""
     full_response = []
     reasoning_content = []
     is_reasoning = False
     max_retries = 3
     retry_count = 0
+    continuations = 0
+    usages = []
+    queue_wait = 0.0
+    first_token_latency = None
+    verbose = not getattr(printer, "silent", False)
+    start_time = time.time()
+    if current_client_type == QWEN_CLIENT:
+        model = "qwen-max-2025-01-25"
+    provider = "deepseek" if current_client_type == DEEPSEEK_CLIENT else "qwen"
+    provider_model = model
     
-    while retry_count < max_retries:
+    while True:
+        breaker = circuit_breakers[provider]
+        if not breaker.allow():
+            console.print(f"\n[red]❌ {provider} 接口连续请求失败，已暂停请求，请 {breaker.remaining():.0f} 秒后再试[/red]")
+            return {"reasoning_content": "", "content": ""}
+        partial = "".join(full_response)
+        request_kwargs = {
+            "messages": messages,
+            "temperature": 0.7,
+            "stream_options": {"include_usage": True},
+            "timeout": API_TIMEOUT,
+        }
+        segment_usage = None
+        finish_reason = None
+        ticket = None
+        stream = None
         try:
-            if current_client_type == QWEN_CLIENT:
-                model = "qwen-max-2025-01-25"
-            
-            for chunk in client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.7,
-                stream=True,
-                timeout=30
-            ):
+            if partial:
+                # 把已输出的内容作为assistant前缀，让模型从断点继续，不重复输出
+                request_kwargs["messages"] = messages + [prefix_message(provider, partial)]
+                ticket = api_governors[provider].acquire(estimate_request_tokens(request_kwargs["messages"]))
+                attempt_start = time.time()
+                stream = resume_client(provider).chat.completions.create(model=provider_model, stream=True, **request_kwargs)
+            elif hedge_available(model) and retry_count == 0:
+                stream = HedgedStream(
+                    [("deepseek", client, model), ("qwen", qwen_client, HEDGE_MODELS[model])],
+                    hedge_threshold("deepseek"), **request_kwargs
+                )
+            else:
+                if reasoning_content:
+                    # 只收到了思考内容就断开，只能重新开始
+                    reasoning_content = []
+                    if is_reasoning:
+                        console.print("\n[bright_blue]（重新思考）[/bright_blue] ", end="")
+                ticket = api_governors[provider].acquire(estimate_request_tokens(messages))
+                attempt_start = time.time()
+                stream = client.chat.completions.create(model=provider_model, stream=True, **request_kwargs)
+            for chunk in stream:
+                if chunk.usage:
+                    segment_usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                if chunk.choices[0].finish_reason:
+                    finish_reason = chunk.choices[0].finish_reason
+                if first_token_latency is None and chunk_has_content(chunk):
+                    first_token_latency = time.time() - start_time
+                    if not isinstance(stream, HedgedStream):
+                        # 统计只算本次请求发出后的等待，不含排队、退避和之前失败的尝试
+                        ttft_stats.record(provider, time.time() - attempt_start)
+                    elif stream.provider != "deepseek":
+                        provider = stream.provider
+                        provider_model = HEDGE_MODELS[model]
+                        if verbose:
+                            console.print(f"\n[dim]DeepSeek响应慢，已改用 {provider} 的回复[/dim]")
                 if hasattr(chunk.choices[0].delta, 'reasoning_content') and chunk.choices[0].delta.reasoning_content:
                     content = chunk.choices[0].delta.reasoning_content
                     reasoning_content.append(content)
+                    if not verbose:
+                        continue
                     if not is_reasoning:
                         console.print("\n[bright_blue]（思考中）[/bright_blue] ", end="")
                         is_reasoning = True
@@ -923,26 +4182,33 @@ def chat_stream(messages, printer, model="deepseek-chat"):
                     content = chunk.choices[0].delta.content
                     full_response.append(content)
                     printer.stream_print(content)
-            break
+            circuit_breakers[provider].record_success()
+            api_governors[provider].record_success()
         except openai.AuthenticationError:
             console.print("\n[red]❌ 认证失败，请检查 DEEPSEEK_API_KEY 是否正确[/red]")
             return {"reasoning_content": "", "content": ""}
-        except (openai.APIConnectionError, openai.APITimeoutError) as e:
+        except openai.RateLimitError as e:
+            # 被限流不算服务故障：按Retry-After等待并降低请求速率后重试
+            retry_after = retry_after_seconds(e)
+            api_governors[provider].penalize(retry_after)
+            retry_count += 1
+            if retry_count < max_retries:
+                wait_time = max(retry_after or 0, backoff_delay(retry_count))
+                console.print(f"\n[yellow]⚠️ 请求过于频繁（429），{wait_time:.1f}秒后重试，并自动降低请求速率...[/yellow]")
+                time.sleep(wait_time)
+                continue
+            console.print("\n[red]❌ 请求过于频繁，请稍后再试[/red]")
+            return {"reasoning_content": "", "content": ""}
+        except RETRYABLE_ERRORS as e:
+            circuit_breakers[provider].record_failure()
+            if is_throttled(e):
+                api_governors[provider].penalize(retry_after_seconds(e))
             retry_count += 1
+            is_timeout = isinstance(e, (openai.APITimeoutError, httpx.TimeoutException))
             console.print(f"\n[red]❌ 连接错误详情：[/red]")
             console.print(f"[yellow]错误类型：{type(e).__name__}[/yellow]")
             console.print(f"[yellow]错误信息：{str(e)}[/yellow]")
-            console.print(f"[yellow]错误详情：{repr(e)}[/yellow]")
-            if isinstance(e, openai.APIConnectionError):
-                console.print("\n[yellow]可能原因：[/yellow]")
-                console.print("1. 网络连接不稳定或断开")
-                console.print("2. DNS解析失败")
-                console.print("3. 服务器响应超时")
-                console.print("4. 代理配置不正确")
-                console.print("\n[yellow]建议解决方案：[/yellow]")
-                console.print("1. 检查网络连接是否正常")
-                console.print("2. 如果使用VPN，请关闭VPN后重试")
-            elif isinstance(e, openai.APITimeoutError):
+            if retry_count == 1 and is_timeout:
                 console.print("\n[yellow]可能原因：[/yellow]")
                 console.print("1. 服务器处理请求时间过长")
                 console.print("2. 网络延迟较高")
@@ -952,34 +4218,333 @@ def chat_stream(messages, printer, model="deepseek-chat"):
                 console.print("2. 尝试减小请求的数据量")
                 console.print("3. 关闭其他占用带宽的程序")
                 console.print("4. 稍后重试")
+            elif retry_count == 1:
+                console.print("\n[yellow]可能原因：[/yellow]")
+                console.print("1. 网络连接不稳定或断开")
+                console.print("2. DNS解析失败")
+                console.print("3. 服务器响应超时")
+                console.print("4. 代理配置不正确")
+                console.print("\n[yellow]建议解决方案：[/yellow]")
+                console.print("1. 检查网络连接是否正常")
+                console.print("2. 如果使用VPN，请关闭VPN后重试")
             if retry_count < max_retries:
-                wait_time = 2 ** retry_count
-                console.print(f"\n[yellow]⚠️ 连接失败，{wait_time}秒后进行第{retry_count + 1}次重试...[/yellow]")
+                wait_time = backoff_delay(retry_count)
+                action = "从中断处继续" if full_response else "重新请求"
+                console.print(f"\n[yellow]⚠️ 连接中断，{wait_time:.1f}秒后{action}（第{retry_count + 1}次尝试）...[/yellow]")
                 time.sleep(wait_time)
-            else:
-                console.print("\n[red]❌ 连接失败，请检查网络连接或稍后重试[/red]")
-                console.print("[yellow]建议：[/yellow]")
-                console.print("1. 检查网络连接是否正常")
-                console.print("2. 确认是否可以访问 api.deepseek.com")
-                console.print("3. 如果使用了代理，请检查代理设置")
-                console.print("4. 尝试重启程序")
-                console.print("5. 确认API密钥额度是否充足")
-                console.print("6. 检查系统时间是否准确")
-                return {"reasoning_content": "", "content": ""}
+                continue
+            console.print("\n[red]❌ 连接失败，请检查网络连接或稍后重试[/red]")
+            console.print("[yellow]建议：[/yellow]")
+            console.print("1. 检查网络连接是否正常")
+            console.print("2. 确认是否可以访问 api.deepseek.com")
+            console.print("3. 如果使用了代理，请检查代理设置")
+            console.print("4. 尝试重启程序")
+            console.print("5. 确认API密钥额度是否充足")
+            console.print("6. 检查系统时间是否准确")
+            return {"reasoning_content": "", "content": ""}
         except Exception as e:
             console.print(f"\n[red]❌ 发生未知错误[/red]")
             console.print(f"[yellow]错误类型：{type(e).__name__}[/yellow]")
             console.print(f"[yellow]错误信息：{str(e)}[/yellow]")
             console.print(f"[yellow]错误详情：{repr(e)}[/yellow]")
             return {"reasoning_content": "", "content": ""}
+        finally:
+            if segment_usage:
+                usages.append(segment_usage)
+            if ticket:
+                api_governors[provider].release(ticket, segment_usage)
+                queue_wait += ticket["waited"]
+            elif isinstance(stream, HedgedStream):
+                queue_wait += stream.queue_wait
+
+        if finish_reason == "length" and full_response and continuations < MAX_CONTINUATIONS:
+            # 输出被长度上限截断，以已输出内容为前缀自动续写
+            continuations += 1
+            if verbose:
+                console.print(f"\n[dim]（输出达到长度上限，自动续写第{continuations}次）[/dim]")
+            continue
+        break
     
     if is_reasoning:
         console.print("\n[bright_blue]（思考结束）[/bright_blue]\n")
-        
+
+    usage = merge_usage(usages)
     return {
         "reasoning_content": "".join(reasoning_content),
-        "content": "".join(full_response)
+        "content": "".join(full_response),
+        "usage": usage,
+        "first_token_latency": first_token_latency,
+        "latency": time.time() - start_time,
+        "provider": provider,
+        "continuations": continuations,
+        "retries": retry_count,
+        "queue_wait": queue_wait,
+    }
+
+# ----------------------------
+# 增量修改：让模型只输出修改部分（SEARCH/REPLACE），本地应用补丁
+# ----------------------------
+# 只收录祈使的修改说法；"错误""不能"等词在普通提问中也很常见，不作为修改的依据
+EDIT_KEYWORDS = [
+    "修改", "改成", "改为", "改一下", "改下", "帮我改", "修复", "修正", "优化一下", "调整一下", "增加一个", "添加一个",
+    "加上", "加个", "去掉", "删掉", "换成", "替换成", "fix ", "traceback (most recent call last)",
+]
+# 包含这些说法时是在提问或要求解释，按普通对话处理
+QUESTION_KEYWORDS = ["为什么", "什么意思", "是什么", "怎么回事", "解释", "what ", "why "]
+NEW_CODE_KEYWORDS = ["写一个", "重新写", "重写", "新写", "生成一个", "再写"]
+
+EDIT_INSTRUCTION = """
+
+【修改方式】请基于上一版代码，只输出需要修改的部分，使用以下格式（可以有多个块，每个块只包含需要改动的连续若干行）：
+<<<<<<< SEARCH
+原代码中需要被替换的连续行（必须与原代码逐字一致，包括缩进）
+=======
+替换后的代码
+>>>>>>> REPLACE
+不要输出完整代码；如果需要改动的内容超过一半，可以直接输出完整代码块。
+如果这条消息只是提问、不需要修改代码，直接正常回答即可。"""
+
+PATCH_BLOCK_PATTERN = re.compile(
+    r"<{5,9} SEARCH[^\n]*\n(.*?)\n?={5,9}[ \t]*\n(.*?)\n?>{5,9} REPLACE",
+    flags=re.DOTALL
+)
+
+def is_edit_request(user_input, last_code):
+    """是否是针对上一次生成代码的修改请求"""
+    if not last_code or not edit_mode_enabled:
+        return False
+    if any(kw in user_input for kw in NEW_CODE_KEYWORDS):
+        return False
+    lowered = user_input.lower()
+    if any(kw in lowered for kw in QUESTION_KEYWORDS):
+        return False
+    return any(kw in lowered for kw in EDIT_KEYWORDS)
+
+def parse_patch_blocks(response):
+    """提取回复中的SEARCH/REPLACE块"""
+    return [(search, replace) for search, replace in PATCH_BLOCK_PATTERN.findall(response)]
+
+def _find_unique_lines(code_lines, search_lines):
+    """忽略行尾空白逐行匹配，返回唯一匹配的起始行号；未匹配返回None，多处匹配返回-1"""
+    target = [line.rstrip() for line in search_lines]
+    stripped = [line.rstrip() for line in code_lines]
+    matches = [
+        i for i in range(len(stripped) - len(target) + 1)
+        if stripped[i:i + len(target)] == target
+    ]
+    if not matches:
+        return None
+    return matches[0] if len(matches) == 1 else -1
+
+def apply_patch_blocks(code_content, blocks):
+    """依次应用补丁，返回 (新代码, 错误信息)"""
+    for index, (search, replace) in enumerate(blocks, 1):
+        if not search.strip():
+            return None, f"第{index}个修改块的SEARCH部分为空"
+        count = code_content.count(search)
+        if count == 1:
+            code_content = code_content.replace(search, replace, 1)
+            continue
+        if count > 1:
+            return None, f"第{index}个修改块在原代码中匹配到{count}处"
+        code_lines = code_content.split("\n")
+        search_lines = search.split("\n")
+        start = _find_unique_lines(code_lines, search_lines)
+        if start is None:
+            return None, f"第{index}个修改块在原代码中找不到：{search_lines[0].strip()[:40]}"
+        if start == -1:
+            return None, f"第{index}个修改块在原代码中匹配到多处"
+        code_lines[start:start + len(search_lines)] = replace.split("\n")
+        code_content = "\n".join(code_lines)
+    compile_error = compile_check(code_content)
+    if compile_error:
+        return None, f"应用修改后代码有语法错误：{compile_error}"
+    return code_content, None
+
+def report_edit_savings(response, new_code):
+    """估算并显示本次增量修改相对整文件重写节省的输出tokens与耗时"""
+    usage = response.get("usage")
+    content = response.get("content") or ""
+    if not usage or not usage.completion_tokens or not content:
+        return None
+    chars_per_token = len(content) / usage.completion_tokens
+    full_tokens = int(len(new_code) / chars_per_token) if chars_per_token else 0
+    saved_tokens = full_tokens - usage.completion_tokens
+    if saved_tokens <= 0:
+        return None
+    generate_time = response["latency"] - (response.get("first_token_latency") or 0)
+    tokens_per_second = usage.completion_tokens / generate_time if generate_time > 0 else 0
+    saved_seconds = saved_tokens / tokens_per_second if tokens_per_second else 0
+    console.print(
+        f"[green]✓ 增量修改：输出 {usage.completion_tokens} tokens（整文件重写约 {full_tokens}），"
+        f"节省约 {saved_tokens / full_tokens:.0%} 输出tokens、{saved_seconds:.1f} 秒[/green]"
+    )
+    return {"completion_tokens": usage.completion_tokens, "full_tokens": full_tokens, "saved_seconds": saved_seconds}
+
+def request_code_edit(messages, printer, model, user_input, current_code, include_code=False, on_response=None):
+    """以增量修改方式请求修改代码，补丁无法应用时回退为整文件重写。
+    返回 (修改后的代码或None, 是否由本地补丁得到)，messages会追加本轮对话；on_response(response)在每次请求结束后调用"""
+    # 修改说明和当前代码只随本次请求发送，对话记录中只保存用户的原话，避免之后每轮重复发送
+    code_block = f"\n\n当前代码：\n```python\n{current_code}\n```" if include_code else ""
+    request = messages + [{"role": "user", "content": user_input + EDIT_INSTRUCTION + code_block}]
+    messages.append({"role": "user", "content": user_input})
+    response = chat_stream(request, printer, model)
+    printer.reset()
+    if on_response:
+        on_response(response)
+    messages.append({"role": "assistant", "content": response["content"]})
+    if not response["content"]:
+        return None, False
+
+    blocks = parse_patch_blocks(response["content"])
+    if blocks:
+        new_code, error = apply_patch_blocks(current_code, blocks)
+        if new_code is not None:
+            console.print(f"\n[green]✓ 已应用 {len(blocks)} 处修改[/green]")
+            report_edit_savings(response, new_code)
+            return new_code, True
+        console.print(f"\n[yellow]⚠️ 修改无法应用（{error}），正在请求完整代码...[/yellow]")
+    else:
+        code_content, _ = extract_code_from_response(response["content"], verbose=False)
+        if code_content:
+            # 模型选择了直接输出完整代码
+            return code_content, False
+        return None, False
+
+    retry_prompt = f"上面的修改无法应用到代码上（{error}），请输出修改后的完整代码。"
+    request = messages + [{"role": "user", "content": retry_prompt + code_block}]
+    messages.append({"role": "user", "content": retry_prompt})
+    response = chat_stream(request, printer, model)
+    printer.reset()
+    if on_response:
+        on_response(response)
+    messages.append({"role": "assistant", "content": response["content"]})
+    code_content, _ = extract_code_from_response(response["content"])
+    return code_content, False
+
+# ----------------------------
+# 模型自动路由：根据提示词和上下文在chat与reasoner之间选择
+# ----------------------------
+ROUTING_MODES = ["off", "auto", "cascade"]
+ROUTING_MODE_LABELS = {"off": "手动选择", "auto": "自动选择", "cascade": "自动选择+先规划后编码"}
+ROUTING_LOG_FILE = "routing_log.jsonl"
+
+# 需要较强推理能力的关键词
+HARD_KEYWORDS = [
+    "算法", "优化", "性能", "并发", "多线程", "多进程", "异步", "递归", "动态规划", "数学", "证明", "公式",
+    "加密", "解密", "解析", "协议", "架构", "设计", "机器学习", "神经网络", "模型", "数据库", "爬虫", "分布式",
+    "为什么", "原因", "分析", "复杂", "调试", "死锁", "内存泄漏",
+]
+# 简单任务的关键词
+SIMPLE_KEYWORDS = [
+    "计算器", "重命名", "打印", "你好", "翻译", "简单", "小工具", "倒计时", "时钟", "hello", "批量改名",
+]
+ERROR_KEYWORDS = ["报错", "错误", "异常", "error", "traceback", "exception"]
+
+# 价格（元/百万tokens：输入, 输出），用于估算每次请求的费用
+MODEL_PRICES = {
+    "deepseek-chat": (2.0, 8.0),
+    "deepseek-reasoner": (4.0, 16.0),
+}
+
+CASCADE_PLAN_INSTRUCTION = "\n\n请先不要写代码，只给出简短的实现计划（不超过8条要点：用到的库、关键步骤、容易出错的地方）。"
+
+def routing_features(user_input, messages, last_code):
+    """提取路由用的特征"""
+    lowered = user_input.lower()
+    last_runs = load_run_history(1)
+    last_failed = bool(last_runs) and last_runs[-1].get("exit_code") not in (0, None)
+    return {
+        "chars": len(user_input),
+        "hard_hits": sum(1 for kw in HARD_KEYWORDS if kw in lowered),
+        "simple_hits": sum(1 for kw in SIMPLE_KEYWORDS if kw in lowered),
+        "mentions_error": any(kw in lowered for kw in ERROR_KEYWORDS),
+        "last_run_failed": last_failed,
+        "turns": sum(1 for m in messages if m["role"] == "user"),
+        "last_code_lines": last_code.count("\n") + 1 if last_code else 0,
+    }
+
+def route_model(user_input, messages, last_code):
+    """启发式打分选择模型，返回路由决策"""
+    features = routing_features(user_input, messages, last_code)
+    score = min(features["hard_hits"], 3) - features["simple_hits"]
+    if features["chars"] > 200:
+        score += 1
+    if features["chars"] > 500:
+        score += 1
+    if features["mentions_error"] and features["last_run_failed"]:
+        # 上次运行失败后的报错修复往往需要推理
+        score += 1
+    if features["last_code_lines"] > 200:
+        score += 1
+    model = "deepseek-reasoner" if score >= ROUTING_THRESHOLD else "deepseek-chat"
+    return {"model": model, "score": score, "features": features}
+
+def response_cost(model, usage):
+    """根据usage估算费用（元）"""
+    if not usage or model not in MODEL_PRICES:
+        return None
+    input_price, output_price = MODEL_PRICES[model]
+    return (usage.prompt_tokens * input_price + usage.completion_tokens * output_price) / 1_000_000
+
+def cascade_chat(messages, printer):
+    """先由reasoner给出简短计划，再由chat按计划生成代码。
+    messages最后一条是用户消息，计划只用于本次请求，不写入对话记录"""
+    user_message = messages[-1]
+    plan_messages = messages[:-1] + [{"role": "user", "content": user_message["content"] + CASCADE_PLAN_INSTRUCTION}]
+    console.print("\n[bright_blue]（规划中）[/bright_blue]")
+    plan = chat_stream(plan_messages, printer, "deepseek-reasoner")
+    printer.reset()
+    if not plan["content"]:
+        return plan
+    console.print("\n[bright_blue]（按计划生成代码）[/bright_blue]")
+    code_messages = messages[:-1] + [{
+        "role": "user",
+        "content": user_message["content"] + "\n\n实现计划（供参考）：\n" + plan["content"]
+    }]
+    response = chat_stream(code_messages, printer, "deepseek-chat")
+    costs = [response_cost("deepseek-reasoner", plan.get("usage")), response_cost("deepseek-chat", response.get("usage"))]
+    response["cost"] = sum(c for c in costs if c is not None) if any(c is not None for c in costs) else None
+    response["first_token_latency"] = plan.get("first_token_latency")
+    response["latency"] = plan.get("latency", 0) + response.get("latency", 0)
+    response["plan_usage"] = plan.get("usage")
+    return response
+
+def log_routing_decision(decision, mode, latency, response=None, produced_code=False):
+    """记录路由决策及其耗时、费用，用于之后调整路由策略"""
+    usage = response.get("usage") if response else None
+    cost = response.get("cost") if response and "cost" in response else response_cost(decision["model"], usage)
+    record = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "mode": mode,
+        "model": decision["model"],
+        "score": decision["score"],
+        "features": decision["features"],
+        "first_token_latency": response.get("first_token_latency") if response else None,
+        "latency": round(latency, 3),
+        "prompt_tokens": usage.prompt_tokens if usage else None,
+        "completion_tokens": usage.completion_tokens if usage else None,
+        "cost": round(cost, 6) if cost is not None else None,
+        "produced_code": produced_code,
     }
+    try:
+        with open(ROUTING_LOG_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError:
+        pass
+
+def load_routing_log():
+    """读取路由记录"""
+    if not os.path.exists(ROUTING_LOG_FILE):
+        return []
+    records = []
+    with open(ROUTING_LOG_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
 
 def get_multiline_input():
     """智能获取用户输入"""
@@ -1076,9 +4641,34 @@ def clear_terminal():
     else:
         os.system("clear")
 
+def ensure_script_dependencies(code_content, filename=None):
+    """检查并安装代码所需的依赖，全部就绪时返回True；提供文件名时优先使用锁文件"""
+    if filename and sync_script_lock(filename, code_content):
+        return True
+    required_libs = extract_imports(code_content)
+    if not required_libs:
+        if filename:
+            write_script_lock(filename, code_content, required_libs)
+        return True
+    console.print("\n[yellow]正在检查已安装的依赖...[/yellow]")
+    uninstalled_libs = missing_dependencies(required_libs)
+    if not uninstalled_libs:
+        console.print("[green]✓ 所有依赖已安装[/green]")
+    else:
+        console.print("\n[yellow]检测到以下依赖尚未安装：[/yellow]")
+        for lib in uninstalled_libs:
+            console.print(f"[blue]- {lib}[/blue]")
+        console.print("\n[yellow]正在安装缺失的依赖...[/yellow]")
+        if not install_dependencies(uninstalled_libs, interactive=True):
+            console.print("\n[red]⚠️ 部分依赖安装失败，代码可能无法正常运行[/red]")
+            return False
+    if filename:
+        write_script_lock(filename, code_content, required_libs)
+    return True
+
 def ls_and_run_code():
-    """列出代码工具库中的文件并允许选择运行"""
-    code_dir = "代码工具库"
+    """列出代码工具库中的文件并允许选择运行（后台任务模式下可用逗号选择多个）"""
+    code_dir = CODE_DIR
     if not os.path.exists(code_dir):
         console.print("[yellow]⚠️ 代码工具库目录不存在[/yellow]")
         return
@@ -1094,52 +4684,21 @@ def ls_and_run_code():
             choice = input("\n请输入文件序号（按回车返回）: ").strip()
             if not choice:
                 return
-            file_index = int(choice) - 1
-            if 0 <= file_index < len(py_files):
-                selected_file = os.path.join(code_dir, py_files[file_index])
-                with open(selected_file, 'r', encoding='utf-8') as f:
-                    code_content = f.read()
-                required_libs = extract_imports(code_content)
-                if required_libs:
-                    console.print("\n[yellow]正在检查已安装的依赖...[/yellow]")
-                    uninstalled_libs = [lib for lib in required_libs if not is_installed(lib)]
-                    if uninstalled_libs:
-                        console.print("\n[yellow]检测到以下依赖尚未安装：[/yellow]")
-                        for lib in uninstalled_libs:
-                            console.print(f"[blue]- {lib}[/blue]")
-                        console.print("\n[yellow]正在安装缺失的依赖...[/yellow]")
-                        if not install_dependencies(uninstalled_libs):
-                            console.print("\n[red]⚠️ 部分依赖安装失败，代码可能无法正常运行[/red]")
-                            continue
-                    else:
-                        console.print("[green]✓ 所有依赖已安装[/green]")
-                python_path = setup_virtual_env()
-                console.print("\n[yellow]🚀 正在新窗口中启动程序(Python 3.9)...[/yellow]")
-                try:
-                    if sys.platform == "win32":
-                        venv_python = os.path.join("venv3.9", "Scripts", "python.exe")
-                        if not os.path.exists(venv_python):
-                            console.print(f"\n[red]⚠️ 虚拟环境Python解释器不存在: {venv_python}[/red]")
-                            return
-                        rel_python = os.path.relpath(venv_python)
-                        rel_filename = os.path.relpath(selected_file)
-                        cmd = f'start cmd /c "{rel_python} {rel_filename} & pause"'
-                        subprocess.Popen(cmd, shell=True)
-                    else:
-                        if sys.platform == "darwin":
-                            subprocess.Popen(['open', '-a', 'Terminal', '--', python_path, selected_file])
-                        else:
-                            terminals = ['gnome-terminal', 'xterm', 'konsole']
-                            for term in terminals:
-                                try:
-                                    subprocess.Popen([term, '--', python_path, selected_file])
-                                    break
-                                except FileNotFoundError:
-                                    continue
-                            else:
-                                subprocess.Popen([python_path, selected_file])
-                except Exception as e:
-                    console.print(f"\n[red]⚠️ 启动程序失败: {str(e)}[/red]")
+            indexes = [int(part) - 1 for part in re.split(r'[,，\s]+', choice) if part]
+            if len(indexes) > 1 and run_mode != "background":
+                console.print("[red]❌ 仅后台任务模式(m)支持同时运行多个文件[/red]")
+                continue
+            if all(0 <= file_index < len(py_files) for file_index in indexes):
+                for file_index in indexes:
+                    selected_file = os.path.join(code_dir, py_files[file_index])
+                    with open(selected_file, 'r', encoding='utf-8') as f:
+                        code_content = f.read()
+                    preflight = Preflight(code_content, os.path.dirname(selected_file)).start()
+                    if not preflight.check_syntax() or not ensure_script_dependencies(code_content, selected_file):
+                        continue
+                    if not preflight.check_imports():
+                        continue
+                    launch_script(selected_file)
                 break
             else:
                 console.print("[red]❌ 无效的序号，请重新输入[/red]")
@@ -1148,6 +4707,340 @@ def ls_and_run_code():
         except Exception as e:
             console.print(f"[red]❌ 发生错误: {str(e)}[/red]")
 
+# ----------------------------
+# 会话记录：每个会话一个只追加的JSONL日志（消息、流式片段、生成代码），可随时恢复
+# sessions/<会话号>/log.jsonl      事件日志
+# sessions/<会话号>/snapshot.json  定期快照（消息列表 + 日志偏移），恢复时只需回放快照之后的部分
+# sessions/<会话号>/code/<哈希>.py  生成的代码
+# ----------------------------
+SESSIONS_DIR = "sessions"
+SESSION_FSYNC_INTERVAL = float(os.getenv("SESSION_FSYNC_INTERVAL", "2"))
+SESSION_SNAPSHOT_EVERY = int(os.getenv("SESSION_SNAPSHOT_EVERY", "20"))
+SESSION_CHUNK_BATCH = 200  # 流式片段攒够这么多字符（或超过1秒）写一次
+
+class SessionLog:
+    """单个会话的事件日志：消息与代码事件立即落盘，流式片段批量写入，按时间间隔fsync"""
+    def __init__(self, session_id=None):
+        self.id = session_id or f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:4]}"
+        self.dir = os.path.join(SESSIONS_DIR, self.id)
+        self.path = os.path.join(self.dir, "log.jsonl")
+        self.file = None
+        self.pending = []  # 第一条用户消息之前的事件先缓存，避免每次启动都生成空会话
+        self.lock = Lock()
+        self.last_fsync = 0.0
+        self.events_since_snapshot = 0
+        self.chunk_buffer = []
+        self.chunk_time = 0.0
+        self.messages = None
+
+    def _open(self):
+        os.makedirs(self.dir, exist_ok=True)
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def append(self, event, sync=False):
+        """追加一个事件"""
+        with self.lock:
+            line = json.dumps(event, ensure_ascii=False) + "\n"
+            if self.file is None:
+                if event.get("type") != "message" or event.get("role") != "user":
+                    self.pending.append(line)
+                    return
+                self._open()
+                self.file.writelines(self.pending)
+                self.pending = []
+            self.file.write(line)
+            self.file.flush()
+            if sync or time.time() - self.last_fsync >= SESSION_FSYNC_INTERVAL:
+                os.fsync(self.file.fileno())
+                self.last_fsync = time.time()
+            self.events_since_snapshot += 1
+
+    def record_message(self, message):
+        # 完整消息已包含此前的流式片段，丢弃尚未写入的片段
+        self.chunk_buffer = []
+        self.append({"type": "message", "role": message["role"], "content": message["content"]}, sync=True)
+        # 只在消息边界写快照，保证快照之后的片段都能在回放时找到
+        if self.events_since_snapshot >= SESSION_SNAPSHOT_EVERY and self.messages is not None:
+            self.write_snapshot(self.messages)
+
+    def record_chunk(self, content):
+        """StreamPrinter的监听器：流式片段攒批写入，程序崩溃时可恢复中断的回答"""
+        if not self.chunk_buffer:
+            self.chunk_time = time.time()
+        self.chunk_buffer.append(content)
+        if sum(len(c) for c in self.chunk_buffer) >= SESSION_CHUNK_BATCH or time.time() - self.chunk_time >= 1:
+            self.append({"type": "chunk", "content": "".join(self.chunk_buffer)})
+            self.chunk_buffer = []
+
+    def record_code(self, code_content, suggested_filename, from_patch):
+        """记录最后生成的代码：代码按哈希存入code目录，日志里只记路径"""
+        if not code_content:
+            event = {"type": "code", "path": None}
+            if self.messages is not None:
+                self.messages.code_event = event
+            self.append(event, sync=True)
+            return
+        import hashlib
+        digest = hashlib.sha256(code_content.encode("utf-8")).hexdigest()[:16]
+        code_dir = os.path.join(self.dir, "code")
+        os.makedirs(code_dir, exist_ok=True)
+        path = os.path.join(code_dir, f"{digest}.py")
+        if not os.path.exists(path):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(code_content)
+        event = {"type": "code", "path": os.path.relpath(path, self.dir), "filename": suggested_filename,
+                 "from_patch": from_patch}
+        if self.messages is not None:
+            self.messages.code_event = event
+        self.append(event, sync=True)
+
+    def write_snapshot(self, messages):
+        """写快照：当前消息列表与对应的日志偏移（原子替换）"""
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.flush()
+            snapshot = {"offset": self.file.tell(), "messages": list(messages), "code": getattr(messages, "code_event", None)}
+            self.events_since_snapshot = 0
+        tmp_path = os.path.join(self.dir, "snapshot.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.dir, "snapshot.json"))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+class SessionMessages(list):
+    """对话记录列表：append/clear时同步写入会话日志，其余用法与普通列表相同"""
+    def __init__(self, messages=(), log=None):
+        super().__init__(messages)
+        self.log = log
+        self.code_event = None
+        if log:
+            log.messages = self
+            for message in self:
+                log.record_message(message)
+
+    def append(self, message):
+        super().append(message)
+        if self.log:
+            self.log.record_message(message)
+
+    def clear(self):
+        super().clear()
+        self.code_event = None
+        if self.log:
+            self.log.append({"type": "reset"}, sync=True)
+
+    def replace(self, messages):
+        """整体替换对话内容（切换分支时使用），日志中记录一次替换事件"""
+        list.clear(self)
+        list.extend(self, messages)
+        if self.log:
+            self.log.append({"type": "replace", "messages": list(messages)}, sync=True)
+
+    def attach(self, log, messages):
+        """切换到另一个会话日志（恢复会话时使用），不重复记录已有消息"""
+        if self.log:
+            self.log.close()
+        list.clear(self)
+        list.extend(self, messages)
+        self.log = log
+        log.messages = self
+
+def replay_session(session_id):
+    """从快照 + 快照之后的日志恢复会话：返回 (消息列表, 最后的代码事件, 中断的回答片段)"""
+    session_dir = os.path.join(SESSIONS_DIR, session_id)
+    log_path = os.path.join(session_dir, "log.jsonl")
+    messages, code_event, offset = [], None, 0
+    snapshot_path = os.path.join(session_dir, "snapshot.json")
+    if os.path.exists(snapshot_path):
+        try:
+            with open(snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            if snapshot["offset"] <= os.path.getsize(log_path):
+                messages, code_event, offset = snapshot["messages"], snapshot.get("code"), snapshot["offset"]
+        except (OSError, json.JSONDecodeError, KeyError):
+            messages, code_event, offset = [], None, 0
+    partial = []
+    with open(log_path, "rb") as f:
+        f.seek(offset)
+        for raw_line in f:
+            try:
+                event = json.loads(raw_line.decode("utf-8"))
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                continue  # 崩溃时写了一半的行
+            kind = event.get("type")
+            if kind == "message":
+                messages.append({"role": event["role"], "content": event["content"]})
+                partial = []
+            elif kind == "chunk":
+                partial.append(event["content"])
+            elif kind == "code":
+                code_event = event
+            elif kind == "reset":
+                messages, code_event, partial = [], None, []
+            elif kind == "replace":
+                messages, partial = list(event["messages"]), []
+    return messages, code_event, "".join(partial)
+
+def list_sessions(limit=10):
+    """最近的会话：[(会话号, 修改时间, 第一条用户消息)]"""
+    if not os.path.isdir(SESSIONS_DIR):
+        return []
+    sessions = []
+    for session_id in os.listdir(SESSIONS_DIR):
+        log_path = os.path.join(SESSIONS_DIR, session_id, "log.jsonl")
+        if not os.path.isfile(log_path):
+            continue
+        first_prompt = ""
+        with open(log_path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if '"role": "user"' in line:
+                    try:
+                        first_prompt = json.loads(line)["content"]
+                    except (json.JSONDecodeError, KeyError):
+                        pass
+                    break
+        sessions.append((session_id, os.path.getmtime(log_path), first_prompt))
+    sessions.sort(key=lambda item: item[1], reverse=True)
+    return sessions[:limit]
+
+# ----------------------------
+# 对话分支：在当前位置分出新分支尝试不同方案，各分支共享分叉前的消息
+# 消息以不可变链表节点保存（每个节点指向上一条），分叉只复制一个指针，不复制消息
+# ----------------------------
+class MessageNode:
+    """对话链表节点：一条消息 + 指向上一条消息的节点"""
+    __slots__ = ("message", "parent", "length")
+
+    def __init__(self, message, parent=None):
+        self.message = message
+        self.parent = parent
+        self.length = parent.length + 1 if parent else 1
+
+def node_messages(node):
+    """从链表节点还原消息列表（消息对象本身是共享的，不复制）"""
+    messages = []
+    while node is not None:
+        messages.append(node.message)
+        node = node.parent
+    messages.reverse()
+    return messages
+
+class ConversationBranch:
+    """一个对话分支：链表头节点、各自的最后生成代码和缓存命中统计"""
+    def __init__(self, name, head=None, parent_name=None):
+        self.name = name
+        self.head = head
+        self.parent_name = parent_name
+        self.fork_point = head.length if head else 0
+        self.last_generated_code = None
+        self.last_suggested_filename = None
+        self.code_from_patch = False
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cache_hit_tokens = 0
+
+    def sync_from(self, messages):
+        """把当前对话列表同步到链表：与已有节点相同的前缀直接复用，只为新增消息建节点"""
+        chain = []
+        node = self.head
+        while node is not None:
+            chain.append(node)
+            node = node.parent
+        chain.reverse()
+        shared = 0
+        while shared < min(len(chain), len(messages)) and chain[shared].message is messages[shared]:
+            shared += 1
+        head = chain[shared - 1] if shared else None
+        for message in messages[shared:]:
+            head = MessageNode(message, head)
+        self.head = head
+
+def usage_cache_hit_tokens(usage):
+    """从usage中读取命中前缀缓存的输入tokens（DeepSeek与通义千问字段不同）"""
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    if hit is not None:
+        return hit
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+class ConversationTree:
+    """管理对话分支：fork 分叉、switch 切换，切换时保存/恢复各分支的最后生成代码"""
+    def __init__(self, messages, state):
+        self.messages = messages
+        self.state = state
+        self.branches = {"main": ConversationBranch("main")}
+        self.current = "main"
+        self.fork_count = 0
+
+    def save_current(self):
+        """把当前对话和最后生成的代码保存到当前分支"""
+        branch = self.branches[self.current]
+        branch.sync_from(self.messages)
+        branch.last_generated_code = self.state.last_generated_code
+        branch.last_suggested_filename = self.state.last_suggested_filename
+        branch.code_from_patch = self.state.code_from_patch
+
+    def reset(self):
+        """丢弃所有分支，以当前对话和最后生成的代码重建 main 分支；返回丢弃的分支数"""
+        dropped = len(self.branches) - 1
+        self.branches = {"main": ConversationBranch("main")}
+        self.current = "main"
+        self.fork_count = 0
+        self.save_current()
+        return dropped
+
+    def fork(self, name=None):
+        """在当前位置分出新分支并切换过去"""
+        if not name:
+            self.fork_count += 1
+            while f"b{self.fork_count}" in self.branches:
+                self.fork_count += 1
+            name = f"b{self.fork_count}"
+        if name in self.branches:
+            raise ValueError(f"分支 {name} 已存在")
+        self.save_current()
+        parent = self.branches[self.current]
+        branch = ConversationBranch(name, parent.head, parent.name)
+        branch.last_generated_code = parent.last_generated_code
+        branch.last_suggested_filename = parent.last_suggested_filename
+        branch.code_from_patch = parent.code_from_patch
+        self.branches[name] = branch
+        self.current = name
+        return branch
+
+    def switch(self, name):
+        """切换到指定分支"""
+        if name not in self.branches:
+            raise KeyError(name)
+        self.save_current()
+        branch = self.branches[name]
+        self.current = name
+        if hasattr(self.messages, "replace"):
+            self.messages.replace(node_messages(branch.head))
+        else:
+            self.messages[:] = node_messages(branch.head)
+        self.state.last_generated_code = branch.last_generated_code
+        self.state.last_suggested_filename = branch.last_suggested_filename
+        self.state.code_from_patch = branch.code_from_patch
+        return branch
+
+    def record_usage(self, usage):
+        """把一次对话请求的用量计入当前分支（规划等不带分支前缀的请求不计入）"""
+        if not usage:
+            return
+        branch = self.branches[self.current]
+        branch.requests += 1
+        branch.prompt_tokens += usage.prompt_tokens
+        branch.cache_hit_tokens += usage_cache_hit_tokens(usage)
+
 # ----------------------------
 # 新增：命令处理类 CommandHandler
 # ----------------------------
@@ -1157,6 +5050,9 @@ class CommandHandler:
         self.messages = messages
         self.last_generated_code = None
         self.last_suggested_filename = None
+        self.code_from_patch = False
+        self.job_manager = job_manager
+        self.tree = ConversationTree(self.messages, self)
         # 构建命令与处理函数的映射
         self.command_map = {
             "cl": self.handle_clear,
@@ -1164,11 +5060,42 @@ class CommandHandler:
             "run": self.handle_run,
             "s": self.handle_save,
             "h": self.show_help,
+            "m": self.handle_toggle_run_mode,
+            "hist": self.handle_history,
+            "jobs": self.handle_jobs,
+            "warm": self.handle_toggle_warm,
+            "queue": self.handle_queue,
+            "diff": self.handle_toggle_edit_mode,
+            "route": self.handle_routing_stats,
+            "hedge": self.handle_toggle_hedge,
+            "stats": self.handle_api_stats,
+            "resume": self.handle_resume,
+            "fork": self.handle_fork,
+            "switch": self.handle_switch,
+            "sync": self.handle_sync,
+            "py": self.handle_toggle_interpreter,
+            "perf": self.handle_toggle_prompt_profile,
+            "gc": self.handle_gc,
+        }
+        # 带参数的命令，如 kill 3
+        self.arg_command_map = {
+            "kill": self.handle_kill,
+            "wait": self.handle_wait,
+            "logs": self.handle_logs,
+            "bench": self.handle_bench,
+            "pybench": self.handle_interpreter_bench,
+            "prof": self.handle_profile,
+            "export": self.handle_export,
+            "resume": self.handle_resume,
+            "fork": self.handle_fork,
+            "switch": self.handle_switch,
         }
 
     def handle_clear(self):
         """清除记忆，并清屏"""
         self.messages.clear()
+        if service_client is not None:
+            service_client.reset()
         clear_terminal()
         self.show_main_menu()
         console.print("[green]✓ 记忆已清除[/green]")
@@ -1180,20 +5107,6 @@ class CommandHandler:
     def handle_run(self):
         """保存并执行最后生成的代码"""
         if self.last_generated_code:
-            required_libs = extract_imports(self.last_generated_code)
-            if required_libs:
-                console.print("\n[yellow]正在检查已安装的依赖...[/yellow]")
-                uninstalled_libs = [lib for lib in required_libs if not is_installed(lib)]
-                if uninstalled_libs:
-                    console.print("\n[yellow]检测到以下依赖尚未安装：[/yellow]")
-                    for lib in uninstalled_libs:
-                        console.print(f"[blue]- {lib}[/blue]")
-                    console.print("\n[yellow]正在安装缺失的依赖...[/yellow]")
-                    if not install_dependencies(uninstalled_libs):
-                        console.print("\n[red]⚠️ 部分依赖安装失败，代码可能无法正常运行[/red]")
-                        return
-                else:
-                    console.print("[green]✓ 所有依赖已安装[/green]")
             save_and_execute_code((self.last_generated_code, self.last_suggested_filename), True)
         else:
             console.print("\n[yellow]⚠️ 没有找到可以执行的代码，请先生成代码再使用run命令[/yellow]")
@@ -1205,6 +5118,244 @@ class CommandHandler:
         else:
             console.print("\n[yellow]⚠️ 没有找到可以保存的代码，请先生成代码再使用s命令[/yellow]")
 
+    def handle_toggle_run_mode(self):
+        """在新窗口运行、托管运行与后台任务之间切换"""
+        global run_mode
+        index = RUN_MODES.index(run_mode) if run_mode in RUN_MODES else 0
+        run_mode = RUN_MODES[(index + 1) % len(RUN_MODES)]
+        if run_mode == "managed":
+            memory = f"{RUN_MEMORY_LIMIT_MB}MB" if RUN_MEMORY_LIMIT_MB > 0 else "不限"
+            console.print(f"\n[cyan]已切换到托管运行模式（超时 {RUN_TIMEOUT:.0f}秒，内存上限 {memory}）[/cyan]")
+        elif run_mode == "background":
+            console.print(f"\n[cyan]已切换到后台任务模式（最多同时运行 {self.job_manager.max_concurrent} 个）[/cyan]")
+        else:
+            console.print("\n[cyan]已切换到新窗口运行模式[/cyan]")
+
+    def handle_jobs(self):
+        """列出后台任务"""
+        self.job_manager.reap()
+        if not self.job_manager.jobs:
+            console.print("\n[yellow]⚠️ 暂无后台任务[/yellow]")
+            return
+        running = len(self.job_manager.running())
+        console.print(f"\n[cyan]后台任务（运行中 {running}/{self.job_manager.max_concurrent}）：[/cyan]")
+        for job_id, job in self.job_manager.jobs.items():
+            run = job["run"]
+            elapsed = f"{run.duration():.1f}s" if run else "-"
+            console.print(f"[blue]{job_id}.[/blue] {os.path.basename(job['file'])}  {job['status']}  {elapsed}")
+
+    def _parse_job_id(self, arg):
+        try:
+            job_id = int(arg)
+        except ValueError:
+            console.print("[red]❌ 请输入有效的任务编号[/red]")
+            return None
+        if not self.job_manager.get(job_id):
+            console.print(f"[red]❌ 任务 {job_id} 不存在[/red]")
+            return None
+        return job_id
+
+    def handle_kill(self, arg):
+        """终止后台任务"""
+        job_id = self._parse_job_id(arg)
+        if job_id is not None and self.job_manager.kill(job_id):
+            console.print(f"\n[green]✓ 任务 {job_id} 已终止[/green]")
+
+    def handle_wait(self, arg):
+        """等待后台任务结束"""
+        job_id = self._parse_job_id(arg)
+        if job_id is not None:
+            console.print(f"\n[yellow]正在等待任务 {job_id} 结束（Ctrl+C停止等待）...[/yellow]")
+            status = self.job_manager.wait(job_id)
+            console.print(f"[blue]任务 {job_id}: {status}[/blue]")
+
+    def handle_logs(self, arg):
+        """显示后台任务的最近输出"""
+        job_id = self._parse_job_id(arg)
+        if job_id is None:
+            return
+        run = self.job_manager.get(job_id)["run"]
+        if not run:
+            console.print(f"\n[yellow]任务 {job_id} 尚未启动[/yellow]")
+            return
+        console.print(f"\n[cyan]任务 {job_id} 最近输出：[/cyan]")
+        with run.output_lock:
+            lines = list(run.output)[-50:]
+        for is_error, line in lines:
+            console.print(line, style="red" if is_error else None, markup=False, highlight=False)
+
+    def handle_history(self):
+        """显示最近的托管运行记录"""
+        entries = load_run_history(limit=10)
+        if not entries:
+            console.print("\n[yellow]⚠️ 暂无运行记录[/yellow]")
+            return
+        console.print("\n[cyan]最近运行记录：[/cyan]")
+        for entry in entries:
+            if entry.get("mode") == "terminal":
+                console.print(f"[blue]{entry.get('timestamp')}[/blue] {entry.get('file')}  新窗口运行")
+                continue
+            peak = f"{entry['peak_rss_kb'] / 1024:.1f}MB" if entry.get("peak_rss_kb") else "-"
+            status = "超时" if entry.get("timed_out") else f"退出码 {entry.get('exit_code')}"
+            console.print(f"[blue]{entry.get('timestamp')}[/blue] {entry.get('file')}  {status}  {entry.get('duration', 0):.2f}s  {peak}")
+
+    def handle_api_stats(self):
+        """显示本次会话的接口调用统计：请求数、排队等待、被限流次数、当前速率"""
+        console.print("\n[cyan]接口调用统计（本次会话）：[/cyan]")
+        for name, governor in api_governors.items():
+            stats = governor.stats
+            if not stats["requests"]:
+                continue
+            avg_wait = stats["queue_wait"] / stats["requests"]
+            rpm = f"{governor.rpm * governor.rate_factor:.0f}/分钟" if governor.rpm else "不限"
+            console.print(
+                f"[blue]{name}[/blue]  请求 {stats['requests']} 次  tokens {stats['tokens']}  "
+                f"排队平均 {avg_wait:.2f}s / 最长 {stats['max_wait']:.2f}s  被限流 {stats['throttled']} 次  "
+                f"当前速率 {rpm}  进行中 {governor.in_flight}/{governor.max_concurrency}"
+            )
+        if not any(governor.stats["requests"] for governor in api_governors.values()):
+            console.print("[yellow]⚠️ 本次会话还没有发出请求[/yellow]")
+
+    def handle_routing_stats(self):
+        """按模型汇总路由记录：次数、平均耗时、平均费用、生成代码的比例"""
+        console.print(f"\n[cyan]当前模型选择方式：{ROUTING_MODE_LABELS[routing_mode]}[/cyan]")
+        records = load_routing_log()
+        if not records:
+            console.print("[yellow]⚠️ 暂无路由记录[/yellow]")
+            return
+        groups = {}
+        for record in records:
+            key = record["model"] + ("（先规划）" if record.get("mode") == "cascade" and record["model"] == "deepseek-reasoner" else "")
+            groups.setdefault(key, []).append(record)
+        for key, items in groups.items():
+            latency = sum(r["latency"] for r in items) / len(items)
+            costs = [r["cost"] for r in items if r.get("cost") is not None]
+            cost = f"{sum(costs) / len(costs):.4f}元" if costs else "-"
+            code_rate = sum(1 for r in items if r.get("produced_code")) / len(items)
+            console.print(f"[blue]{key}[/blue]  {len(items)}次  平均耗时 {latency:.1f}s  平均费用 {cost}  生成代码 {code_rate:.0%}")
+
+    def handle_toggle_hedge(self):
+        """开启/关闭对冲请求，并显示各服务商的首token耗时统计"""
+        global hedge_enabled
+        if qwen_client is None:
+            console.print("\n[yellow]⚠️ 对冲请求需要在.env中配置 DASHSCOPE_API_KEY（通义千问）[/yellow]")
+            return
+        hedge_enabled = not hedge_enabled
+        state = "开启" if hedge_enabled else "关闭"
+        console.print(f"\n[cyan]已{state}对冲请求（DeepSeek超过 {hedge_threshold():.1f} 秒无输出时同时请求通义千问）[/cyan]")
+        for provider in ("deepseek", "qwen"):
+            summary = ttft_stats.summary(provider)
+            if summary:
+                count, mean, p50, p90 = summary
+                console.print(f"[blue]{provider}[/blue]  {count}次  首token平均 {mean:.2f}s  中位数≤{p50}s  P90≤{p90}s")
+
+    def handle_toggle_edit_mode(self):
+        """开启/关闭增量修改"""
+        global edit_mode_enabled
+        edit_mode_enabled = not edit_mode_enabled
+        state = "开启" if edit_mode_enabled else "关闭"
+        console.print(f"\n[cyan]已{state}增量修改（修改代码时只让AI输出改动部分）[/cyan]")
+
+    def handle_queue(self):
+        """查看待安装依赖队列"""
+        queue = get_install_queue()
+        if not queue.jobs:
+            console.print("\n[yellow]⚠️ 待安装队列为空[/yellow]")
+            return
+        console.print("\n[cyan]待安装依赖队列：[/cyan]")
+        for job in queue.jobs.values():
+            status = InstallQueue.STATUS_LABELS.get(job["status"], job["status"])
+            line = f"[blue]{job['id']}[/blue] {os.path.basename(job['filename'])}  {status}  尝试 {job['attempts']}/{QUEUE_MAX_ATTEMPTS}  依赖: {', '.join(job['libs'])}"
+            if job["status"] == InstallQueue.STATUS_PENDING and job["next_attempt"] > time.time():
+                line += f"  {job['next_attempt'] - time.time():.0f}秒后重试"
+            if job.get("hold_pid") == os.getpid():
+                line += "  （重启程序后安装）"
+            console.print(line)
+            if job.get("error"):
+                console.print(f"    [red]{job['error']}[/red]", markup=True, highlight=False)
+
+    def handle_toggle_warm(self):
+        """开启/关闭预热启动"""
+        global warm_launch_enabled
+        if not warm_launcher.available():
+            console.print("\n[red]❌ 预热启动仅支持Linux/macOS[/red]")
+            return
+        warm_launch_enabled = not warm_launch_enabled
+        if not warm_launch_enabled:
+            warm_launcher.stop()
+            console.print("\n[cyan]已关闭预热启动[/cyan]")
+            return
+        console.print("\n[yellow]正在启动预热进程...[/yellow]")
+        start = time.time()
+        if warm_launcher.ensure_started():
+            modules = ", ".join(warm_launcher.modules) or "无（运行历史为空）"
+            console.print(f"[cyan]已开启预热启动（{time.time() - start:.1f}s），预导入模块: {modules}[/cyan]")
+            if run_mode == "terminal":
+                console.print("[yellow]提示：预热启动仅在托管运行/后台任务模式下生效，输入 m 切换[/yellow]")
+        else:
+            warm_launch_enabled = False
+            console.print("[red]❌ 预热进程启动失败[/red]")
+
+    def handle_bench(self, arg):
+        """对比冷启动与预热启动的耗时"""
+        path = arg if os.path.exists(arg) else os.path.join(CODE_DIR, arg)
+        if not os.path.exists(path):
+            console.print(f"[red]❌ 文件不存在: {arg}[/red]")
+            return
+        benchmark_launch(path)
+
+    def handle_toggle_interpreter(self):
+        """切换解释器策略，并列出本机找到的解释器"""
+        global interpreter_policy
+        interpreter_policy = "fixed" if interpreter_policy == "fastest" else "fastest"
+        interps = discover_interpreters(refresh=True)
+        console.print(f"\n[cyan]本机找到 {len(interps)} 个Python解释器：[/cyan]")
+        for interp in interps:
+            env_state = "环境已创建" if os.path.exists(interpreter_venv_dir(interp)) else "首次使用时创建环境"
+            console.print(f"[blue]- Python {interp['version']}[/blue]  {interp['path']}  （{interpreter_venv_dir(interp)}，{env_state}）")
+        if interpreter_policy == "fastest":
+            console.print("[cyan]已切换为：每个脚本自动选用兼容的最快解释器（输入 pybench 文件名.py 实测对比）[/cyan]")
+        else:
+            console.print("[cyan]已切换为：固定使用Python 3.9环境运行[/cyan]")
+
+    def handle_interpreter_bench(self, arg):
+        """在各个解释器上运行脚本并比较耗时"""
+        path = arg if os.path.exists(arg) else os.path.join(CODE_DIR, arg)
+        if not os.path.exists(path):
+            console.print(f"[red]❌ 文件不存在: {arg}[/red]")
+            return
+        benchmark_interpreters(path)
+
+    def handle_toggle_prompt_profile(self):
+        """切换提示词方案（默认 / 注重运行速度），立即替换当前对话的系统提示词"""
+        global prompt_profile
+        if service_client is not None:
+            console.print("\n[yellow]⚠️ 服务模式下对话保存在服务端，暂不支持切换提示词方案[/yellow]")
+            return
+        prompt_profile = "default" if prompt_profile == "perf" else "perf"
+        if self.messages and self.messages[0].get("role") == "system":
+            new_messages = init_messages() + list(self.messages[1:])
+            if hasattr(self.messages, "replace"):
+                self.messages.replace(new_messages)
+            else:
+                self.messages[:] = new_messages
+        console.print(f"\n[cyan]已切换提示词方案：{PROMPT_PROFILE_LABELS[prompt_profile]}[/cyan]")
+
+    def handle_profile(self, arg):
+        """分析脚本的耗时与内存热点，可选让AI据此优化"""
+        path = arg if os.path.exists(arg) else os.path.join(CODE_DIR, arg)
+        if not os.path.exists(path):
+            console.print(f"[red]❌ 文件不存在: {arg}[/red]")
+            return
+        if input("\n性能分析会实际运行一次脚本（其中的文件操作也会执行），继续吗？(y/n): ").strip().lower() != "y":
+            return
+        profile = profile_script(path)
+        if not profile:
+            return
+        report_profile(profile)
+        if input("\n是否让AI根据分析结果优化这个脚本？(y/n): ").strip().lower() == "y":
+            optimize_from_profile(path, profile)
+
     def show_help(self):
         """显示详细帮助信息"""
         help_text = (
@@ -1212,9 +5363,33 @@ class CommandHandler:
             "[cyan]ls[/cyan]    列出并运行已有代码\n"
             "[cyan]run[/cyan]   运行AI最后一次生成的代码\n"
             "[cyan]s[/cyan]     保存AI最后一次生成的代码（不运行）\n"
+            "[cyan]m[/cyan]     切换运行方式：新窗口/托管运行（超时、资源限制）/后台任务\n"
+            "[cyan]hist[/cyan]  查看最近的托管运行记录\n"
+            "[cyan]jobs[/cyan]  列出后台任务\n"
+            "[cyan]kill[/cyan]  终止后台任务，如 kill 1\n"
+            "[cyan]wait[/cyan]  等待后台任务结束，如 wait 1\n"
+            "[cyan]logs[/cyan]  查看后台任务输出，如 logs 1\n"
+            "[cyan]warm[/cyan]  开启/关闭预热启动（预先导入常用模块，加快托管运行的启动）\n"
+            "[cyan]bench[/cyan] 对比冷启动与预热启动耗时，如 bench 文件名.py\n"
+            "[cyan]queue[/cyan] 查看待安装依赖队列（后台自动安装与重试）\n"
+            "[cyan]diff[/cyan]  开启/关闭增量修改（修改代码时只输出改动部分，更快更省）\n"
             "[cyan]-n[/cyan]    在对话中输入此后缀可仅生成不运行\n"
             "[cyan]r[/cyan]     切换深度思考模式\n"
-            "[cyan]c[/cyan]     切换普通模式"
+            "[cyan]c[/cyan]     切换普通模式\n"
+            "[cyan]a[/cyan]     切换模型自动选择：手动/自动/自动+先规划后编码\n"
+            "[cyan]route[/cyan] 查看自动选择模型的记录统计\n"
+            "[cyan]hedge[/cyan] 开启/关闭对冲请求（DeepSeek响应慢时同时请求通义千问，谁先回复用谁）\n"
+            "[cyan]stats[/cyan] 查看本次会话的接口调用统计（排队等待、限流次数）\n"
+            "[cyan]resume[/cyan] 恢复之前的会话（对话记忆和最后生成的代码），也可 resume 会话号\n"
+            "[cyan]fork[/cyan]  从当前位置分出对话分支，尝试另一种方案，也可 fork 名称\n"
+            "[cyan]switch[/cyan] 查看各分支（含缓存命中率），switch 名称 切换分支\n"
+            "[cyan]sync[/cyan]  一次性安装代码工具库中所有脚本的依赖（重建虚拟环境后使用）\n"
+            "[cyan]py[/cyan]    切换解释器策略：固定Python 3.9 / 为每个脚本选用兼容的最快解释器\n"
+            "[cyan]pybench[/cyan] 在本机各个Python版本上运行脚本并比较耗时，如 pybench 文件名.py\n"
+            "[cyan]prof[/cyan]  分析脚本哪里慢、哪里占内存，可让AI优化后实测对比，如 prof 文件名.py\n"
+            "[cyan]perf[/cyan]  切换提示词方案：默认 / 注重运行速度（要求AI避免常见的慢写法）\n"
+            "[cyan]export[/cyan] 把脚本和依赖打包成单个.pyz文件，换电脑无需重建环境，如 export 文件名.py\n"
+            "[cyan]gc[/cyan]    清理重复脚本、长期未运行的脚本、旧会话和不再使用的包（先预览再确认）"
         )
         console.print(Panel(help_text, title="[bold magenta]命令菜单[/bold magenta]", expand=False))
 
@@ -1232,35 +5407,141 @@ class CommandHandler:
             # 如果匹配命令，执行对应函数
             self.command_map[user_input]()
             return True  # 表示已处理命令
+        parts = user_input.split()
+        if len(parts) == 2 and parts[0] in self.arg_command_map:
+            self.arg_command_map[parts[0]](parts[1])
+            return True
         return False  # 未处理，正常走对话逻辑
 
-    def store_generated_code(self, code_content, suggested_filename):
-        """存储最新生成代码"""
+    def store_generated_code(self, code_content, suggested_filename, from_patch=False):
+        """存储最新生成代码；from_patch表示代码由本地应用补丁得到，对话记录中没有完整代码"""
         self.last_generated_code = code_content
         self.last_suggested_filename = suggested_filename
+        self.code_from_patch = from_patch
+        session_log = getattr(self.messages, "log", None)
+        if session_log:
+            session_log.record_code(code_content, suggested_filename, from_patch)
 
-# ----------------------------
-# 主函数
-# ----------------------------
-def main():
-    try:
-        global current_client_type, client
-        check_for_updates()
-        check_pending_dependencies()
-        if current_client_type == DEEPSEEK_CLIENT:
-            check_python_version()
-            if not os.path.exists(REQUIREMENTS_FILE):
-                generate_requirements()
-            setup_virtual_env()
-        
-        printer = StreamPrinter()
-        current_model = "deepseek-chat" if current_client_type == DEEPSEEK_CLIENT else "qwen-max-2025-01-25"
-        
-        def init_messages():
-            return [{
-                #提示词
-                "role": "system",
-                "content": """你是一个Python专家。在生成代码时，请遵循以下规则：
+    def handle_export(self, arg):
+        """把脚本及其依赖导出为单个.pyz文件，可选对比冷启动耗时"""
+        path = arg if os.path.exists(arg) else os.path.join(CODE_DIR, arg)
+        if not os.path.exists(path):
+            console.print(f"[red]❌ 文件不存在: {arg}[/red]")
+            return
+        output_path, manifest = export_script(path)
+        if output_path and input("\n是否对比冷启动耗时？（会新建临时虚拟环境并重新安装依赖，可能较慢）(y/n): ").strip().lower() == "y":
+            benchmark_export(path, output_path, manifest)
+
+    def handle_gc(self):
+        """预览可清理的内容和可回收的空间，确认后清理"""
+        session_log = getattr(self.messages, "log", None)
+        keep_session = os.path.abspath(session_log.dir) if session_log else None
+        console.print("\n[yellow]正在统计可清理的内容...[/yellow]")
+        candidates = collect_gc_candidates(keep_session=keep_session)
+        report_gc(candidates, storage_usage())
+        if not candidates or input("\n是否执行清理？(y/n): ").strip().lower() != "y":
+            return
+        named = [candidate for candidate in candidates if candidate["kind"] == "unused" and not candidate["generated"]]
+        if named and input(f"其中有 {len(named)} 个长期未运行的脚本是自己命名的，也一起删除吗？(y/n): ").strip().lower() != "y":
+            candidates = [candidate for candidate in candidates if candidate not in named]
+        console.print(f"\n[green]✓ 清理完成，释放 {_format_bytes(apply_gc(candidates))}[/green]")
+
+    def handle_sync(self):
+        """同步代码工具库中所有脚本的依赖"""
+        sync_library(interactive=True)
+
+    def handle_fork(self, name=None):
+        """在当前位置分出新的对话分支并切换过去"""
+        if service_client is not None:
+            console.print("\n[yellow]⚠️ 服务模式下对话保存在服务端，暂不支持分支[/yellow]")
+            return
+        try:
+            branch = self.tree.fork(name)
+        except ValueError as e:
+            console.print(f"\n[red]❌ {str(e)}[/red]")
+            return
+        console.print(f"\n[green]✓ 已从 {branch.parent_name} 分出分支 {branch.name}（共享前 {branch.fork_point} 条消息），输入 switch 查看或切换分支[/green]")
+
+    def handle_switch(self, name=None):
+        """不带参数时并排显示各分支；带分支名时切换过去"""
+        if name is None:
+            self.tree.save_current()
+            console.print("\n[cyan]对话分支（* 为当前分支）：[/cyan]")
+            for branch in self.tree.branches.values():
+                marker = "*" if branch.name == self.tree.current else " "
+                turns = sum(1 for m in node_messages(branch.head) if m["role"] == "user")
+                hit_rate = f"{branch.cache_hit_tokens / branch.prompt_tokens:.0%}" if branch.prompt_tokens else "-"
+                origin = f"从{branch.parent_name}第{branch.fork_point}条分出" if branch.parent_name else "主线"
+                code = "有代码" if branch.last_generated_code else "无代码"
+                console.print(
+                    f"{marker} [blue]{branch.name:<8}[/blue] {origin:<12} {turns}轮  请求{branch.requests}次  "
+                    f"输入{branch.prompt_tokens}tokens  缓存命中{branch.cache_hit_tokens}（{hit_rate}）  {code}"
+                )
+            return
+        try:
+            branch = self.tree.switch(name)
+        except KeyError:
+            console.print(f"\n[red]❌ 分支不存在: {name}[/red]")
+            return
+        self.store_generated_code(branch.last_generated_code, branch.last_suggested_filename, branch.code_from_patch)
+        console.print(f"\n[green]✓ 已切换到分支 {name}[/green]")
+
+    def handle_resume(self, session_id=None):
+        """恢复之前的会话：不带参数时列出最近的会话供选择"""
+        if service_client is not None:
+            console.print("\n[yellow]⚠️ 服务模式下对话保存在服务端，暂不支持恢复本地会话[/yellow]")
+            return
+        if session_id is None:
+            sessions = list_sessions()
+            if not sessions:
+                console.print("\n[yellow]⚠️ 暂无可恢复的会话[/yellow]")
+                return
+            console.print("\n[cyan]最近的会话：[/cyan]")
+            for index, (sid, mtime, prompt) in enumerate(sessions, 1):
+                preview = prompt.replace("\n", " ")[:40]
+                console.print(f"[blue]{index}.[/blue] {datetime.fromtimestamp(mtime).strftime('%m-%d %H:%M')}  {preview}")
+            choice = input("\n输入序号恢复（回车取消）: ").strip()
+            if not choice.isdigit() or not 1 <= int(choice) <= len(sessions):
+                return
+            session_id = sessions[int(choice) - 1][0]
+        if not os.path.isfile(os.path.join(SESSIONS_DIR, session_id, "log.jsonl")):
+            console.print(f"\n[red]❌ 会话不存在: {session_id}[/red]")
+            return
+        start = time.time()
+        messages, code_event, partial = replay_session(session_id)
+        log = SessionLog(session_id)
+        log._open()
+        self.messages.attach(log, messages)
+        self.messages.code_event = code_event
+        self.last_generated_code = None
+        self.last_suggested_filename = None
+        self.code_from_patch = False
+        if code_event and code_event.get("path"):
+            with open(os.path.join(log.dir, code_event["path"]), "r", encoding="utf-8") as f:
+                self.last_generated_code = f.read()
+            self.last_suggested_filename = code_event.get("filename")
+            self.code_from_patch = code_event.get("from_patch", False)
+        if partial:
+            # 上次的回答在输出过程中中断，保留已输出的部分
+            self.messages.append({"role": "assistant", "content": partial})
+            code_content, suggested_filename = extract_code_from_response(partial, verbose=False)
+            if code_content:
+                self.store_generated_code(code_content, suggested_filename)
+            console.print("[yellow]⚠️ 上次的回答在输出过程中中断，已恢复已输出的部分[/yellow]")
+        # 分支属于之前的会话，恢复后以恢复的对话重新作为 main 分支
+        dropped = self.tree.reset()
+        log.write_snapshot(self.messages)
+        turns = sum(1 for m in messages if m["role"] == "user")
+        console.print(f"\n[green]✓ 已恢复会话 {session_id}（{turns} 轮对话，耗时 {(time.time() - start) * 1000:.0f}ms）[/green]")
+        if self.last_generated_code:
+            console.print("[blue]💡 最后生成的代码也已恢复，可输入 run 或 s[/blue]")
+        if dropped:
+            console.print(f"[yellow]⚠️ 之前会话的 {dropped} 个分支已丢弃，当前为 main 分支[/yellow]")
+
+# ----------------------------
+# 系统提示词
+# ----------------------------
+SYSTEM_PROMPT = """你是一个Python专家。在生成代码时，请遵循以下规则：
 ## 基础结构
 1. 代码块格式（必须严格遵守）
 - 代码块内容必须按以下格式编写：
@@ -1276,19 +5557,15 @@ def main():
 import os
 import sys
 
-# 在导入其他包之前，确保使用正确的Python环境
-def ensure_correct_python():
-    #确保使用正确的Python环境
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    python_path = os.path.join(os.path.dirname(current_dir), "venv3.9", "Scripts", "python.exe")
-    
-    if os.path.exists(python_path) and sys.executable.lower() != python_path.lower():
-        print(f"正在切换到正确的Python环境...")
-        os.execv(python_path, [python_path] + sys.argv)
-
-# 先执行环境切换
-if __name__ == "__main__":
-    ensure_correct_python()
+# 由启动器运行时已在正确的虚拟环境中（设置了AUTOCODE_LAUNCHER），直接跳过检查
+if __name__ == "__main__" and not os.environ.get("AUTOCODE_LAUNCHER"):
+    _venv = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "venv3.9")
+    _python = os.path.join(_venv, "Scripts", "python.exe") if os.name == "nt" else os.path.join(_venv, "bin", "python")
+    if os.path.exists(_python) and os.path.normcase(os.path.realpath(sys.prefix)) != os.path.normcase(os.path.realpath(_venv)):
+        if os.name == "nt":
+            import subprocess
+            sys.exit(subprocess.call([_python] + sys.argv))
+        os.execv(_python, [_python] + sys.argv)
 
 # 在确保环境正确后，再导入其他包
 import glob
@@ -1298,7 +5575,7 @@ from datetime import datetime
 ```
 
 2. 代码规范
-- 生成的代码固定声明PYTHON39_PATH = "../venv3.9/Scripts/python.exe"
+- 上面的环境检查代码原样保留，不要修改，也不要另外声明Python解释器路径
 
 ## 编码规范
 - 强制使用UTF-8编码
@@ -1321,7 +5598,7 @@ from datetime import datetime
 ├─ 涉及非特定文件选择时，集成tkinter文件选择器
 ├─ 使用tkinter时，确保窗口内容显示完全
 ├─ 添加windll.shcore.SetProcessDpiAwareness(1)
-└─ 长操作添加进度提示（time.sleep）
+└─ 长操作用print或tqdm显示真实进度，不要用time.sleep制造等待效果
 
 ## 环境约束
 - 优先选用轻量级依赖包，不需要额外系统依赖
@@ -1333,9 +5610,1400 @@ from datetime import datetime
 3. 重新运行本程序
 这样才能确保系统级依赖生效
 """
-            }]
 
-        messages = init_messages()
+PERF_PROMPT_RULES = """
+## 性能规范
+- 不要使用time.sleep制造延时或动画效果，只有轮询、限速等确实需要等待时才使用
+- 循环中拼接字符串时先放入列表，最后用"".join()合并
+- 不要在循环中反复打开同一个文件，在循环外打开一次
+- pandas不要用iterrows逐行处理，也不要在循环中append/concat，优先使用向量化操作
+- 大文件按块读取，批量处理数据，避免重复计算
+"""
+
+PROMPT_PROFILES = {
+    "default": SYSTEM_PROMPT,
+    "perf": SYSTEM_PROMPT + PERF_PROMPT_RULES,
+}
+PROMPT_PROFILE_LABELS = {"default": "默认", "perf": "注重运行速度"}
+
+def init_messages():
+    """初始化对话记录（仅包含系统提示词）"""
+    return [{"role": "system", "content": PROMPT_PROFILES.get(prompt_profile, SYSTEM_PROMPT)}]
+
+# ----------------------------
+# 批量生成模式（无交互）
+# ----------------------------
+def read_batch_prompts(source):
+    """读取提示词：每行一个，忽略空行和#开头的注释；source为 - 时从标准输入读取"""
+    if source == "-":
+        text = sys.stdin.read()
+    else:
+        with open(source, "r", encoding="utf-8") as f:
+            text = f.read()
+    return [line.strip() for line in text.splitlines() if line.strip() and not line.strip().startswith("#")]
+
+def generate_for_prompt(index, prompt, model):
+    """批量模式下处理单个提示词：对话 → 提取代码 → 分析依赖 → 保存"""
+    record = {
+        "index": index,
+        "prompt": prompt,
+        "model": model,
+        "success": False,
+        "file": None,
+        "libs": [],
+        "queue_wait": 0.0,
+        "latency": None,
+        "first_token_latency": None,
+        "prompt_tokens": None,
+        "completion_tokens": None,
+        "error": None,
+    }
+    try:
+        messages = init_messages() + [{"role": "user", "content": prompt}]
+        response = chat_stream(messages, SilentPrinter(), model)
+        record["queue_wait"] = round(response.get("queue_wait") or 0.0, 3)
+        record["latency"] = round(response.get("latency") or 0.0, 3)
+        if response.get("first_token_latency") is not None:
+            record["first_token_latency"] = round(response["first_token_latency"], 3)
+        usage = response.get("usage")
+        if usage:
+            record["prompt_tokens"] = usage.prompt_tokens
+            record["completion_tokens"] = usage.completion_tokens
+        if not response["content"]:
+            record["error"] = "模型无响应"
+            return record
+        code_content, suggested_filename = extract_code_from_response(response["content"], verbose=False)
+        if not code_content:
+            record["error"] = "回复中未检测到代码块"
+            return record
+        code_content, perf_findings = perf_lint(code_content)
+        record["file"] = save_code_file(code_content, suggested_filename, unique=True)
+        record_perf_lint(record["file"], perf_findings)
+        record["perf_findings"] = perf_lint_counts(perf_findings)
+        record["libs"] = sorted(extract_imports(code_content, verbose=False))
+        record["success"] = True
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {str(e)}"
+    return record
+
+def run_batch(prompts, model="deepseek-chat", workers=BATCH_WORKERS, rpm=BATCH_RPM, report_path=None, install=True):
+    """并发处理多个提示词，依赖去重后统一安装，并写出JSONL报告"""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    report_path = report_path or f"batch_report_{datetime.now().strftime('%Y%m%d%H%M%S')}.jsonl"
+    # 批量请求与交互请求共用同一个限流器，这里只调整速率
+    api_governors["deepseek"].set_limits(rpm=rpm)
+    results = [None] * len(prompts)
+    start_time = time.time()
+    console.print(f"\n[yellow]开始批量生成：共 {len(prompts)} 条，并发 {workers}，每分钟最多 {rpm} 次请求[/yellow]")
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(generate_for_prompt, i, prompt, model) for i, prompt in enumerate(prompts)]
+        for done, future in enumerate(as_completed(futures), 1):
+            record = future.result()
+            results[record["index"]] = record
+            if record["success"]:
+                console.print(f"[green]✓ [{done}/{len(prompts)}] {os.path.basename(record['file'])}（{record['latency']:.1f}s）[/green]")
+            else:
+                console.print(f"[red]❌ [{done}/{len(prompts)}] 第{record['index'] + 1}条失败: {record['error']}[/red]")
+
+    # 所有脚本的依赖合并去重后只安装一次
+    lib_count = sum(len(record["libs"]) for record in results if record["success"])
+    all_libs = sorted({lib for record in results if record["success"] for lib in record["libs"]})
+    failed_libs = set()
+    if install and all_libs:
+        missing_libs = missing_dependencies(all_libs, verbose=False)
+        console.print(f"\n[yellow]依赖合计 {lib_count} 个，去重后 {len(all_libs)} 个，需安装 {len(missing_libs)} 个[/yellow]")
+        if missing_libs and not install_dependencies(missing_libs):
+            failed_libs = {lib for lib in all_libs if not is_installed(lib, verbose=False)}
+    for record in results:
+        record["deps_ok"] = record["success"] and not (set(record["libs"]) & failed_libs) if install else None
+
+    with open(report_path, "w", encoding="utf-8") as f:
+        for record in results:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    succeeded = sum(1 for record in results if record["success"])
+    total_tokens = sum((record["prompt_tokens"] or 0) + (record["completion_tokens"] or 0) for record in results)
+    console.print(f"\n[blue]批量生成完成：成功 {succeeded}/{len(prompts)}，总耗时 {time.time() - start_time:.1f}s，消耗tokens {total_tokens}[/blue]")
+    console.print(f"[blue]报告已写入: [cyan]{os.path.abspath(report_path)}[/cyan][/blue]")
+    return results
+
+def batch_cli(argv):
+    """命令行入口：python aigene.py batch prompts.txt"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="aigene.py batch", description="从文件批量生成代码（每行一个提示词）")
+    parser.add_argument("prompts", help="提示词文件路径，使用 - 从标准输入读取")
+    parser.add_argument("-o", "--report", help="JSONL报告输出路径")
+    parser.add_argument("-w", "--workers", type=int, default=BATCH_WORKERS, help="并发数")
+    parser.add_argument("--rpm", type=int, default=BATCH_RPM, help="每分钟最多请求次数")
+    parser.add_argument("-m", "--model", default="deepseek-chat", choices=["deepseek-chat", "deepseek-reasoner"])
+    parser.add_argument("--no-install", action="store_true", help="只生成和保存，不安装依赖")
+    args = parser.parse_args(argv)
+
+    prompts = read_batch_prompts(args.prompts)
+    if not prompts:
+        console.print("[yellow]⚠️ 没有读取到提示词[/yellow]")
+        return
+    check_python_version()
+    if not args.no_install:
+        setup_virtual_env()
+    run_batch(prompts, args.model, args.workers, args.rpm, args.report, install=not args.no_install)
+
+# ----------------------------
+# 同步代码工具库：并行分析所有脚本的依赖，合并后一次安装
+# ----------------------------
+def load_analysis_cache():
+    try:
+        with open(ANALYSIS_CACHE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def save_analysis_cache(cache):
+    tmp_path = ANALYSIS_CACHE_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False)
+    os.replace(tmp_path, ANALYSIS_CACHE_FILE)
+
+def analyze_script(path, cache):
+    """分析一个脚本的依赖；内容哈希命中缓存时直接复用上次的结果"""
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        code_content = f.read()
+    digest = _code_hash(code_content)
+    entry = cache.get(digest)
+    cached = entry is not None
+    if not cached:
+        try:
+            compile(code_content, path, "exec")
+            syntax_ok = True
+        except (SyntaxError, ValueError):
+            syntax_ok = False
+        entry = {
+            "libs": sorted(extract_imports(code_content, verbose=False)),
+            "syntax_ok": syntax_ok,
+            "system_deps": check_system_dependencies(code_content),
+        }
+    return {"file": path, "sha256": digest, "cached": cached, "code": code_content, **entry}
+
+def sync_library(workers=SYNC_WORKERS, interactive=False, report_path=None):
+    """同步代码工具库的依赖：并行分析 → 合并去重 → 一次解析安装 → 报告哪些脚本可以运行"""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    if not os.path.isdir(CODE_DIR):
+        console.print("[yellow]⚠️ 代码工具库目录不存在[/yellow]")
+        return []
+    paths = sorted(os.path.join(CODE_DIR, name) for name in os.listdir(CODE_DIR) if name.endswith(".py"))
+    if not paths:
+        console.print("[yellow]⚠️ 代码工具库中没有.py文件[/yellow]")
+        return []
+    start_time = time.time()
+    cache = load_analysis_cache()
+    records = []
+    with ProgressManager() as progress:
+        task = progress.add_task("[yellow]正在分析脚本依赖...[/yellow]", total=len(paths))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [executor.submit(analyze_script, path, cache) for path in paths]
+            for future in as_completed(futures):
+                try:
+                    records.append(future.result())
+                except OSError as e:
+                    console.print(f"[red]读取脚本失败: {str(e)}[/red]")
+                progress.update(task, advance=1)
+    records.sort(key=lambda record: record["file"])
+    # 只保留仍存在的脚本的分析结果，缓存不会无限增长
+    save_analysis_cache({record["sha256"]: {key: record[key] for key in ("libs", "syntax_ok", "system_deps")}
+                         for record in records})
+    hits = sum(1 for record in records if record["cached"])
+    analysis_time = time.time() - start_time
+
+    all_libs = sorted({lib for record in records if record["syntax_ok"] for lib in record["libs"]})
+    setup_virtual_env()
+    missing = missing_dependencies(all_libs, verbose=False)
+    lib_count = sum(len(record["libs"]) for record in records)
+    console.print(
+        f"\n[yellow]共 {len(records)} 个脚本（分析缓存命中 {hits} 个，用时 {analysis_time:.1f}s），"
+        f"依赖合计 {lib_count} 个，去重后 {len(all_libs)} 个，需安装 {len(missing)} 个[/yellow]"
+    )
+    install_time = 0.0
+    if missing:
+        missing = precheck_pins(missing, interactive)
+    if missing:
+        install_start = time.time()
+        with install_lock.hold(missing):
+            if install_lock.waited:
+                missing = missing_dependencies(missing, verbose=False)
+            if missing:
+                console.print(f"[yellow]⏳ 正在一次性安装 {len(missing)} 个包: {', '.join(missing)}[/yellow]")
+                ok, error = pip_install_quiet(missing)
+                if not ok:
+                    console.print(f"[red]批量安装失败: {error}，改为逐个安装以找出失败的包[/red]")
+                    with ProgressManager() as progress:
+                        task = progress.add_task("[yellow]逐个安装依赖...[/yellow]", total=len(missing))
+                        for lib in missing:
+                            lib_ok, _ = pip_install_quiet([lib])
+                            console.print(f"[green]✓ {lib}[/green]" if lib_ok else f"[red]❌ {lib}[/red]")
+                            progress.update(task, advance=1)
+                mark_venv_changed()
+        install_time = time.time() - install_start
+
+    # 安装后重新读取一次元数据，逐个脚本判断是否已可运行，可运行的写入锁文件
+    distributions = read_venv_distributions()
+    for record in records:
+        record["missing"] = missing_dependencies(record["libs"], verbose=False, distributions=distributions)
+        record["runnable"] = record["syntax_ok"] and not record["missing"] and not record["system_deps"]
+        if record["runnable"] and not load_script_lock(record["file"], record["code"]):
+            write_script_lock(record["file"], record["code"], record["libs"])
+
+    console.print("\n[cyan]同步结果：[/cyan]")
+    for record in records:
+        name = os.path.basename(record["file"])
+        if record["runnable"]:
+            console.print(f"[green]✓ {name}[/green]")
+        elif not record["syntax_ok"]:
+            console.print(f"[red]❌ {name}（语法错误）[/red]")
+        elif record["missing"]:
+            console.print(f"[red]❌ {name}（缺少: {', '.join(record['missing'])}）[/red]")
+        else:
+            console.print(f"[yellow]⚠️ {name}（需要先安装系统级依赖）[/yellow]")
+    runnable = sum(1 for record in records if record["runnable"])
+    console.print(
+        f"\n[blue]同步完成：{runnable}/{len(records)} 个脚本可以运行，"
+        f"分析 {analysis_time:.1f}s，安装 {install_time:.1f}s，总耗时 {time.time() - start_time:.1f}s[/blue]"
+    )
+    if report_path:
+        with open(report_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps({key: value for key, value in record.items() if key != "code"}, ensure_ascii=False) + "\n")
+        console.print(f"[blue]报告已写入: [cyan]{os.path.abspath(report_path)}[/cyan][/blue]")
+    return records
+
+def sync_cli(argv):
+    """命令行入口：python aigene.py sync（可在夜间等无人值守时运行）"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="aigene.py sync", description="分析代码工具库中所有脚本的依赖并一次性安装")
+    parser.add_argument("-o", "--report", help="JSONL报告输出路径")
+    parser.add_argument("-w", "--workers", type=int, default=SYNC_WORKERS, help="并行分析的线程数")
+    args = parser.parse_args(argv)
+    check_python_version()
+    sync_library(args.workers, interactive=False, report_path=args.report)
+
+# ----------------------------
+# 导出：脚本 + 锁定的依赖 → 单文件zipapp（.pyz），纯Python包直接从压缩包导入，
+# 含编译扩展或数据文件的包首次运行时解压到缓存目录
+# ----------------------------
+EXPORT_BOOTSTRAP_SOURCE = r'''
+# 由 AutoCode-Runner 导出：纯Python依赖直接从压缩包导入，含编译扩展或数据文件的包首次运行时解压到缓存目录
+import os, sys, json, shutil, zipfile, tempfile, runpy
+
+def cache_root():
+    base = os.environ.get("LOCALAPPDATA") if sys.platform == "win32" else os.environ.get("XDG_CACHE_HOME")
+    return os.path.join(base or os.path.join(os.path.expanduser("~"), ".cache"), "autocode-runner", "exports")
+
+def unpack_native(archive, build_id):
+    target = os.path.join(cache_root(), build_id)
+    if os.path.isdir(target):
+        return target
+    os.makedirs(cache_root(), exist_ok=True)
+    staging = tempfile.mkdtemp(dir=cache_root())
+    with zipfile.ZipFile(archive) as zf:
+        for name in zf.namelist():
+            if name.startswith("_native/") and not name.endswith("/"):
+                path = os.path.join(staging, *name[len("_native/"):].split("/"))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with zf.open(name) as src, open(path, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+    try:
+        os.rename(staging, target)
+    except OSError:
+        # 其他进程已先解压完成
+        shutil.rmtree(staging, ignore_errors=True)
+    return target
+
+def main():
+    archive = os.path.dirname(os.path.abspath(__file__))
+    with zipfile.ZipFile(archive) as zf:
+        manifest = json.loads(zf.read("_export/manifest.json").decode("utf-8"))
+    if manifest["native"]:
+        if "%d.%d" % sys.version_info[:2] != manifest["python"]:
+            sys.stderr.write("警告：导出时使用Python %s，当前为Python %d.%d，编译扩展可能无法加载\n"
+                             % ((manifest["python"],) + tuple(sys.version_info[:2])))
+        sys.path.insert(0, unpack_native(archive, manifest["build_id"]))
+    sys.path.insert(0, os.path.join(archive, "lib"))
+    # 依赖已随压缩包提供，脚本无需再检查或切换虚拟环境
+    os.environ.setdefault("AUTOCODE_LAUNCHER", "1")
+    runpy.run_module("_tool_main", run_name="__main__", alter_sys=True)
+
+main()
+'''
+EXPORT_CACHE_PARTS = ("autocode-runner", "exports")
+
+def export_cache_dir(build_id):
+    """导出文件解压编译扩展的缓存目录（与 EXPORT_BOOTSTRAP_SOURCE 中的规则一致）"""
+    base = os.getenv("LOCALAPPDATA") if sys.platform == "win32" else os.getenv("XDG_CACHE_HOME")
+    return os.path.join(base or os.path.join(os.path.expanduser("~"), ".cache"), *EXPORT_CACHE_PARTS, build_id)
+
+def venv_base_python(venv_dir=None):
+    """虚拟环境所基于的解释器（pyvenv.cfg 中的 home），找不到时返回None"""
+    cfg_path = Path(venv_dir or VENV_DIR).absolute() / "pyvenv.cfg"
+    try:
+        lines = cfg_path.read_text(encoding="utf-8", errors="replace").splitlines()
+    except OSError:
+        return None
+    cfg = {key.strip(): value.strip() for key, _, value in (line.partition("=") for line in lines)}
+    version = cfg.get("version_info") or cfg.get("version", "")
+    minor = ".".join(version.split(".")[:2])
+    home = cfg.get("home", "")
+    names = ["python.exe"] if sys.platform == "win32" else [f"python{minor}", "python3", "python"]
+    for name in names:
+        path = os.path.join(home, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+def distribution_files(dist):
+    """按RECORD列出包安装到site-packages中的文件（相对路径），跳过字节码和site-packages之外的文件"""
+    record = Path(dist["path"]) / "RECORD"
+    if not record.is_file():
+        return None
+    files = []
+    for line in record.read_text(encoding="utf-8", errors="replace").splitlines():
+        path = line.split(",")[0].strip()
+        if not path or path.startswith("..") or os.path.isabs(path):
+            continue
+        if path.endswith(".pyc") or "__pycache__/" in path or path.endswith(".pth"):
+            continue
+        files.append(path)
+    return files
+
+def needs_extraction(files):
+    """包中有.py以外的文件（编译扩展、数据文件）时不能直接从压缩包导入，需要首次运行时解压"""
+    for path in files:
+        if ".dist-info/" in path or ".egg-info/" in path:
+            continue
+        if not path.endswith((".py", ".pyi", "py.typed")):
+            return True
+    return False
+
+def export_script(filename, output_dir=EXPORT_DIR):
+    """把脚本和锁定的依赖打包成单个.pyz文件，返回 (导出文件路径, 清单)，失败返回 (None, None)"""
+    import zipfile
+    import tempfile
+    import hashlib
+    with open(filename, "r", encoding="utf-8") as f:
+        code_content = f.read()
+    if not ensure_script_dependencies(code_content, filename):
+        console.print("[red]❌ 依赖未就绪，无法导出[/red]")
+        return None, None
+    lock = load_script_lock(filename, code_content) or write_script_lock(filename, code_content)
+    if not lock:
+        return None, None
+    if lock["unresolved"]:
+        console.print(f"[yellow]⚠️ 以下依赖在虚拟环境中找不到，不会打包: {', '.join(lock['unresolved'])}[/yellow]")
+    base_python = venv_base_python()
+    python_path = setup_virtual_env()
+    distributions = read_venv_distributions()
+    start_time = time.time()
+    staging = tempfile.mkdtemp(prefix="autocode_export_")
+    try:
+        shutil.copyfile(filename, os.path.join(staging, "_tool_main.py"))
+        with open(os.path.join(staging, "__main__.py"), "w", encoding="utf-8") as f:
+            f.write(EXPORT_BOOTSTRAP_SOURCE.lstrip())
+        pure, native = [], []
+        for name, version in lock["distributions"].items():
+            dist = distributions.get(normalize_dist_name(name))
+            files = distribution_files(dist) if dist else None
+            if files is None:
+                console.print(f"[yellow]⚠️ 找不到 {name} 的文件清单（RECORD），不会打包[/yellow]")
+                continue
+            extract = needs_extraction(files)
+            (native if extract else pure).append(f"{name}=={version}")
+            site_dir = Path(dist["path"]).parent
+            target_dir = os.path.join(staging, "_native" if extract else "lib")
+            for path in files:
+                source = site_dir / path
+                if source.is_file():
+                    target = os.path.join(target_dir, *path.split("/"))
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.copyfile(source, target)
+        # 预编译为与源文件并列的.pyc（zipimport只认这种位置），不校验源文件，压缩包内容不会再变
+        subprocess.run(
+            [python_path, "-m", "compileall", "-q", "-b", "--invalidation-mode", "unchecked-hash",
+             os.path.join(staging, "_tool_main.py"), os.path.join(staging, "lib")],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(staging):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, staging).replace(os.sep, "/").encode("utf-8"))
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+        python_minor = subprocess.run([python_path, "-c", "import sys; print('%d.%d' % sys.version_info[:2])"],
+                                      capture_output=True, text=True).stdout.strip()
+        manifest = {
+            "script": os.path.basename(filename),
+            "build_id": digest.hexdigest()[:16],
+            "python": python_minor,
+            "pure": sorted(pure),
+            "native": sorted(native),
+            "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        os.makedirs(os.path.join(staging, "_export"))
+        with open(os.path.join(staging, "_export", "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = os.path.join(output_dir, os.path.splitext(os.path.basename(filename))[0] + ".pyz")
+        tmp_path = output_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"#!/usr/bin/env python3\n")
+            with zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as archive:
+                for root, dirs, files in os.walk(staging):
+                    dirs.sort()
+                    for name in sorted(files):
+                        path = os.path.join(root, name)
+                        archive.write(path, os.path.relpath(path, staging).replace(os.sep, "/"))
+        os.replace(tmp_path, output_path)
+        if os.name == "posix":
+            os.chmod(output_path, 0o755)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    manifest["base_python"] = base_python
+    console.print(
+        f"[green]✓ 已导出: {os.path.abspath(output_path)}（{_format_bytes(os.path.getsize(output_path))}，"
+        f"用时 {time.time() - start_time:.1f}s）[/green]"
+    )
+    console.print(f"[blue]直接打包的纯Python包: {', '.join(manifest['pure']) or '无'}[/blue]")
+    if manifest["native"]:
+        console.print(f"[blue]首次运行时解压的包（含编译扩展或数据文件）: {', '.join(manifest['native'])}[/blue]")
+        console.print(f"[yellow]提示：含编译扩展时，目标电脑需使用 Python {python_minor} 及相同的操作系统[/yellow]")
+    console.print(f"[blue]运行方式: python {os.path.basename(output_path)}（需要 Python {python_minor}，无需创建虚拟环境）[/blue]")
+    return output_path, manifest
+
+def benchmark_export(filename, output_path, manifest, repeat=3):
+    """对比冷启动耗时：新建虚拟环境并安装依赖后运行 / 导出文件首次运行（含解压）/ 导出文件再次运行"""
+    import tempfile
+    base_python = manifest.get("base_python")
+    if not base_python:
+        console.print("[red]❌ 找不到虚拟环境所基于的解释器，无法对比[/red]")
+        return None
+    with open(filename, "r", encoding="utf-8") as f:
+        lock = load_script_lock(filename, f.read())
+    specs = [f"{name}=={version}" for name, version in (lock or {}).get("distributions", {}).items()]
+    console.print("\n[yellow]⏳ 正在模拟原有流程：新建虚拟环境 → 安装依赖 → 运行...[/yellow]")
+    venv_root = tempfile.mkdtemp(prefix="autocode_export_bench_")
+    try:
+        start = time.time()
+        subprocess.run([base_python, "-m", "venv", venv_root], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        venv_time = time.time() - start
+        python_path = get_venv_python_path(Path(venv_root))
+        start = time.time()
+        if specs and not pip_install_exact(specs, quiet=True, python_path=python_path):
+            console.print("[red]❌ 在临时虚拟环境中安装依赖失败，无法对比[/red]")
+            return None
+        install_time = time.time() - start
+        run = ManagedRun(python_path, filename, echo=False, interactive=False).start()
+        run.wait()
+        venv_run = run.result()
+    except (subprocess.CalledProcessError, OSError) as e:
+        console.print(f"[red]❌ 创建临时虚拟环境失败: {str(e)}[/red]")
+        return None
+    finally:
+        shutil.rmtree(venv_root, ignore_errors=True)
+
+    def run_export():
+        run = ManagedRun(base_python, output_path, echo=False, interactive=False, launcher_marker=False).start()
+        run.wait()
+        return run.result()
+
+    cold = []
+    warm = []
+    for _ in range(repeat):
+        shutil.rmtree(export_cache_dir(manifest["build_id"]), ignore_errors=True)
+        cold.append(run_export())
+        warm.append(run_export())
+    def median(results):
+        return sorted(result["duration"] for result in results)[len(results) // 2]
+
+    summary = {
+        "venv": venv_time + install_time + venv_run["duration"],
+        "export_cold": median(cold),
+        "export_warm": median(warm),
+    }
+    console.print(f"\n[cyan]{'总耗时':>7}{'退出码':>6}  方式[/cyan]")
+    console.print(f"{summary['venv']:>9.2f}s{venv_run['exit_code']:>9}  新建环境+安装+运行")
+    console.print(f"[blue]{'':21}创建环境 {venv_time:.2f}s，安装 {len(specs)} 个包 {install_time:.2f}s，运行 {venv_run['duration']:.2f}s[/blue]")
+    console.print(f"{summary['export_cold']:>9.2f}s{cold[-1]['exit_code']:>9}  导出文件首次运行（含解压）")
+    console.print(f"{summary['export_warm']:>9.2f}s{warm[-1]['exit_code']:>9}  导出文件再次运行")
+    if summary["export_cold"] > 0:
+        console.print(f"[green]导出文件首次运行比原有流程快 {summary['venv'] / summary['export_cold']:.1f} 倍[/green]")
+    return summary
+
+# ----------------------------
+# 存储清理：重复脚本、长期未运行的脚本、旧会话、遗留文件，以及虚拟环境中不再被任何脚本使用的包
+# ----------------------------
+GC_KIND_LABELS = {
+    "temp": "遗留的临时文件",
+    "log": "错误日志",
+    "session": "旧会话记录",
+    "leftover": "失效的锁文件、备份和导出文件",
+    "duplicate": "内容重复的脚本",
+    "venv_package": "虚拟环境中不再使用的包",
+    "unused": "长期未运行的脚本",
+}
+# 按预算自动清理时按此顺序，先清理最没有保留价值的
+GC_KIND_ORDER = list(GC_KIND_LABELS)
+GC_PROTECTED_DISTS = {"pip", "setuptools", "wheel", "packaging"}
+GC_TEMP_PATTERNS = ("autocode_prof_*", "autocode_export_*")
+HOST_SCRIPTS = ("aigene.py", "updater.py", "version_check_update.py", "warm_launcher.py")
+
+def host_requirements():
+    """本程序自身需要的包：requirements.txt 与程序文件中的第三方导入"""
+    libs = set()
+    if os.path.exists(REQUIREMENTS_FILE):
+        with open(REQUIREMENTS_FILE, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                name = split_requirement(line.split("#")[0].strip())[0]
+                if name:
+                    libs.add(name)
+    host_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in HOST_SCRIPTS:
+        try:
+            with open(os.path.join(host_dir, name), "r", encoding="utf-8") as f:
+                libs.update(extract_import_names(f.read()))
+        except OSError:
+            continue
+    return libs
+
+def path_size(path):
+    """文件或目录占用的字节数"""
+    if not os.path.isdir(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def storage_usage():
+    """程序产生的文件的占用：{类别: 字节数}"""
+    log_files = [RUN_HISTORY_FILE, ROUTING_LOG_FILE, "update_error.log", ANALYSIS_CACHE_FILE, PERF_LINT_FILE,
+                 TTFT_STATS_FILE, WHEEL_INFO_CACHE_FILE, INTERPRETER_BENCH_FILE]
+    venv_dirs = {VENV_DIR} | {str(path) for path in Path(".").glob("venv3.*") if path.is_dir()}
+    return {
+        "代码工具库": path_size(CODE_DIR),
+        "会话记录": path_size(SESSIONS_DIR),
+        "虚拟环境": sum(path_size(path) for path in venv_dirs),
+        "导出文件": path_size(EXPORT_DIR),
+        "日志与缓存": sum(path_size(path) for path in log_files),
+    }
+
+def last_run_times():
+    """各脚本最后一次运行的时间：{绝对路径: 时间戳}"""
+    last_runs = {}
+    for entry in load_run_history():
+        try:
+            timestamp = datetime.strptime(entry["timestamp"], "%Y-%m-%d %H:%M:%S").timestamp()
+            path = os.path.abspath(entry["file"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        last_runs[path] = max(timestamp, last_runs.get(path, 0))
+    return last_runs
+
+def distribution_modules(dist):
+    """包提供的顶层模块：优先用top_level.txt，没有时按RECORD推断"""
+    if dist["top_level"]:
+        return dist["top_level"]
+    modules = set()
+    for path in distribution_files(dist) or []:
+        first = path.split("/")[0]
+        if first.endswith((".dist-info", ".egg-info", ".data")):
+            continue
+        modules.add(first if "/" in path else first.split(".")[0])
+    return sorted(modules)
+
+def unused_venv_packages(scripts):
+    """虚拟环境中不属于任何脚本依赖闭包的包：[(包信息, 字节数)]"""
+    distributions = read_venv_distributions()
+    for dist in distributions.values():
+        dist["top_level"] = distribution_modules(dist)
+    cache = load_analysis_cache()
+    libs = set()
+    for path in scripts:
+        try:
+            libs.update(analyze_script(path, cache)["libs"])
+        except OSError:
+            continue
+    # 本程序也运行在这个虚拟环境中，它自己的依赖闭包同样保留
+    libs.update(host_requirements())
+    used, _ = resolve_installed_closure(sorted(libs), distributions)
+    keep = {normalize_dist_name(name) for name in used} | GC_PROTECTED_DISTS
+    unused = []
+    for key, dist in sorted(distributions.items()):
+        if key in keep:
+            continue
+        site_dir = Path(dist["path"]).parent
+        size = path_size(dist["path"]) + sum(path_size(site_dir / path) for path in distribution_files(dist) or [])
+        unused.append((dist, size))
+    return unused
+
+def collect_gc_candidates(unused_days=GC_UNUSED_DAYS, session_days=GC_SESSION_DAYS, keep_session=None, include_venv=True):
+    """找出可以清理的内容：[{kind, paths, bytes, reason, last_used, generated, package}]"""
+    import fnmatch
+    import hashlib
+    import tempfile
+    import zipfile
+    now = time.time()
+    candidates = []
+
+    def add(kind, paths, reason, last_used=0.0, generated=False, package=None, size=None):
+        paths = [path for path in paths if os.path.lexists(path)]
+        if paths or package:
+            candidates.append({
+                "kind": kind, "paths": paths, "reason": reason, "last_used": last_used, "generated": generated,
+                "package": package, "bytes": size if size is not None else sum(path_size(path) for path in paths),
+            })
+
+    def companions(path):
+        return [path, lock_path_for(path), path + ".bak"]
+
+    scripts = []
+    if os.path.isdir(CODE_DIR):
+        for name in sorted(os.listdir(CODE_DIR)):
+            path = os.path.abspath(os.path.join(CODE_DIR, name))
+            if name.endswith("_优化候选.py"):
+                add("temp", [path], "性能优化中断后留下的候选脚本")
+            elif name.endswith(".py"):
+                scripts.append(path)
+    script_set = set(scripts)
+
+    # 脚本的最后使用时间：最后一次运行与最后一次修改中较晚的一个
+    last_runs = last_run_times()
+    last_used = {path: max(last_runs.get(path, 0), os.path.getmtime(path)) for path in scripts}
+    groups = {}
+    for path in scripts:
+        with open(path, "rb") as f:
+            groups.setdefault(hashlib.sha256(f.read()).hexdigest(), []).append(path)
+    duplicates = set()
+    for paths in groups.values():
+        if len(paths) < 2:
+            continue
+        # 保留自己命名的、最近运行过的那个；都没运行过时保留最早的原件
+        keep = max(paths, key=lambda path: (not os.path.basename(path).startswith("generated_"),
+                                            last_runs.get(path, 0), -os.path.getmtime(path)))
+        for path in paths:
+            if path != keep:
+                duplicates.add(path)
+                add("duplicate", companions(path), f"与 {os.path.basename(keep)} 内容相同", last_used[path],
+                    os.path.basename(path).startswith("generated_"))
+    for path in scripts:
+        idle_days = (now - last_used[path]) / 86400
+        if path not in duplicates and idle_days > unused_days:
+            add("unused", companions(path), f"{idle_days:.0f} 天未运行", last_used[path],
+                os.path.basename(path).startswith("generated_"))
+
+    if os.path.isdir(CODE_DIR):
+        for name in sorted(os.listdir(CODE_DIR)):
+            path = os.path.abspath(os.path.join(CODE_DIR, name))
+            if name.endswith(LOCK_SUFFIX) and path[:-len(LOCK_SUFFIX)] + ".py" not in script_set:
+                add("leftover", [path], "对应的脚本已不存在")
+            elif name.endswith(".py.bak") and path[:-4] not in script_set:
+                add("leftover", [path], "对应的脚本已不存在")
+    if os.path.isdir(EXPORT_DIR):
+        for name in sorted(os.listdir(EXPORT_DIR)):
+            path = os.path.abspath(os.path.join(EXPORT_DIR, name))
+            if not name.endswith(".pyz"):
+                continue
+            try:
+                with zipfile.ZipFile(path) as archive:
+                    script = json.loads(archive.read("_export/manifest.json").decode("utf-8"))["script"]
+            except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+                continue
+            if os.path.abspath(os.path.join(CODE_DIR, script)) not in script_set:
+                add("leftover", [path], "导出时的脚本已不存在")
+
+    temp_dir = tempfile.gettempdir()
+    for name in sorted(os.listdir(temp_dir)):
+        path = os.path.join(temp_dir, name)
+        try:
+            # 一天内的可能仍在使用
+            stale = now - os.path.getmtime(path) > 86400
+        except OSError:
+            continue
+        if stale and any(fnmatch.fnmatch(name, pattern) for pattern in GC_TEMP_PATTERNS):
+            add("temp", [path], "性能分析或导出中断后留下的临时文件")
+    add("log", ["update_error.log"], "更新失败时留下的错误日志")
+
+    if os.path.isdir(SESSIONS_DIR):
+        for name in sorted(os.listdir(SESSIONS_DIR)):
+            path = os.path.abspath(os.path.join(SESSIONS_DIR, name))
+            if not os.path.isdir(path) or path == keep_session:
+                continue
+            log_path = os.path.join(path, "log.jsonl")
+            modified = os.path.getmtime(log_path if os.path.exists(log_path) else path)
+            idle_days = (now - modified) / 86400
+            if idle_days > session_days:
+                add("session", [path], f"{idle_days:.0f} 天前的会话", modified)
+
+    if include_venv and os.path.isdir(VENV_DIR):
+        # 被清理的脚本不再计入依赖
+        remaining = [path for path in scripts
+                     if not any(path in candidate["paths"] for candidate in candidates if candidate["kind"] == "duplicate")]
+        for dist, size in unused_venv_packages(remaining):
+            add("venv_package", [], f"版本 {dist['version']}，没有脚本用到", package=dist["name"], size=size)
+    return candidates
+
+def report_gc(candidates, usage):
+    """显示清理预览：各类占用，以及每类可回收的内容和字节数（不做任何删除）"""
+    console.print("\n[cyan]当前占用：[/cyan]")
+    for label, size in usage.items():
+        console.print(f"{_format_bytes(size):>10}  {label}")
+    console.print(f"[cyan]{_format_bytes(sum(usage.values())):>10}  合计[/cyan]")
+    if not candidates:
+        console.print("\n[green]✓ 没有需要清理的内容[/green]")
+        return
+    console.print("\n[cyan]可以清理：[/cyan]")
+    for kind in GC_KIND_ORDER:
+        items = [candidate for candidate in candidates if candidate["kind"] == kind]
+        if not items:
+            continue
+        console.print(f"\n[yellow]{GC_KIND_LABELS[kind]}（{len(items)} 项，{_format_bytes(sum(item['bytes'] for item in items))}）[/yellow]")
+        for item in items[:10]:
+            name = item["package"] or os.path.relpath(item["paths"][0])
+            console.print(f"{_format_bytes(item['bytes']):>10}  {name}  [blue]{item['reason']}[/blue]")
+        if len(items) > 10:
+            console.print(f"{'':>10}  ……等 {len(items)} 项")
+    total = sum(candidate["bytes"] for candidate in candidates)
+    console.print(f"\n[green]预计可回收 {_format_bytes(total)}[/green]")
+
+def apply_gc(candidates):
+    """执行清理，返回实际回收的字节数"""
+    reclaimed = 0
+    packages = [candidate for candidate in candidates if candidate["package"]]
+    for candidate in candidates:
+        if candidate["package"]:
+            continue
+        for path in candidate["paths"]:
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                console.print(f"[yellow]⚠️ 删除 {path} 失败: {str(e)}[/yellow]")
+                break
+        else:
+            reclaimed += candidate["bytes"]
+    if packages:
+        names = [candidate["package"] for candidate in packages]
+        with install_lock.hold(names):
+            console.print(f"[yellow]⏳ 正在从虚拟环境卸载 {len(names)} 个包: {', '.join(names)}[/yellow]")
+            result = subprocess.run([setup_virtual_env(), "-m", "pip", "uninstall", "-y"] + names,
+                                    capture_output=True, text=True, encoding="utf-8", errors="replace")
+            mark_venv_changed()
+        if result.returncode == 0:
+            reclaimed += sum(candidate["bytes"] for candidate in packages)
+        else:
+            console.print(f"[red]卸载失败: {(result.stderr.strip().splitlines() or [''])[-1]}[/red]")
+    return reclaimed
+
+def select_for_budget(candidates, excess):
+    """按清理顺序（同类中最久未用的优先）选出足以回到预算内的内容；不会删除自己命名的脚本"""
+    allowed = [candidate for candidate in candidates if candidate["kind"] not in ("duplicate", "unused") or candidate["generated"]]
+    allowed.sort(key=lambda candidate: (GC_KIND_ORDER.index(candidate["kind"]), candidate["last_used"]))
+    selected = []
+    for candidate in allowed:
+        if excess <= 0:
+            break
+        selected.append(candidate)
+        excess -= candidate["bytes"]
+    return selected
+
+def enforce_storage_budget(budget_mb=STORAGE_BUDGET_MB):
+    """启动时检查占用，超出预算时自动清理"""
+    if budget_mb <= 0:
+        return 0
+    total = sum(storage_usage().values())
+    budget = budget_mb * 1024 * 1024
+    if total <= budget:
+        return 0
+    # 自动清理不卸载虚拟环境中的包，卸载需在 gc 中确认
+    selected = select_for_budget(collect_gc_candidates(include_venv=False), total - budget)
+    reclaimed = apply_gc(selected)
+    console.print(
+        f"[yellow]⚠️ 占用 {_format_bytes(total)} 超出存储预算 {_format_bytes(budget)}，"
+        f"已自动清理 {len(selected)} 项，释放 {_format_bytes(reclaimed)}[/yellow]"
+    )
+    if total - reclaimed > budget:
+        console.print("[yellow]💡 仍超出预算，请输入 gc 查看可清理的内容（自己命名的脚本和虚拟环境中的包不会被自动删除）[/yellow]")
+    return reclaimed
+
+def gc_cli(argv):
+    """命令行入口：python aigene.py gc（默认只预览，加 --apply 才会删除）"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="aigene.py gc", description="清理重复脚本、长期未运行的脚本、旧会话和虚拟环境中不再使用的包")
+    parser.add_argument("--apply", action="store_true", help="执行清理（默认只显示可回收的空间）")
+    parser.add_argument("--budget", type=float, default=0, help="只清理到总占用不超过该值（MB），不删除自己命名的脚本")
+    parser.add_argument("--days", type=int, default=GC_UNUSED_DAYS, help="超过多少天未运行的脚本视为不再使用")
+    parser.add_argument("--no-venv", action="store_true", help="不检查虚拟环境中的包")
+    args = parser.parse_args(argv)
+    usage = storage_usage()
+    candidates = collect_gc_candidates(unused_days=args.days, include_venv=not args.no_venv)
+    if args.budget > 0:
+        candidates = select_for_budget(candidates, sum(usage.values()) - args.budget * 1024 * 1024)
+    report_gc(candidates, usage)
+    if args.apply and candidates:
+        console.print(f"\n[green]✓ 清理完成，释放 {_format_bytes(apply_gc(candidates))}[/green]")
+    elif candidates:
+        console.print("[blue]以上为预览，加 --apply 执行清理[/blue]")
+
+# ----------------------------
+# 一轮对话（交互模式与服务模式共用）
+# ----------------------------
+def generate_reply(messages, state, printer, user_input, model, routing="off"):
+    """一轮对话：自动选模型 → 增量修改或普通对话 → 提取代码并记录到state。
+    state需有 last_generated_code、last_suggested_filename、code_from_patch 与 store_generated_code()；
+    有tree（对话分支）时，本轮请求的用量计入当前分支。
+    返回 (代码结果, 本轮回复)，代码结果为 (代码, 建议文件名) 或 None"""
+    verbose = not printer.silent
+    turn_model = model
+    decision = None
+    if routing != "off" and current_client_type == DEEPSEEK_CLIENT:
+        decision = route_model(user_input, messages, state.last_generated_code)
+        turn_model = decision["model"]
+        if verbose:
+            console.print(f"[dim]自动选择模型：{turn_model}[/dim]")
+    turn_start = time.time()
+    response = None
+    tree = getattr(state, "tree", None)
+    record_usage = (lambda result: tree.record_usage(result.get("usage"))) if tree else None
+
+    if is_edit_request(user_input, state.last_generated_code):
+        edited_code, from_patch = request_code_edit(
+            messages, printer, turn_model, user_input,
+            state.last_generated_code, include_code=state.code_from_patch, on_response=record_usage
+        )
+        code_result = (edited_code, state.last_suggested_filename)
+    else:
+        messages.append({"role": "user", "content": user_input})
+        wants_code = any(kw in user_input for kw in ["写", "代码", "生成"])
+        if routing == "cascade" and turn_model == "deepseek-reasoner" and wants_code:
+            response = cascade_chat(messages, printer)
+        else:
+            response = chat_stream(messages, printer, turn_model)
+        printer.reset()
+        if record_usage:
+            # 级联模式下只计入带对话前缀的编码请求，规划请求的用量在plan_usage中
+            record_usage(response)
+        messages.append({"role": "assistant", "content": response["content"]})
+        code_result = extract_code_from_response(response["content"], verbose=verbose)
+        from_patch = False
+
+    if decision:
+        log_routing_decision(
+            decision, routing, time.time() - turn_start, response,
+            produced_code=bool(code_result and code_result[0])
+        )
+    if code_result and code_result[0]:
+        state.store_generated_code(code_result[0], code_result[1], from_patch)
+        return code_result, response
+    return None, response
+
+# ----------------------------
+# 本地服务模式：多人共用一个进程（共享虚拟环境、wheel缓存、接口连接与限流）
+# python aigene.py serve 启动服务；在.env中设置 AIGENE_SERVER=http://地址:端口 后，交互界面作为瘦客户端使用服务
+# ----------------------------
+SERVICE_HOST = os.getenv("SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.getenv("SERVICE_PORT", "8765"))
+SERVICE_TOKEN = os.getenv("SERVICE_TOKEN", "")
+SERVICE_TOKEN_FILE = ".service_token"  # 未设置SERVICE_TOKEN时服务自动生成访问密码，本机客户端从这里读取
+SERVICE_SESSION_TTL = float(os.getenv("SERVICE_SESSION_TTL", "3600"))
+SERVICE_MAX_BODY = 8 * 1024 * 1024  # 请求体上限（字节）
+LOOPBACK_HOSTS = {"127.0.0.1", "localhost", "::1"}
+
+def service_token():
+    """客户端使用的访问密码：优先SERVICE_TOKEN，否则读取本机服务生成的密码文件"""
+    if SERVICE_TOKEN:
+        return SERVICE_TOKEN
+    try:
+        with open(SERVICE_TOKEN_FILE, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+def generate_service_token():
+    """生成随机访问密码并写入密码文件（仅当前用户可读）"""
+    import secrets
+    token = secrets.token_urlsafe(24)
+    fd = os.open(SERVICE_TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(token)
+    return token
+
+class ServiceSession:
+    """服务端保存的会话：对话记录与最后生成的代码"""
+    def __init__(self, session_id):
+        self.id = session_id
+        self.messages = init_messages()
+        self.lock = Lock()
+        self.last_active = time.time()
+        self.last_generated_code = None
+        self.last_suggested_filename = None
+        self.code_from_patch = False
+
+    def store_generated_code(self, code_content, suggested_filename, from_patch=False):
+        self.last_generated_code = code_content
+        self.last_suggested_filename = suggested_filename
+        self.code_from_patch = from_patch
+
+class ServiceSessions:
+    """会话表：长时间未使用的会话自动清理"""
+    def __init__(self, ttl=SERVICE_SESSION_TTL):
+        self.ttl = ttl
+        self.sessions = {}
+        self.lock = Lock()
+
+    def create(self):
+        with self.lock:
+            self._expire()
+            session = ServiceSession(uuid.uuid4().hex[:12])
+            self.sessions[session.id] = session
+            return session
+
+    def get(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session:
+                session.last_active = time.time()
+            return session
+
+    def remove(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def _expire(self):
+        now = time.time()
+        for session_id in [s.id for s in self.sessions.values() if now - s.last_active > self.ttl and not s.lock.locked()]:
+            del self.sessions[session_id]
+
+class EventPrinter(StreamPrinter):
+    """把流式输出转成SSE事件写给客户端；客户端断开后继续完成本轮（结果仍保存在会话中）"""
+    silent = True
+
+    def __init__(self, send_event):
+        super().__init__()
+        self.send_event = send_event
+        self.disconnected = False
+
+    def stream_print(self, content):
+        if content and not self.disconnected:
+            try:
+                self.send_event({"type": "delta", "content": content})
+            except OSError:
+                self.disconnected = True
+
+    def reset(self):
+        pass
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """服务接口（JSON）：
+    POST /sessions                 创建会话
+    DELETE /sessions/<id>          删除会话
+    POST /sessions/<id>/reset      清除会话记忆
+    POST /sessions/<id>/chat       对话（SSE流式返回：delta事件，最后一个done事件带代码）
+    POST /extract                  从回复文本提取代码和依赖
+    POST /install                  安装依赖
+    POST /run                      保存并在后台运行代码，返回任务号
+    GET  /jobs/<id>                查看后台任务状态和输出
+    GET  /stats                    接口调用统计"""
+    sessions = None
+    token = ""
+    loopback_only = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_event(self, data):
+        self.wfile.write(("data: " + json.dumps(data, ensure_ascii=False) + "\n\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode("utf-8"))
+
+    def _authorized(self):
+        import hmac
+        # 客户端不会带Origin；带Origin的请求来自浏览器中的网页，一律拒绝
+        if self.headers.get("Origin"):
+            self._send_json({"error": "不接受来自网页的请求"}, 403)
+            return False
+        # 只监听本机时Host必须是本机地址，防止DNS重绑定
+        host = (self.headers.get("Host") or "").rsplit(":", 1)[0].strip("[]").lower()
+        if self.loopback_only and host not in LOOPBACK_HOSTS:
+            self._send_json({"error": "Host不正确"}, 403)
+            return False
+        supplied = self.headers.get("Authorization", "")
+        if not hmac.compare_digest(supplied.encode("utf-8"), f"Bearer {self.token}".encode("utf-8")):
+            self._send_json({"error": "未授权"}, 401)
+            return False
+        return True
+
+    def _route(self, method):
+        if not self._authorized():
+            return
+        if method == "POST" and int(self.headers.get("Content-Length") or 0) \
+                and (self.headers.get("Content-Type") or "").split(";")[0].strip().lower() != "application/json":
+            self._send_json({"error": "Content-Type必须是application/json"}, 415)
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0 or length > SERVICE_MAX_BODY:
+            self._send_json({"error": "请求体长度无效或超过上限"}, 413)
+            self.close_connection = True
+            return
+        parts = [p for p in self.path.split("?")[0].split("/") if p]
+        try:
+            body = self._read_json() if method == "POST" else {}
+        except (ValueError, UnicodeDecodeError):
+            self._send_json({"error": "请求不是有效的JSON"}, 400)
+            return
+        try:
+            if method == "GET" and parts == ["health"]:
+                self._send_json({"ok": True, "sessions": len(self.sessions.sessions), "venv": str(Path(VENV_DIR).absolute())})
+            elif method == "GET" and parts == ["stats"]:
+                self._send_json({name: dict(g.stats, in_flight=g.in_flight) for name, g in api_governors.items()})
+            elif method == "POST" and parts == ["sessions"]:
+                self._send_json({"session_id": self.sessions.create().id})
+            elif len(parts) >= 2 and parts[0] == "sessions":
+                self._handle_session(method, parts[1], parts[2:], body)
+            elif method == "POST" and parts == ["extract"]:
+                code, filename = extract_code_from_response(body.get("content", ""), verbose=False)
+                libs = sorted(extract_imports(code, verbose=False)) if code else []
+                self._send_json({"code": code, "filename": filename, "libs": libs})
+            elif method == "POST" and parts == ["install"]:
+                self._send_json({"ok": install_dependencies(set(body.get("libs") or []))})
+            elif method == "POST" and parts == ["run"]:
+                self._handle_run(body)
+            elif method == "GET" and len(parts) == 2 and parts[0] == "jobs":
+                self._handle_job(parts[1])
+            else:
+                self._send_json({"error": "接口不存在"}, 404)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _handle_session(self, method, session_id, action, body):
+        session = self.sessions.get(session_id)
+        if session is None:
+            self._send_json({"error": "会话不存在或已过期"}, 404)
+        elif method == "DELETE" and not action:
+            self.sessions.remove(session_id)
+            self._send_json({"ok": True})
+        elif method == "POST" and action == ["reset"]:
+            with session.lock:
+                session.messages[:] = init_messages()
+                session.store_generated_code(None, None)
+            self._send_json({"ok": True})
+        elif method == "POST" and action == ["chat"]:
+            self._handle_chat(session, body)
+        else:
+            self._send_json({"error": "接口不存在"}, 404)
+
+    def _handle_chat(self, session, body):
+        content = (body.get("content") or "").strip()
+        if not content:
+            self._send_json({"error": "content不能为空"}, 400)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        printer = EventPrinter(self._send_event)
+        # 同一会话的请求依次处理，不同会话并行
+        with session.lock:
+            code_result, response = generate_reply(
+                session.messages, session, printer, content,
+                body.get("model") or "deepseek-chat", body.get("routing") or "off"
+            )
+        usage = response.get("usage") if response else None
+        if printer.disconnected:
+            return
+        self._send_event({
+            "type": "done",
+            "content": session.messages[-1]["content"] if session.messages[-1]["role"] == "assistant" else "",
+            "code": code_result[0] if code_result else None,
+            "filename": code_result[1] if code_result else None,
+            "from_patch": session.code_from_patch if code_result else False,
+            "first_token_latency": response.get("first_token_latency") if response else None,
+            "usage": {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens} if usage else None,
+        })
+
+    def _handle_run(self, body):
+        if body.get("code"):
+            code_content, perf_findings = perf_lint(body["code"])
+            filename = save_code_file(code_content, body.get("filename"), unique=True)
+            record_perf_lint(filename, perf_findings)
+        else:
+            filename = body.get("file")
+            if not filename or not os.path.isfile(filename):
+                self._send_json({"error": "文件不存在"}, 404)
+                return
+        job_id = job_manager.submit(setup_virtual_env(), filename)
+        self._send_json({"job_id": job_id, "file": filename})
+
+    def _handle_job(self, job_id):
+        job = job_manager.get(int(job_id)) if job_id.isdigit() else None
+        if job is None:
+            self._send_json({"error": "任务不存在"}, 404)
+            return
+        job_manager.reap()
+        run = job["run"]
+        data = {"id": job["id"], "file": job["file"], "status": job["status"], "output": run.tail(50) if run else []}
+        if run and run.returncode is not None:
+            data["result"] = run.result()
+        self._send_json(data)
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+def run_service(host=SERVICE_HOST, port=SERVICE_PORT):
+    """启动本地服务（阻塞）"""
+    loopback_only = host in LOOPBACK_HOSTS
+    if not loopback_only and not SERVICE_TOKEN:
+        console.print("[red]❌ 监听非本机地址时必须在.env中设置 SERVICE_TOKEN 作为访问密码[/red]")
+        return
+    ServiceHandler.token = SERVICE_TOKEN or generate_service_token()
+    ServiceHandler.loopback_only = loopback_only
+    ServiceHandler.sessions = ServiceSessions()
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.daemon_threads = True
+    console.print(f"\n[green]✓ 服务已启动: http://{host}:{port}[/green]")
+    if not SERVICE_TOKEN:
+        console.print(f"[blue]访问密码已自动生成并写入 {SERVICE_TOKEN_FILE}（本机客户端自动读取）: {ServiceHandler.token}[/blue]")
+    console.print("[blue]其他窗口在.env中设置 AIGENE_SERVER=此地址 即可连接，按 Ctrl+C 停止[/blue]")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        console.print("\n[yellow]🛑 服务已停止[/yellow]")
+    finally:
+        server.server_close()
+        job_manager.kill_all()
+        warm_launcher.stop()
+
+def serve_cli(argv):
+    """命令行入口：python aigene.py serve [--host 127.0.0.1] [--port 8765]"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="aigene.py serve", description="启动本地服务，多人共用虚拟环境和接口连接")
+    parser.add_argument("--host", default=SERVICE_HOST, help="监听地址，局域网共用时设为 0.0.0.0（必须同时设置 SERVICE_TOKEN）")
+    parser.add_argument("--port", type=int, default=SERVICE_PORT, help="端口")
+    args = parser.parse_args(argv)
+    check_python_version()
+    if not os.path.exists(REQUIREMENTS_FILE):
+        generate_requirements()
+    setup_virtual_env()
+    check_pending_dependencies()
+    run_service(args.host, args.port)
+
+class ServiceClient:
+    """瘦客户端：对话交给服务；与服务共用虚拟环境时依赖也由服务安装，保存和运行仍在本机进行"""
+    def __init__(self, base_url, token=None):
+        self.base_url = base_url.rstrip("/")
+        self.http = requests.Session()
+        token = token or service_token()
+        if token:
+            self.http.headers["Authorization"] = f"Bearer {token}"
+        self.session_id = None
+        self.shared_venv = False
+
+    def _get(self, path, **kwargs):
+        response = self.http.get(self.base_url + path, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def _post(self, path, data=None, **kwargs):
+        response = self.http.post(self.base_url + path, json=data or {}, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def open(self):
+        """创建服务端会话，并确认服务是否与本机使用同一个虚拟环境"""
+        venv = self._get("/health", timeout=10).json().get("venv")
+        self.shared_venv = bool(venv) and os.path.normcase(venv) == os.path.normcase(str(Path(VENV_DIR).absolute()))
+        self.session_id = self._post("/sessions", timeout=10).json()["session_id"]
+        return self.session_id
+
+    def close(self):
+        if self.session_id:
+            try:
+                self.http.delete(f"{self.base_url}/sessions/{self.session_id}", timeout=5)
+            except requests.RequestException:
+                pass
+
+    def reset(self):
+        self._post(f"/sessions/{self.session_id}/reset", timeout=10)
+
+    def chat(self, content, model, printer, routing="off"):
+        """流式对话，返回done事件"""
+        response = self._post(
+            f"/sessions/{self.session_id}/chat",
+            {"content": content, "model": model, "routing": routing},
+            stream=True, timeout=(API_CONNECT_TIMEOUT, None)
+        )
+        for line in iter_sse_lines(response):
+            event = json.loads(line)
+            if event["type"] == "delta":
+                printer.stream_print(event["content"])
+            elif event["type"] == "done":
+                printer.reset()
+                return event
+        printer.reset()
+        return {"type": "done", "content": "", "code": None}
+
+    def install(self, libs):
+        return self._post("/install", {"libs": sorted(libs)}).json().get("ok", False)
+
+def iter_sse_lines(response):
+    """逐个读取SSE事件的data内容"""
+    buffer = ""
+    for piece in response.iter_content(chunk_size=None, decode_unicode=True):
+        buffer += piece
+        while "\n\n" in buffer:
+            event, buffer = buffer.split("\n\n", 1)
+            for line in event.splitlines():
+                if line.startswith("data: "):
+                    yield line[len("data: "):]
+
+def connect_service(base_url):
+    """连接本地服务，失败返回None（回退为独立运行）"""
+    try:
+        service = ServiceClient(base_url)
+        service.open()
+        if service.shared_venv:
+            console.print(f"[green]✓ 已连接服务 {base_url}（对话与依赖安装由服务统一处理）[/green]")
+        else:
+            console.print(f"[green]✓ 已连接服务 {base_url}（对话由服务处理；脚本在本机运行，依赖安装在本机虚拟环境）[/green]")
+        return service
+    except (requests.RequestException, KeyError, ValueError) as e:
+        console.print(f"[yellow]⚠️ 无法连接服务 {base_url}（{type(e).__name__}），改为独立运行[/yellow]")
+        return None
+
+service_client = None
+
+def bench_service(base_url, users=8, turns=3, prompt="写一个打印hello的小工具"):
+    """模拟多个用户同时使用服务，统计吞吐量和首字耗时（建议让服务连接 api_stub.py 模拟接口）"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def simulate_user(_):
+        client_ = ServiceClient(base_url)
+        timings = []
+        errors = 0
+        try:
+            client_.open()
+            for _ in range(turns):
+                start = time.time()
+                first = []
+                printer = SilentPrinter()
+                printer.stream_print = lambda content: first or first.append(time.time() - start)
+                try:
+                    event = client_.chat(prompt, "deepseek-chat", printer)
+                    if not event.get("code"):
+                        errors += 1
+                    timings.append((first[0] if first else None, time.time() - start))
+                except requests.RequestException:
+                    errors += 1
+        except requests.RequestException:
+            errors += turns
+        finally:
+            client_.close()
+        return timings, errors
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        results = list(executor.map(simulate_user, range(users)))
+    elapsed = time.time() - start
+    timings = [t for user_timings, _ in results for t in user_timings]
+    errors = sum(e for _, e in results)
+
+    def pct(values, q):
+        values = sorted(v for v in values if v is not None)
+        return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+    firsts = [t[0] for t in timings]
+    totals = [t[1] for t in timings]
+    console.print(f"\n[cyan]服务压测：{users} 个用户 × {turns} 轮[/cyan]")
+    console.print(f"完成 {len(timings)} 轮，失败 {errors} 轮，总耗时 {elapsed:.2f}s，吞吐 {len(timings) / elapsed:.2f} 轮/秒")
+    console.print(f"首字耗时 P50 {pct(firsts, 0.5):.2f}s  P95 {pct(firsts, 0.95):.2f}s")
+    console.print(f"整轮耗时 P50 {pct(totals, 0.5):.2f}s  P95 {pct(totals, 0.95):.2f}s")
+    return {"turns": len(timings), "errors": errors, "elapsed": elapsed}
+
+def service_bench_cli(argv):
+    """命令行入口：python aigene.py service-bench [--url] [-u 用户数] [-t 每人轮数]"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="aigene.py service-bench", description="模拟多个用户压测本地服务")
+    parser.add_argument("--url", default=os.getenv("AIGENE_SERVER") or f"http://{SERVICE_HOST}:{SERVICE_PORT}")
+    parser.add_argument("-u", "--users", type=int, default=8, help="模拟用户数")
+    parser.add_argument("-t", "--turns", type=int, default=3, help="每个用户的对话轮数")
+    parser.add_argument("-p", "--prompt", default="写一个打印hello的小工具")
+    args = parser.parse_args(argv)
+    bench_service(args.url, args.users, args.turns, args.prompt)
+
+# 无交互命令：python aigene.py <命令> [参数]
+HEADLESS_COMMANDS = {
+    "batch": batch_cli,
+    "serve": serve_cli,
+    "service-bench": service_bench_cli,
+    "sync": sync_cli,
+    "gc": gc_cli,
+}
+
+# ----------------------------
+# 主函数
+# ----------------------------
+def main():
+    try:
+        global current_client_type, client, routing_mode, service_client
+        check_for_updates()
+        check_pending_dependencies()
+        if current_client_type == DEEPSEEK_CLIENT:
+            check_python_version()
+            if not os.path.exists(REQUIREMENTS_FILE):
+                generate_requirements()
+            setup_virtual_env()
+            enforce_storage_budget()
+        
+        if os.getenv("AIGENE_SERVER"):
+            service_client = connect_service(os.getenv("AIGENE_SERVER"))
+
+        printer = StreamPrinter()
+        current_model = "deepseek-chat" if current_client_type == DEEPSEEK_CLIENT else "qwen-max-2025-01-25"
+        
+        # 对话记录同步写入会话日志，可用 resume 恢复
+        messages = SessionMessages(init_messages(), SessionLog())
+        printer.add_listener(lambda content: messages.log and messages.log.record_chunk(content))
         # 实例化命令处理器
         cmd_handler = CommandHandler(messages)
         cmd_handler.show_main_menu()
@@ -1354,32 +7022,38 @@ from datetime import datetime
                 if current_client_type == DEEPSEEK_CLIENT:
                     if user_input == "r":
                         current_model = "deepseek-reasoner"
+                        routing_mode = "off"
                         console.print(f"\n[cyan]已切换到 [bright_blue]{current_model}[/bright_blue] 模型[/cyan]")
                         continue
                     elif user_input == "c":
                         current_model = "deepseek-chat"
+                        routing_mode = "off"
                         console.print(f"\n[cyan]已切换到 {current_model} 模型[/cyan]")
                         continue
+                    elif user_input == "a":
+                        routing_mode = ROUTING_MODES[(ROUTING_MODES.index(routing_mode) + 1) % len(ROUTING_MODES)]
+                        console.print(f"\n[cyan]模型选择方式：{ROUTING_MODE_LABELS[routing_mode]}[/cyan]")
+                        continue
 
                 execute_code = "-n" not in user_input
                 cleaned_input = user_input.replace("-n", "").strip()
                 
-                messages.append({"role": "user", "content": cleaned_input})
-                response = chat_stream(messages, printer, current_model)
-                printer.reset()
-                messages.append({"role": "assistant", "content": response["content"]})
+                if service_client is not None:
+                    try:
+                        event = service_client.chat(cleaned_input, current_model, printer, routing_mode)
+                    except requests.RequestException as e:
+                        console.print(f"\n[red]❌ 服务请求失败: {type(e).__name__}，请检查服务是否在运行[/red]")
+                        continue
+                    code_result = (event["code"], event["filename"]) if event.get("code") else None
+                    if code_result:
+                        cmd_handler.store_generated_code(event["code"], event["filename"], event.get("from_patch", False))
+                else:
+                    code_result, _ = generate_reply(messages, cmd_handler, printer, cleaned_input, current_model, routing_mode)
 
-                code_result = extract_code_from_response(response["content"])
                 if code_result and code_result[0]:
                     code_content, suggested_filename = code_result
-                    cmd_handler.store_generated_code(code_content, suggested_filename)
                     if any(kw in cleaned_input for kw in ["写", "代码", "生成"]):
-                        required_libs = extract_imports(code_content)
-                        if required_libs:
-                            console.print("\n[yellow]正在检查依赖...[/yellow]")
-                            if not install_dependencies(required_libs):
-                                console.print("\n[red]⚠️ 部分依赖安装失败，代码可能无法正常运行[/red]")
-                                continue
+                        # 语法检查、依赖安装、导入检查和启动的顺序由save_and_execute_code负责
                         save_and_execute_code((code_content, suggested_filename), execute_code)
                     else:
                         console.print("\n[blue]💡 检测到代码块，你可以使用:[/blue]")
@@ -1389,9 +7063,18 @@ from datetime import datetime
             except KeyboardInterrupt:
                 console.print("\n[yellow]🛑 操作已中断[/yellow]")
                 break
+        cmd_handler.job_manager.kill_all()
+        warm_launcher.stop()
+        if messages.log:
+            messages.log.close()
+        if service_client is not None:
+            service_client.close()
 
     except Exception as e:
         console.print(f"\n[red]⚠️ 异常: {str(e)}[/red]")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] in HEADLESS_COMMANDS:
+        HEADLESS_COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        main()
\ No newline at end of file
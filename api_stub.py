@@ -0,0 +1,107 @@
+'''api_stub'''
+# 本地模拟接口：兼容OpenAI的 /v1/chat/completions 流式接口，返回固定的代码回复。
+# 用于在不消耗API额度的情况下测试对冲请求、断线续传、限流和性能对比。
+# 用法：python api_stub.py <端口> [首token延迟秒数] [每个分片间隔秒数] [故障模式]
+# 故障模式：drop 输出一半时断开连接；length 输出一半时以长度上限结束。
+# 带assistant前缀（prefix/partial）的续写请求会从前缀之后继续输出剩余内容。
+# 然后在.env中设置 DEEPSEEK_BASE_URL=http://127.0.0.1:<端口>/v1（或 DASHSCOPE_BASE_URL）
+
+import sys
+import json
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+REPLY = '好的\n文件名：『测试工具』.py\n```python\n# 依赖包：无\nimport os\nprint("hello from stub")\n```\n'
+CHUNK_SIZE = 8
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    first_token_delay = 0.0
+    chunk_interval = 0.005
+    fault = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_event(self, obj):
+        """发送一个SSE事件（HTTP分块编码），obj为None时发送结束标记"""
+        data = ("data: " + json.dumps(obj, ensure_ascii=False) + "\n\n").encode("utf-8") if obj is not None else b"data: [DONE]\n\n"
+        self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+        self.wfile.flush()
+
+    def chunk(self, model, delta, finish_reason=None):
+        return {
+            "id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    def do_GET(self):
+        body = json.dumps({"object": "list", "data": [{"id": "stub", "object": "model"}]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        model = request.get("model", "stub")
+        messages = request.get("messages", [])
+        prompt_chars = sum(len(str(m.get("content", ""))) for m in messages)
+        last = messages[-1] if messages else {}
+        prefix = last.get("content", "") if last.get("prefix") or last.get("partial") else ""
+        reply = REPLY[len(prefix):] if REPLY.startswith(prefix) else REPLY
+        # 故障只作用于首次请求，续写请求正常完成
+        cut = len(REPLY) // 2 if self.fault and not prefix else None
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            self.send_event(self.chunk(model, {"role": "assistant", "content": ""}))
+            time.sleep(self.first_token_delay)
+            for i in range(0, len(reply) if cut is None else cut, CHUNK_SIZE):
+                self.send_event(self.chunk(model, {"content": reply[i:i + CHUNK_SIZE]}))
+                time.sleep(self.chunk_interval)
+            if cut is not None and self.fault == "drop":
+                self.close_connection = True
+                self.wfile.flush()
+                self.connection.shutdown(2)
+                return
+            self.send_event(self.chunk(model, {}, "length" if cut is not None else "stop"))
+            self.send_event({
+                "id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [],
+                "usage": {"prompt_tokens": prompt_chars // 2, "completion_tokens": len(reply) // 2,
+                          "total_tokens": prompt_chars // 2 + len(reply) // 2},
+            })
+            self.send_event(None)
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端取消了请求（如对冲请求中落败的一方）
+            pass
+
+def serve(port, first_token_delay=0.0, chunk_interval=0.005, fault=None):
+    StubHandler.first_token_delay = first_token_delay
+    StubHandler.chunk_interval = chunk_interval
+    StubHandler.fault = fault
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    print(f"模拟接口已启动: http://127.0.0.1:{port}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("用法: python api_stub.py <端口> [首token延迟秒数] [每个分片间隔秒数] [drop|length]")
+        sys.exit(1)
+    serve(
+        int(sys.argv[1]),
+        float(sys.argv[2]) if len(sys.argv) > 2 else 0.0,
+        float(sys.argv[3]) if len(sys.argv) > 3 else 0.005,
+        sys.argv[4] if len(sys.argv) > 4 else None,
+    )
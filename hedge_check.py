@@ -0,0 +1,80 @@
+'''hedge_check'''
+# 对冲请求自检：在本地启动两个模拟接口（见 api_stub.py），分别扮演主服务商和备用服务商，
+# 检查 HedgedStream 的胜出方、取消行为以及首token耗时统计（包括被取消请求的删失样本）。
+# 不访问真实接口、不消耗API额度，也不会改动当前目录下的 ttft_stats.json。
+# 用法：python hedge_check.py
+
+import os
+import sys
+import time
+import tempfile
+from threading import Thread
+from http.server import ThreadingHTTPServer
+
+os.environ.setdefault("DEEPSEEK_API_KEY", "stub")
+
+import openai
+import aigene
+from api_stub import StubHandler
+
+def start_stub(first_token_delay):
+    """在后台线程启动一个模拟接口，返回 (服务器, base_url)"""
+    handler = type("Stub", (StubHandler,), {"first_token_delay": first_token_delay, "chunk_interval": 0.001})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+def run_hedge(primary_delay, secondary_delay, threshold):
+    """用两个模拟接口跑一次对冲请求，返回 (胜出方, 回复文本, 耗时, 统计)"""
+    primary, primary_url = start_stub(primary_delay)
+    secondary, secondary_url = start_stub(secondary_delay)
+    stats = aigene.TTFTStats(os.path.join(tempfile.mkdtemp(prefix="autocode_hedge_check_"), "ttft_stats.json"))
+    aigene.ttft_stats = stats
+    try:
+        attempts = [
+            ("deepseek", openai.OpenAI(api_key="stub", base_url=primary_url, max_retries=0), "deepseek-chat"),
+            ("qwen", openai.OpenAI(api_key="stub", base_url=secondary_url, max_retries=0), "qwen-max"),
+        ]
+        stream = aigene.HedgedStream(attempts, threshold, messages=[{"role": "user", "content": "hi"}])
+        start = time.time()
+        text = "".join(chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices)
+        return stream.provider, text, time.time() - start, stats.data
+    finally:
+        primary.shutdown()
+        secondary.shutdown()
+
+def check(name, condition, detail=""):
+    print(f"{'✓' if condition else '❌'} {name}{'：' + detail if detail else ''}")
+    return condition
+
+def main():
+    results = []
+
+    # 主服务商很快：不应启动备用请求，记录一个正常样本
+    provider, text, elapsed, data = run_hedge(0.0, 0.0, 1.0)
+    results.append(check("主服务商及时响应时由主服务商胜出", provider == "deepseek", provider))
+    results.append(check("回复内容完整", "hello from stub" in text))
+    results.append(check("未启动备用请求", "qwen" not in data))
+    results.append(check("记录主服务商的正常样本", data.get("deepseek", {}).get("count") == 1
+                         and not data["deepseek"].get("censored")))
+
+    # 主服务商很慢：超过阈值后启动备用请求并胜出，主服务商被取消且记为删失样本
+    threshold = 0.3
+    provider, text, elapsed, data = run_hedge(3.0, 0.0, threshold)
+    results.append(check("主服务商超时后由备用服务商胜出", provider == "qwen", provider))
+    results.append(check("回复内容完整", "hello from stub" in text))
+    results.append(check("不必等待慢速主服务商", elapsed < 2.0, f"{elapsed:.2f}秒"))
+    entry = data.get("deepseek", {})
+    results.append(check("被取消的主服务商记为删失样本", entry.get("censored") == 1 and entry.get("count") == 1))
+    results.append(check("删失样本不小于对冲阈值", entry.get("sum", 0) >= threshold, f"{entry.get('sum', 0):.2f}秒"))
+    results.append(check("记录备用服务商的正常样本", data.get("qwen", {}).get("count") == 1))
+
+    print()
+    if all(results):
+        print("全部检查通过")
+        return 0
+    print(f"{results.count(False)} 项检查失败")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+'''install_race_check'''
+# 多窗口同时安装依赖的自检：在临时目录中准备虚拟环境和本地wheel索引，
+# 同时启动多个进程调用 aigene.install_dependencies 安装同一个包，检查安装锁能否把安装串行化：
+# 所有进程都成功、真正执行pip安装的时间段互不重叠、等待过锁的进程不再重复安装。
+# 全程离线（PIP_NO_INDEX + PIP_FIND_LINKS 指向本地wheel），不会改动当前目录下的虚拟环境。
+# 用法：python install_race_check.py [进程数，默认4]
+
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PACKAGE = "autocode-race-demo"
+DEPENDENCY = "autocode-race-dep"
+
+def build_wheel(index_dir, name, requires=()):
+    """在index_dir中生成一个纯Python的wheel，返回文件路径"""
+    module = name.replace("-", "_")
+    dist_info = f"{module}-1.0.dist-info"
+    metadata = f"Metadata-Version: 2.1\nName: {name}\nVersion: 1.0\n"
+    metadata += "".join(f"Requires-Dist: {req}\n" for req in requires)
+    files = {
+        f"{module}/__init__.py": f"NAME = {name!r}\n",
+        f"{dist_info}/METADATA": metadata,
+        f"{dist_info}/WHEEL": "Wheel-Version: 1.0\nGenerator: install_race_check\nRoot-Is-Purelib: true\nTag: py3-none-any\n",
+        f"{dist_info}/top_level.txt": module + "\n",
+    }
+    files[f"{dist_info}/RECORD"] = "".join(f"{path},,\n" for path in files) + f"{dist_info}/RECORD,,\n"
+    path = os.path.join(index_dir, f"{module}-1.0-py3-none-any.whl")
+    with zipfile.ZipFile(path, "w") as zf:
+        for arcname, content in files.items():
+            zf.writestr(arcname, content)
+    return path
+
+def worker(log_path, go_path):
+    """子进程：导入aigene后等待统一开始信号，再安装同一个包，并记录每次真正执行安装的时间段"""
+    import aigene
+
+    real_install = aigene._install_dependencies
+
+    def logged_install(required_libs):
+        start = time.time()
+        try:
+            return real_install(required_libs)
+        finally:
+            write_log(log_path, {"pid": os.getpid(), "event": "install", "start": start, "end": time.time(),
+                                 "libs": list(required_libs)})
+
+    aigene._install_dependencies = logged_install
+    write_log(log_path, {"pid": os.getpid(), "event": "ready"})
+    while not os.path.exists(go_path):
+        time.sleep(0.01)
+    ok = aigene.install_dependencies([PACKAGE])
+    write_log(log_path, {"pid": os.getpid(), "event": "done", "ok": ok, "waited": aigene.install_lock.waited})
+    return 0 if ok else 1
+
+def write_log(log_path, record):
+    # O_APPEND 保证多个进程的整行写入不会互相覆盖
+    fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record) + "\n").encode("utf-8"))
+    finally:
+        os.close(fd)
+
+def read_log(log_path):
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def check(name, condition, detail=""):
+    print(f"{'✓' if condition else '❌'} {name}{'：' + detail if detail else ''}")
+    return condition
+
+def main(count):
+    work_dir = tempfile.mkdtemp(prefix="autocode_install_race_")
+    try:
+        index_dir = os.path.join(work_dir, "index")
+        os.makedirs(index_dir)
+        build_wheel(index_dir, PACKAGE, [DEPENDENCY])
+        build_wheel(index_dir, DEPENDENCY)
+        print("正在创建临时虚拟环境...")
+        # 与 aigene.VENV_DIR 同名，子进程在work_dir中运行时直接使用它
+        venv_dir = os.path.join(work_dir, "venv3.9")
+        subprocess.run([sys.executable, "-m", "venv", venv_dir], check=True)
+
+        log_path = os.path.join(work_dir, "race.jsonl")
+        go_path = os.path.join(work_dir, "go")
+        env = dict(os.environ)
+        env.update({
+            "PYTHONPATH": HERE + os.pathsep + env.get("PYTHONPATH", ""),
+            "PIP_NO_INDEX": "1",
+            "PIP_FIND_LINKS": index_dir,
+            "DEEPSEEK_API_KEY": env.get("DEEPSEEK_API_KEY", "stub"),
+        })
+        processes = [
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker", log_path, go_path],
+                             cwd=work_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             text=True, encoding="utf-8", errors="replace")
+            for _ in range(count)
+        ]
+        # 所有进程导入完成后再同时开始，尽量让它们在同一时刻争抢安装锁
+        deadline = time.time() + 120
+        while sum(r["event"] == "ready" for r in read_log(log_path)) < count and time.time() < deadline:
+            if any(p.poll() is not None for p in processes):
+                break
+            time.sleep(0.05)
+        print(f"{count} 个进程同时开始安装 {PACKAGE}...")
+        open(go_path, "w").close()
+        outputs = [p.communicate(timeout=300)[0] for p in processes]
+
+        records = read_log(log_path)
+        done = [r for r in records if r["event"] == "done"]
+        installs = sorted((r for r in records if r["event"] == "install"), key=lambda r: r["start"])
+        overlaps = [(a["pid"], b["pid"]) for a, b in zip(installs, installs[1:]) if b["start"] < a["end"]]
+        site_check = subprocess.run(
+            [os.path.join(venv_dir, "Scripts" if sys.platform == "win32" else "bin", "python"),
+             "-c", "import autocode_race_demo, autocode_race_dep"],
+            capture_output=True, text=True)
+
+        results = [
+            check("所有进程都安装成功", len(done) == count and all(r["ok"] for r in done),
+                  f"{sum(r['ok'] for r in done)}/{count}"),
+            check("真正执行安装的时间段互不重叠", not overlaps, f"重叠 {overlaps}" if overlaps else ""),
+            check("只有一个进程执行了pip安装", len(installs) == 1, f"{len(installs)} 次"),
+            check("其余进程等待锁后直接复用安装结果", sum(r["waited"] for r in done) == count - 1,
+                  f"{sum(r['waited'] for r in done)} 个等待过"),
+            check("包及其依赖都已装入虚拟环境", site_check.returncode == 0, site_check.stderr.strip()[-200:]),
+            check("安装结束后已清理持有者信息", not os.path.exists(os.path.join(work_dir, ".venv3.9.installing.json"))),
+        ]
+        print()
+        if all(results):
+            print("全部检查通过")
+            return 0
+        print(f"{results.count(False)} 项检查失败，各进程输出：")
+        for process, output in zip(processes, outputs):
+            print(f"--- pid {process.pid} (退出码 {process.returncode}) ---")
+            print(output.strip()[-2000:])
+        return 1
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+        sys.exit(worker(sys.argv[2], sys.argv[3]))
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 4))
@@ -0,0 +1,143 @@
+'''warm_launcher'''
+# 预热启动器：在虚拟环境中常驻，预先导入常用的重量级模块，
+# 收到启动请求后fork出子进程运行脚本，省去解释器启动和模块导入的时间。
+# 仅支持Linux/macOS（依赖fork与Unix域套接字）。
+# 用法：python warm_launcher.py <套接字路径> [预导入模块 ...]
+
+import os
+import sys
+import json
+import runpy
+import socket
+import importlib
+import traceback
+from threading import Thread
+
+MAX_REQUEST_SIZE = 1024 * 1024
+
+def preload_modules(modules):
+    """预导入模块，导入失败的模块直接跳过"""
+    loaded = []
+    for name in modules:
+        try:
+            importlib.import_module(name)
+            loaded.append(name)
+        except Exception:
+            pass
+    return loaded
+
+def apply_limits(limits):
+    """在子进程中设置资源限制"""
+    import resource
+    for name, value in limits.items():
+        limit = getattr(resource, name, None)
+        if limit is None or not value or value <= 0:
+            continue
+        try:
+            soft, hard = resource.getrlimit(limit)
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            resource.setrlimit(limit, (value, hard))
+        except (ValueError, OSError):
+            pass
+
+def run_child(request, fds):
+    """子进程：接管标准输入输出，切换工作目录与参数后运行脚本"""
+    os.setsid()
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    sys.stdin = open(0, "r", encoding="utf-8", closefd=False)
+    sys.stdout = open(1, "w", encoding="utf-8", buffering=1, closefd=False)
+    sys.stderr = open(2, "w", encoding="utf-8", buffering=1, closefd=False)
+    exit_code = 0
+    script = request["argv"][0]
+    try:
+        apply_limits(request.get("limits", {}))
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = list(request["argv"])
+        sys.path[0] = os.path.dirname(os.path.abspath(script))
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None:
+            exit_code = 0
+        elif isinstance(e.code, int):
+            exit_code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException:
+        # 去掉启动器自身的调用栈，只显示脚本中的回溯
+        etype, value, tb = sys.exc_info()
+        script_tb = tb
+        while script_tb is not None and script_tb.tb_frame.f_code.co_filename != script:
+            script_tb = script_tb.tb_next
+        traceback.print_exception(etype, value, script_tb or tb)
+        exit_code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except Exception:
+            pass
+        os._exit(exit_code)
+
+def wait_child(conn, pid):
+    """等待子进程结束，把退出码和峰值内存发回启动方"""
+    try:
+        _, status, rusage = os.wait4(pid, 0)
+        result = {"exit_code": os.waitstatus_to_exitcode(status), "maxrss": rusage.ru_maxrss}
+        conn.sendall((json.dumps(result) + "\n").encode("utf-8"))
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+def handle_request(server, conn):
+    """接收一个启动请求（JSON + 标准输入输出的文件描述符）并fork运行"""
+    data, fds, _, _ = socket.recv_fds(conn, MAX_REQUEST_SIZE, 3)
+    if not data or len(fds) != 3:
+        for fd in fds:
+            os.close(fd)
+        conn.close()
+        return
+    request = json.loads(data.decode("utf-8"))
+    pid = os.fork()
+    if pid == 0:
+        server.close()
+        conn.close()
+        run_child(request, fds)
+    for fd in fds:
+        os.close(fd)
+    conn.sendall((json.dumps({"pid": pid}) + "\n").encode("utf-8"))
+    Thread(target=wait_child, args=(conn, pid), daemon=True).start()
+
+def serve(socket_path, modules):
+    loaded = preload_modules(modules)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(16)
+    # 通知启动方已就绪，并告知实际预导入的模块
+    print(json.dumps({"ready": True, "modules": loaded}), flush=True)
+    try:
+        while True:
+            conn, _ = server.accept()
+            try:
+                handle_request(server, conn)
+            except Exception:
+                traceback.print_exc()
+                conn.close()
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("用法: python warm_launcher.py <套接字路径> [预导入模块 ...]")
+        sys.exit(1)
+    serve(sys.argv[1], sys.argv[2:])